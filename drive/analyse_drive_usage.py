@@ -0,0 +1,107 @@
+import argparse
+import json
+import sqlite3
+
+from core_data_modules.logging import Logger
+from storage.google_cloud import google_cloud_utils
+
+from src.drive_objects import init_drive_service
+from src.usage_snapshot import DriveUsageSnapshot, populate_snapshot, apply_changes
+
+log = Logger(__name__)
+
+DEFAULT_TOP_N = 20
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarises the quota used by the objects in a service account's "
+                                                 "Drive account, by parent folder, mime type and age")
+
+    parser.add_argument("--snapshot-path",
+                        help="Path to a SQLite file to keep a snapshot of the service account's objects in. If the "
+                             "snapshot exists, only the objects changed since the previous run are fetched from "
+                             "Drive. If not provided, every object is listed on each run")
+    parser.add_argument("--full-rescan", const=True, default=False, action="store_const",
+                        help="Re-list every object into the snapshot, rather than only fetching the changes since the "
+                             "previous run")
+    parser.add_argument("--top-n", type=int, default=DEFAULT_TOP_N,
+                        help=f"Number of parent folders and mime types to report. Defaults to {DEFAULT_TOP_N}")
+    parser.add_argument("--json-output-file-path",
+                        help="JSON file to write the complete usage summary to")
+    parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
+                        help="Path to a Google Cloud service account credentials file to use to access the "
+                             "credentials bucket")
+    parser.add_argument("google_drive_credentials_url", metavar="google-drive-credentials-url",
+                        help="GS URL to the Drive service account credentials file to use")
+
+    args = parser.parse_args()
+
+    snapshot_path = args.snapshot_path
+    full_rescan = args.full_rescan
+    top_n = args.top_n
+    json_output_file_path = args.json_output_file_path
+    google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
+    google_drive_credentials_url = args.google_drive_credentials_url
+
+    log.info("Initialising Google Drive client...")
+    credentials_info = json.loads(google_cloud_utils.download_blob_to_string(
+        google_cloud_credentials_file_path,
+        google_drive_credentials_url
+    ))
+    drive_service = init_drive_service(credentials_info)
+
+    if snapshot_path is None:
+        snapshot = DriveUsageSnapshot(sqlite3.connect(":memory:"))
+    else:
+        snapshot = DriveUsageSnapshot.open(snapshot_path)
+
+    if full_rescan or snapshot.get_start_page_token() is None:
+        log.info("Listing all objects owned by the service account...")
+        objects_listed = populate_snapshot(drive_service, snapshot)
+        log.info(f"Listed {objects_listed} objects")
+    else:
+        log.info(f"Fetching the changes made since the snapshot at '{snapshot_path}' was last updated...")
+        changes_applied = apply_changes(drive_service, snapshot)
+        log.info(f"Applied {changes_applied} changes")
+    snapshot.commit()
+
+    object_count, total_bytes = snapshot.total_usage()
+    usage_by_parent = snapshot.usage_by_parent()
+    usage_by_mime_type = snapshot.usage_by_mime_type()
+    usage_by_age = snapshot.usage_by_age()
+
+    log.info(f"Total: {object_count} objects using {total_bytes} bytes")
+
+    log.info(f"Top {top_n} parent folders by quota used:")
+    for parent_id, parent_name, count, usage in usage_by_parent[:top_n]:
+        log.info(f"  {usage} bytes in {count} objects: '{parent_name}' ({parent_id})")
+
+    log.info(f"Top {top_n} mime types by quota used:")
+    for mime_type, count, usage in usage_by_mime_type[:top_n]:
+        log.info(f"  {usage} bytes in {count} objects: {mime_type}")
+
+    log.info("Quota used by object age:")
+    for label, count, usage in usage_by_age:
+        log.info(f"  {usage} bytes in {count} objects: {label}")
+
+    if json_output_file_path is not None:
+        log.info(f"Writing the usage summary to '{json_output_file_path}'...")
+        with open(json_output_file_path, "w") as f:
+            json.dump({
+                "objects": object_count,
+                "quota_bytes_used": total_bytes,
+                "by_parent": [
+                    {"parent_id": parent_id, "parent_name": parent_name, "objects": count, "quota_bytes_used": usage}
+                    for parent_id, parent_name, count, usage in usage_by_parent
+                ],
+                "by_mime_type": [
+                    {"mime_type": mime_type, "objects": count, "quota_bytes_used": usage}
+                    for mime_type, count, usage in usage_by_mime_type
+                ],
+                "by_age": [
+                    {"age": label, "objects": count, "quota_bytes_used": usage}
+                    for label, count, usage in usage_by_age
+                ]
+            }, f, indent=2)
+
+    snapshot.close()
+    log.info("Done")
@@ -8,7 +8,8 @@ from storage.google_drive import drive_client_wrapper
 log = Logger(__name__)
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Deletes an object from Google Drive")
+    parser = argparse.ArgumentParser(description="Deletes an object from Google Drive. To delete many objects, use "
+                                                 "delete_objects.py")
 
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
                         help="Path to a Google Cloud service account credentials file to use to access the "
@@ -0,0 +1,94 @@
+import argparse
+import json
+
+from core_data_modules.logging import Logger
+from storage.google_cloud import google_cloud_utils
+
+from src.bulk_delete import BulkDeleter, DeletionProgressLog, ObjectFilter, ObjectSelector, \
+    DEFAULT_MAX_CONCURRENT_BATCHES, MAX_BATCH_SIZE
+from src.drive_objects import iter_jsonl, quota_bytes_used, DEFAULT_ROOT_URL
+
+log = Logger(__name__)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deletes many objects from Google Drive, using a listing exported by "
+                                                 "list_all_objects_in_drive.py")
+
+    parser.add_argument("--dry-run", const=True, default=False, action="store_const",
+                        help="Logs the objects that would be deleted, without deleting anything")
+    parser.add_argument("--filter",
+                        help="Python expression selecting the objects in the listing to delete, which can refer to "
+                             "each object's fields by name, e.g. \"mimeType == 'text/csv' and "
+                             "int(quotaBytesUsed) > 1e6 and days_since(createdTime) > 90\". "
+                             "If not provided, deletes every object in the listing")
+    parser.add_argument("--progress-log-file-path",
+                        help="JSONL file to record the outcome of each delete in. If this file already exists, "
+                             "objects it records as deleted are skipped, so an interrupted run can be resumed by "
+                             "re-running with the same progress log")
+    parser.add_argument("--max-concurrent-batches", type=int, default=DEFAULT_MAX_CONCURRENT_BATCHES,
+                        help=f"Maximum number of batch requests of up to {MAX_BATCH_SIZE} deletes to have in flight "
+                             f"at once. Defaults to {DEFAULT_MAX_CONCURRENT_BATCHES}")
+    parser.add_argument("--fake-drive-api-root-url",
+                        help="Root URL of a local fake Drive API to send unauthenticated requests to instead of "
+                             "Google, for testing. If provided, the Drive credentials are not downloaded")
+    parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
+                        help="Path to a Google Cloud service account credentials file to use to access the "
+                             "credentials bucket")
+    parser.add_argument("google_drive_credentials_url", metavar="google-drive-credentials-url",
+                        help="GS URL to the Drive service account credentials file to use")
+    parser.add_argument("jsonl_input_file_path", metavar="jsonl-input-file-path",
+                        help="JSONL listing of objects to delete, as exported by list_all_objects_in_drive.py")
+
+    args = parser.parse_args()
+
+    dry_run = args.dry_run
+    filter_expression = args.filter
+    progress_log_file_path = args.progress_log_file_path
+    max_concurrent_batches = args.max_concurrent_batches
+    fake_drive_api_root_url = args.fake_drive_api_root_url
+    google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
+    google_drive_credentials_url = args.google_drive_credentials_url
+    jsonl_input_file_path = args.jsonl_input_file_path
+
+    dry_run_text = " (dry run)" if dry_run else ""
+
+    object_filter = None if filter_expression is None else ObjectFilter(filter_expression)
+    progress_log = None if progress_log_file_path is None else DeletionProgressLog(progress_log_file_path)
+
+    if fake_drive_api_root_url is not None:
+        log.warning(f"Sending unauthenticated requests to the fake Drive API at '{fake_drive_api_root_url}'")
+        credentials_info = None
+        root_url = fake_drive_api_root_url
+    else:
+        log.info("Downloading Google Drive credentials...")
+        credentials_info = json.loads(google_cloud_utils.download_blob_to_string(
+            google_cloud_credentials_file_path,
+            google_drive_credentials_url
+        ))
+        root_url = DEFAULT_ROOT_URL
+    deleter = BulkDeleter(credentials_info, root_url, max_concurrent_batches)
+
+    selector = ObjectSelector(object_filter, progress_log)
+
+    log.info(f"Deleting the objects listed in '{jsonl_input_file_path}'{dry_run_text}...")
+    with open(jsonl_input_file_path) as f:
+        selected_objects = selector.select(iter_jsonl(f))
+        if dry_run:
+            for drive_object in selected_objects:
+                log.info(f"Would delete '{drive_object.get('name')}' ({drive_object['id']}, "
+                         f"{quota_bytes_used(drive_object)} bytes)")
+            outcome_counts = {"deleted": 0, "not_found": 0, "failed": 0}
+        else:
+            outcome_counts = deleter.delete_all(
+                (drive_object["id"] for drive_object in selected_objects), progress_log
+            )
+
+    if progress_log is not None:
+        progress_log.close()
+
+    log.info(f"Selected {selector.selected_objects} objects using {selector.selected_bytes} bytes of quota"
+             f"{dry_run_text}")
+    log.info(f"Done. Deleted {outcome_counts['deleted']} objects. {outcome_counts['not_found']} objects were "
+             f"already deleted, and {outcome_counts['failed']} deletes failed{dry_run_text}")
+    if outcome_counts["failed"] > 0:
+        exit(1)
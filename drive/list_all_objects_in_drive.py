@@ -3,13 +3,21 @@ import json
 
 from core_data_modules.logging import Logger
 from storage.google_cloud import google_cloud_utils
-from storage.google_drive import drive_client_wrapper
+
+from src.drive_objects import (init_drive_service, iter_object_pages, quota_bytes_used, write_jsonl, sort_objects,
+                               TopKLargest)
 
 log = Logger(__name__)
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Exports a list of all objects in a service account's Drive account")
+    parser = argparse.ArgumentParser(description="Exports a list of all objects in a service account's Drive account, "
+                                                 "sorted by quotaBytesUsed")
 
+    parser.add_argument("--unsorted", const=True, default=False, action="store_const",
+                        help="Write each page of objects to the output file as soon as it is fetched, in the order "
+                             "Drive returns them, rather than sorting the objects by quotaBytesUsed")
+    parser.add_argument("--top-k", type=int,
+                        help="Also log a summary of the k objects using the most quota")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
                         help="Path to a Google Cloud service account credentials file to use to access the "
                              "credentials bucket")
@@ -20,6 +28,8 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    unsorted = args.unsorted
+    top_k = args.top_k
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
     google_drive_credentials_url = args.google_drive_credentials_url
     jsonl_output_file_path = args.jsonl_output_file_path
@@ -29,17 +39,34 @@ if __name__ == "__main__":
         google_cloud_credentials_file_path,
         google_drive_credentials_url
     ))
-    drive_client_wrapper.init_client_from_info(credentials_info)
+    drive_service = init_drive_service(credentials_info)
 
-    log.info("Fetching info on all objects owned by the service account...")
-    objects = drive_client_wrapper.list_all_objects_in_drive()
-    log.info(f"Fetched info on {len(objects)} objects")
+    largest_objects = None if top_k is None else TopKLargest(top_k)
 
-    objects.sort(key=lambda f: int(f["quotaBytesUsed"]))
+    def iter_objects():
+        objects_fetched = 0
+        for page in iter_object_pages(drive_service):
+            for drive_object in page:
+                if largest_objects is not None:
+                    largest_objects.add(drive_object)
+                yield drive_object
+            objects_fetched += len(page)
+            log.info(f"Fetched info on {objects_fetched} objects so far")
 
-    log.info(f"Exporting object info to '{jsonl_output_file_path}'...")
+    log.info("Fetching info on all objects owned by the service account...")
     with open(jsonl_output_file_path, "w") as f:
-        for file in objects:
-            json.dump(file, f)
-            f.write("\n")
+        if unsorted:
+            log.info(f"Exporting object info to '{jsonl_output_file_path}' as it is fetched...")
+            objects_written = write_jsonl(iter_objects(), f)
+        else:
+            log.info(f"Exporting object info to '{jsonl_output_file_path}', sorted by quotaBytesUsed...")
+            objects_written = write_jsonl(sort_objects(iter_objects(), quota_bytes_used), f)
+    log.info(f"Exported info on {objects_written} objects")
+
+    if largest_objects is not None:
+        log.info(f"Top {top_k} objects by quotaBytesUsed:")
+        for drive_object in largest_objects.largest():
+            log.info(f"  {quota_bytes_used(drive_object)} bytes: '{drive_object.get('name')}' ({drive_object['id']}, "
+                     f"{drive_object.get('mimeType')})")
+
     log.info("Done")
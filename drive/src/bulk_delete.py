@@ -0,0 +1,319 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+
+from core_data_modules.logging import Logger
+from dateutil.parser import isoparse
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+
+from src.drive_objects import init_drive_service, quota_bytes_used, DEFAULT_ROOT_URL
+
+log = Logger(__name__)
+
+# Maximum number of calls Drive accepts in a single batch request
+MAX_BATCH_SIZE = 100
+
+DEFAULT_MAX_CONCURRENT_BATCHES = 4
+
+# HTTP statuses for which a delete is worth retrying after backing off. Drive reports rate limiting as either a 403
+# (with reason rateLimitExceeded or userRateLimitExceeded) or a 429.
+_RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class _FilterNamespace(dict):
+    # Fields missing from an object evaluate to None in filter expressions, rather than raising a NameError
+    def __missing__(self, key):
+        return None
+
+
+def _days_since(timestamp):
+    return (datetime.now(timezone.utc) - isoparse(timestamp)).total_seconds() / (24 * 60 * 60)
+
+
+_FILTER_FUNCTIONS = {
+    "int": int,
+    "float": float,
+    "str": str,
+    "len": len,
+    "any": any,
+    "all": all,
+    "days_since": _days_since
+}
+
+
+class ObjectFilter:
+    """
+    Selects objects from a Drive listing using a Python expression, which can refer to each object's fields by name
+    e.g. "mimeType == 'text/csv' and int(quotaBytesUsed) > 1e6 and days_since(createdTime) > 90".
+
+    Fields missing from an object evaluate to None. The only functions available are int, float, str, len, any, all,
+    and days_since, which returns the number of days since an ISO 8601 timestamp.
+
+    :param expression: Expression which evaluates to a truthy value for the objects to select.
+    :type expression: str
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        self._code = compile(expression, "<filter>", "eval")
+
+    def matches(self, drive_object):
+        """
+        :param drive_object: Object from a Drive listing.
+        :type drive_object: dict
+        :return: Whether the object matches this filter.
+        :rtype: bool
+        """
+        namespace = _FilterNamespace({**drive_object, **_FILTER_FUNCTIONS})
+        return bool(eval(self._code, {"__builtins__": {}}, namespace))
+
+
+class DeletionProgressLog:
+    """
+    Append-only log of the outcome of each object's deletion, so that an interrupted bulk deletion can resume without
+    re-requesting deletions that have already succeeded.
+
+    Each line is a json object {"id", "status"}, where status is one of "deleted", "not_found" or "failed".
+
+    :param file_path: Path to the progress log. This is created if it does not exist.
+    :type file_path: str
+    """
+    COMPLETED_STATUSES = {"deleted", "not_found"}
+
+    def __init__(self, file_path):
+        self._lock = threading.Lock()
+        self._completed_ids = set()
+        if os.path.exists(file_path):
+            with open(file_path) as f:
+                for line in f:
+                    if line.strip() == "":
+                        continue
+                    entry = json.loads(line)
+                    if entry["status"] in self.COMPLETED_STATUSES:
+                        self._completed_ids.add(entry["id"])
+        self._f = open(file_path, "a")
+
+    def is_completed(self, object_id):
+        """
+        :param object_id: Id of the object to check.
+        :type object_id: str
+        :return: Whether this object has already been deleted, or found not to exist, by a previous run.
+        :rtype: bool
+        """
+        return object_id in self._completed_ids
+
+    def record(self, outcomes):
+        """
+        :param outcomes: Status of each object, keyed by object id.
+        :type outcomes: dict of str -> str
+        """
+        with self._lock:
+            for object_id, status in outcomes.items():
+                self._f.write(json.dumps({"id": object_id, "status": status}))
+                self._f.write("\n")
+                if status in self.COMPLETED_STATUSES:
+                    self._completed_ids.add(object_id)
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def close(self):
+        self._f.close()
+
+
+class ObjectSelector:
+    """
+    Selects the objects to delete from a Drive listing, and tallies how many objects were selected and how many bytes
+    of quota they use.
+
+    :param object_filter: Filter the objects must match to be selected, or None to select every object.
+    :type object_filter: ObjectFilter | None
+    :param progress_log: Progress log of a previous run, or None. Objects it records as already deleted or not found
+                         are not selected again.
+    :type progress_log: DeletionProgressLog | None
+    """
+    def __init__(self, object_filter=None, progress_log=None):
+        self._object_filter = object_filter
+        self._progress_log = progress_log
+        self.selected_objects = 0
+        self.selected_bytes = 0
+
+    def select(self, drive_objects):
+        """
+        :param drive_objects: Objects from a Drive listing.
+        :type drive_objects: iterable of dict
+        :return: Generator of the selected objects. The tallies are updated as each object is yielded.
+        :rtype: iterator of dict
+        """
+        for drive_object in drive_objects:
+            if self._object_filter is not None and not self._object_filter.matches(drive_object):
+                continue
+            if self._progress_log is not None and self._progress_log.is_completed(drive_object["id"]):
+                continue
+
+            self.selected_objects += 1
+            self.selected_bytes += quota_bytes_used(drive_object)
+            yield drive_object
+
+
+def _is_retryable(exception):
+    if not isinstance(exception, HttpError):
+        return False
+    if exception.resp.status in _RETRYABLE_STATUSES:
+        return True
+    if exception.resp.status == 403:
+        try:
+            errors = json.loads(exception.content.decode("utf-8"))["error"]["errors"]
+        except (ValueError, KeyError, TypeError):
+            return False
+        return any(error.get("reason") in _RATE_LIMIT_REASONS for error in errors)
+    return False
+
+
+class BulkDeleter:
+    """
+    Deletes objects from Google Drive in batch requests of up to `MAX_BATCH_SIZE` deletes, with up to
+    `max_concurrent_batches` batch requests in flight at once.
+
+    Each worker thread uses its own Drive service, because the underlying http client isn't thread-safe. Deletes that
+    fail because of rate limiting or server errors are retried with exponential backoff.
+
+    :param credentials_info: Drive service account credentials, or None to send unauthenticated requests.
+    :type credentials_info: dict | None
+    :param root_url: Root URL of the Google APIs to send requests to, for example to test against a local fake Drive
+                     API.
+    :type root_url: str
+    :param max_concurrent_batches: Maximum number of batch requests to have in flight at once.
+    :type max_concurrent_batches: int
+    :param max_attempts: Maximum number of times to attempt each delete before recording it as failed.
+    :type max_attempts: int
+    :param initial_backoff_seconds: Time to wait before the first retry. This doubles after each failed attempt.
+    :type initial_backoff_seconds: float
+    """
+    def __init__(self, credentials_info, root_url=DEFAULT_ROOT_URL,
+                 max_concurrent_batches=DEFAULT_MAX_CONCURRENT_BATCHES, max_attempts=6, initial_backoff_seconds=1):
+        self._credentials_info = credentials_info
+        self._root_url = root_url
+        self._max_concurrent_batches = max_concurrent_batches
+        self._max_attempts = max_attempts
+        self._initial_backoff_seconds = initial_backoff_seconds
+        self._thread_local = threading.local()
+
+    def _drive_service(self):
+        if not hasattr(self._thread_local, "drive_service"):
+            self._thread_local.drive_service = init_drive_service(self._credentials_info, self._root_url)
+        return self._thread_local.drive_service
+
+    def _execute_batch(self, object_ids):
+        # Returns a dict of object id -> exception (or None if the delete succeeded)
+        results = dict()
+
+        def callback(request_id, response, exception):
+            results[request_id] = exception
+
+        batch = BatchHttpRequest(callback=callback, batch_uri=f"{self._root_url}batch/drive/v3")
+        for object_id in object_ids:
+            batch.add(self._drive_service().files().delete(fileId=object_id), request_id=object_id)
+        batch.execute()
+        return results
+
+    def delete_batch(self, object_ids):
+        """
+        Deletes a batch of objects, retrying the deletes which fail with retryable errors.
+
+        :param object_ids: Ids of the objects to delete. At most `MAX_BATCH_SIZE`.
+        :type object_ids: list of str
+        :return: Outcome of each delete, keyed by object id. Each outcome is one of "deleted", "not_found" or
+                 "failed".
+        :rtype: dict of str -> str
+        """
+        assert len(object_ids) <= MAX_BATCH_SIZE, f"Cannot delete {len(object_ids)} objects in one batch request"
+
+        outcomes = dict()
+        pending_ids = list(object_ids)
+        backoff_seconds = self._initial_backoff_seconds
+        for attempt in range(1, self._max_attempts + 1):
+            try:
+                results = self._execute_batch(pending_ids)
+            except HttpError as e:
+                if not _is_retryable(e):
+                    raise
+                results = {object_id: e for object_id in pending_ids}
+
+            retry_ids = []
+            for object_id in pending_ids:
+                exception = results.get(object_id)
+                if exception is None:
+                    outcomes[object_id] = "deleted"
+                elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                    outcomes[object_id] = "not_found"
+                elif _is_retryable(exception) and attempt < self._max_attempts:
+                    retry_ids.append(object_id)
+                else:
+                    log.warning(f"Failed to delete object '{object_id}': {exception}")
+                    outcomes[object_id] = "failed"
+
+            if len(retry_ids) == 0:
+                break
+
+            log.warning(f"{len(retry_ids)} deletes were rate limited or failed with a server error "
+                        f"(attempt {attempt}/{self._max_attempts}). Retrying in {backoff_seconds} seconds...")
+            time.sleep(backoff_seconds)
+            backoff_seconds *= 2
+            pending_ids = retry_ids
+
+        return outcomes
+
+    def delete_all(self, object_ids, progress_log=None):
+        """
+        Deletes objects, in batch requests run concurrently on a bounded pool of worker threads.
+
+        :param object_ids: Ids of the objects to delete. These are read lazily, so can be streamed from a large
+                           listing.
+        :type object_ids: iterable of str
+        :param progress_log: Log to record the outcome of each delete in, or None to disable progress logging.
+        :type progress_log: DeletionProgressLog | None
+        :return: Number of objects with each outcome.
+        :rtype: dict of str -> int
+        """
+        outcome_counts = {"deleted": 0, "not_found": 0, "failed": 0}
+
+        def process_batch(batch_ids):
+            outcomes = self.delete_batch(batch_ids)
+            if progress_log is not None:
+                progress_log.record(outcomes)
+            return outcomes
+
+        def collect(futures):
+            for future in futures:
+                for outcome in future.result().values():
+                    outcome_counts[outcome] += 1
+            log.info(f"Deleted {outcome_counts['deleted']} objects so far ({outcome_counts['not_found']} not found, "
+                     f"{outcome_counts['failed']} failed)")
+
+        with ThreadPoolExecutor(max_workers=self._max_concurrent_batches) as executor:
+            in_flight = set()
+            batch_ids = []
+            for object_id in object_ids:
+                if object_id in batch_ids:
+                    # Batch requests can't contain two calls with the same id
+                    continue
+                batch_ids.append(object_id)
+                if len(batch_ids) < MAX_BATCH_SIZE:
+                    continue
+
+                in_flight.add(executor.submit(process_batch, batch_ids))
+                batch_ids = []
+                if len(in_flight) >= self._max_concurrent_batches:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+            if len(batch_ids) > 0:
+                in_flight.add(executor.submit(process_batch, batch_ids))
+            done, _ = wait(in_flight)
+            collect(done)
+
+        return outcome_counts
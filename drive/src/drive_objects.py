@@ -0,0 +1,186 @@
+import heapq
+import json
+import os
+import tempfile
+
+from core_data_modules.logging import Logger
+from google.auth.credentials import AnonymousCredentials
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+
+log = Logger(__name__)
+
+DRIVE_SCOPES = ["https://www.googleapis.com/auth/drive"]
+
+DEFAULT_ROOT_URL = "https://www.googleapis.com/"
+
+# Maximum page size the Drive v3 files.list endpoint accepts
+MAX_PAGE_SIZE = 1000
+
+OBJECT_FIELDS = "id, name, mimeType, parents, quotaBytesUsed, size, createdTime, modifiedTime, trashed"
+
+# Maximum number of objects to sort in memory at once when sorting a listing. Larger listings are sorted in runs on
+# disk which are then merged.
+DEFAULT_MAX_OBJECTS_IN_MEMORY = 100000
+
+
+def init_drive_service(credentials_info, root_url=DEFAULT_ROOT_URL):
+    """
+    Initialises a Google Drive v3 service for a service account.
+
+    This builds a service directly rather than using `storage.google_drive.drive_client_wrapper`, because the
+    wrapper's listing function only returns the complete listing at once, and its single global client can't be
+    shared between threads.
+
+    :param credentials_info: Drive service account credentials, or None to send unauthenticated requests, for example
+                             to a local fake Drive API.
+    :type credentials_info: dict | None
+    :param root_url: Root URL of the Google APIs to send requests to. Requests are sent to `{root_url}drive/v3/`, and
+                     batch requests to `{root_url}batch/drive/v3`.
+    :type root_url: str
+    :rtype: googleapiclient.discovery.Resource
+    """
+    if credentials_info is None:
+        credentials = AnonymousCredentials()
+    else:
+        credentials = service_account.Credentials.from_service_account_info(credentials_info, scopes=DRIVE_SCOPES)
+    client_options = None if root_url == DEFAULT_ROOT_URL else {"api_endpoint": f"{root_url}drive/v3/"}
+    return build("drive", "v3", credentials=credentials, client_options=client_options, cache_discovery=False)
+
+
+def iter_object_pages(drive_service, query="'me' in owners", page_size=MAX_PAGE_SIZE, fields=OBJECT_FIELDS):
+    """
+    Streams the objects in a Drive account, one page at a time.
+
+    :param drive_service: Drive service to list with.
+    :type drive_service: googleapiclient.discovery.Resource
+    :param query: Drive search query selecting the objects to list. Defaults to all the objects the service account
+                  owns, including trashed objects because they still count towards its quota.
+    :type query: str
+    :param page_size: Maximum number of objects to request in each page.
+    :type page_size: int
+    :param fields: Fields to fetch for each object.
+    :type fields: str
+    :return: Generator of pages of objects, each object a dict of the requested fields.
+    :rtype: iterator of list of dict
+    """
+    page_token = None
+    while True:
+        response = drive_service.files().list(
+            q=query, spaces="drive", pageSize=page_size, pageToken=page_token,
+            fields=f"nextPageToken, files({fields})"
+        ).execute()
+
+        yield response.get("files", [])
+
+        page_token = response.get("nextPageToken")
+        if page_token is None:
+            return
+
+
+def quota_bytes_used(drive_object):
+    return int(drive_object.get("quotaBytesUsed", 0))
+
+
+def write_jsonl(objects, f):
+    """
+    :param objects: Objects to write.
+    :type objects: iterable of dict
+    :param f: Text stream to write the objects to, one json object per line.
+    :type f: file-like
+    :return: Number of objects written.
+    :rtype: int
+    """
+    objects_written = 0
+    for drive_object in objects:
+        json.dump(drive_object, f)
+        f.write("\n")
+        objects_written += 1
+    return objects_written
+
+
+def iter_jsonl(f):
+    """
+    :param f: Text stream of objects written by `write_jsonl`, for example a file written by
+              list_all_objects_in_drive.py.
+    :type f: file-like
+    :return: Generator of the objects in the stream.
+    :rtype: iterator of dict
+    """
+    for line in f:
+        if line.strip() != "":
+            yield json.loads(line)
+
+
+def sort_objects(objects, key, max_objects_in_memory=DEFAULT_MAX_OBJECTS_IN_MEMORY):
+    """
+    Sorts objects which may not fit in memory, by sorting them in runs written to temporary files and then merging
+    the runs.
+
+    :param objects: Objects to sort.
+    :type objects: iterable of dict
+    :param key: Function returning the key to sort each object by.
+    :type key: function of dict -> any
+    :param max_objects_in_memory: Maximum number of objects to hold in memory at once.
+    :type max_objects_in_memory: int
+    :return: Generator of the objects in sorted order.
+    :rtype: iterator of dict
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        run_paths = []
+        run = []
+
+        def write_run():
+            run.sort(key=key)
+            run_paths.append(os.path.join(temp_dir, f"run-{len(run_paths)}.jsonl"))
+            with open(run_paths[-1], "w") as f:
+                write_jsonl(run, f)
+            run.clear()
+
+        for drive_object in objects:
+            run.append(drive_object)
+            if len(run) >= max_objects_in_memory:
+                write_run()
+
+        if len(run_paths) == 0:
+            run.sort(key=key)
+            yield from run
+            return
+
+        if len(run) > 0:
+            write_run()
+
+        run_files = [open(path) for path in run_paths]
+        try:
+            yield from heapq.merge(*[iter_jsonl(f) for f in run_files], key=key)
+        finally:
+            for f in run_files:
+                f.close()
+
+
+class TopKLargest:
+    """
+    Tracks the k objects using the most quota, in O(k) memory, using a min-heap.
+
+    :param k: Number of objects to track.
+    :type k: int
+    """
+    def __init__(self, k):
+        self._k = k
+        self._heap = []  # of (quota bytes used, insertion counter, object)
+        self._objects_seen = 0
+
+    def add(self, drive_object):
+        item = (quota_bytes_used(drive_object), self._objects_seen, drive_object)
+        self._objects_seen += 1
+        if len(self._heap) < self._k:
+            heapq.heappush(self._heap, item)
+        elif item[0] > self._heap[0][0]:
+            heapq.heapreplace(self._heap, item)
+
+    def largest(self):
+        """
+        :return: The largest objects seen so far, largest first.
+        :rtype: list of dict
+        """
+        return [drive_object for _, _, drive_object in sorted(self._heap, key=lambda item: item[0], reverse=True)]
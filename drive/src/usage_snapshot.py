@@ -0,0 +1,230 @@
+import json
+import sqlite3
+
+from core_data_modules.logging import Logger
+
+from src.drive_objects import OBJECT_FIELDS, MAX_PAGE_SIZE, iter_object_pages, quota_bytes_used
+
+log = Logger(__name__)
+
+# Age buckets to aggregate quota usage by, as (label, minimum age in days inclusive, maximum age in days exclusive)
+AGE_BUCKETS = [
+    ("< 30 days", 0, 30),
+    ("30-90 days", 30, 90),
+    ("90-365 days", 90, 365),
+    ("1-2 years", 365, 730),
+    ("> 2 years", 730, None)
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    mime_type TEXT,
+    parent_id TEXT,
+    quota_bytes_used INTEGER NOT NULL,
+    created_time TEXT,
+    modified_time TEXT,
+    trashed INTEGER,
+    object TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_parent_id ON objects (parent_id);
+CREATE INDEX IF NOT EXISTS objects_mime_type ON objects (mime_type);
+
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class DriveUsageSnapshot:
+    """
+    Local SQLite snapshot of the objects a service account owns in Drive, which can be kept up to date cheaply using
+    the Drive changes feed, and which aggregates quota usage by parent folder, mime type and age.
+
+    :param connection: Connection to the SQLite database to use.
+    :type connection: sqlite3.Connection
+    """
+    def __init__(self, connection):
+        self._connection = connection
+        self._connection.executescript(_SCHEMA)
+
+    @classmethod
+    def open(cls, file_path):
+        """
+        :param file_path: Path to the SQLite file. This is created if it does not exist.
+        :type file_path: str
+        :rtype: DriveUsageSnapshot
+        """
+        return cls(sqlite3.connect(file_path))
+
+    def close(self):
+        self._connection.close()
+
+    def commit(self):
+        self._connection.commit()
+
+    def get_start_page_token(self):
+        """
+        :return: The Drive changes page token to fetch the changes made since this snapshot was last updated from, or
+                 None if this snapshot has never been populated.
+        :rtype: str | None
+        """
+        row = self._connection.execute("SELECT value FROM metadata WHERE key = 'start_page_token'").fetchone()
+        return None if row is None else row[0]
+
+    def set_start_page_token(self, start_page_token):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO metadata VALUES ('start_page_token', ?)", (start_page_token,)
+        )
+
+    def clear(self):
+        self._connection.execute("DELETE FROM objects")
+        self._connection.execute("DELETE FROM metadata")
+
+    def upsert_object(self, drive_object):
+        """
+        :param drive_object: Object to insert or update, as returned by the Drive API.
+        :type drive_object: dict
+        """
+        parents = drive_object.get("parents", [])
+        self._connection.execute(
+            "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (drive_object["id"], drive_object.get("name"), drive_object.get("mimeType"),
+             parents[0] if len(parents) > 0 else None, quota_bytes_used(drive_object),
+             drive_object.get("createdTime"), drive_object.get("modifiedTime"), drive_object.get("trashed"),
+             json.dumps(drive_object))
+        )
+
+    def delete_object(self, object_id):
+        self._connection.execute("DELETE FROM objects WHERE id = ?", (object_id,))
+
+    def total_usage(self):
+        """
+        :return: (number of objects, total quota bytes used) of all the objects in the snapshot.
+        :rtype: (int, int)
+        """
+        count, total = self._connection.execute("SELECT COUNT(*), SUM(quota_bytes_used) FROM objects").fetchone()
+        return count, total or 0
+
+    def usage_by_parent(self, limit=None):
+        """
+        :param limit: Maximum number of parents to return, or None to return all of them.
+        :type limit: int | None
+        :return: (parent id, parent name, number of objects, quota bytes used) for each parent folder, largest first.
+                 Parent name is None for parents which aren't in the snapshot e.g. folders the service account
+                 doesn't own.
+        :rtype: list of (str | None, str | None, int, int)
+        """
+        return self._connection.execute(
+            "SELECT o.parent_id, p.name, COUNT(*), SUM(o.quota_bytes_used) AS usage "
+            "FROM objects o LEFT JOIN objects p ON p.id = o.parent_id "
+            "GROUP BY o.parent_id ORDER BY usage DESC LIMIT ?",
+            (-1 if limit is None else limit,)
+        ).fetchall()
+
+    def usage_by_mime_type(self, limit=None):
+        """
+        :param limit: Maximum number of mime types to return, or None to return all of them.
+        :type limit: int | None
+        :return: (mime type, number of objects, quota bytes used) for each mime type, largest first.
+        :rtype: list of (str | None, int, int)
+        """
+        return self._connection.execute(
+            "SELECT mime_type, COUNT(*), SUM(quota_bytes_used) AS usage FROM objects "
+            "GROUP BY mime_type ORDER BY usage DESC LIMIT ?",
+            (-1 if limit is None else limit,)
+        ).fetchall()
+
+    def usage_by_age(self):
+        """
+        :return: (age bucket label, number of objects, quota bytes used) for each of the `AGE_BUCKETS`, by the time
+                 since each object was created.
+        :rtype: list of (str, int, int)
+        """
+        usage = []
+        for label, min_age_days, max_age_days in AGE_BUCKETS:
+            query = "SELECT COUNT(*), SUM(quota_bytes_used) FROM objects " \
+                    "WHERE julianday('now') - julianday(created_time) >= ?"
+            params = [min_age_days]
+            if max_age_days is not None:
+                query += " AND julianday('now') - julianday(created_time) < ?"
+                params.append(max_age_days)
+            count, total = self._connection.execute(query, params).fetchone()
+            usage.append((label, count, total or 0))
+        return usage
+
+
+def get_changes_start_page_token(drive_service):
+    """
+    :param drive_service: Drive service to use.
+    :type drive_service: googleapiclient.discovery.Resource
+    :return: Page token for fetching the changes made after now.
+    :rtype: str
+    """
+    return drive_service.changes().getStartPageToken().execute()["startPageToken"]
+
+
+def populate_snapshot(drive_service, snapshot):
+    """
+    Replaces the contents of a snapshot with a full listing of the objects the service account owns.
+
+    :param drive_service: Drive service to list with.
+    :type drive_service: googleapiclient.discovery.Resource
+    :param snapshot: Snapshot to populate. The caller is responsible for committing this.
+    :type snapshot: DriveUsageSnapshot
+    :return: Number of objects listed.
+    :rtype: int
+    """
+    # Get the start token before listing, so that changes made while the listing runs are picked up next time
+    start_page_token = get_changes_start_page_token(drive_service)
+
+    snapshot.clear()
+    objects_listed = 0
+    for page in iter_object_pages(drive_service):
+        for drive_object in page:
+            snapshot.upsert_object(drive_object)
+        objects_listed += len(page)
+        log.info(f"Listed {objects_listed} objects so far")
+
+    snapshot.set_start_page_token(start_page_token)
+    return objects_listed
+
+
+def apply_changes(drive_service, snapshot):
+    """
+    Updates a snapshot with the changes made in Drive since it was last updated.
+
+    :param drive_service: Drive service to fetch the changes with.
+    :type drive_service: googleapiclient.discovery.Resource
+    :param snapshot: Snapshot to update, which must have been populated with `populate_snapshot`. The caller is
+                     responsible for committing this.
+    :type snapshot: DriveUsageSnapshot
+    :return: Number of changes applied.
+    :rtype: int
+    """
+    page_token = snapshot.get_start_page_token()
+    assert page_token is not None, "Cannot apply changes to a snapshot that has never been populated"
+
+    changes_applied = 0
+    while True:
+        response = drive_service.changes().list(
+            pageToken=page_token, spaces="drive", pageSize=MAX_PAGE_SIZE, includeRemoved=True,
+            fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({OBJECT_FIELDS}, ownedByMe))"
+        ).execute()
+
+        for change in response.get("changes", []):
+            drive_object = change.get("file")
+            # The changes feed includes objects shared with the service account, which don't use its quota
+            if change.get("removed", False) or drive_object is None or not drive_object.get("ownedByMe", False):
+                snapshot.delete_object(change["fileId"])
+            else:
+                drive_object.pop("ownedByMe")
+                snapshot.upsert_object(drive_object)
+            changes_applied += 1
+
+        if "newStartPageToken" in response:
+            snapshot.set_start_page_token(response["newStartPageToken"])
+            return changes_applied
+        page_token = response["nextPageToken"]
@@ -14,16 +14,34 @@ from engagement_database.data_models import (HistoryEntryOrigin, Message, Messag
 from google.cloud import firestore
 from storage.google_cloud import google_cloud_utils
 
+from src.bulk_mutation import BulkMessageMutation, iter_message_pages_by_id
+from src.bulk_writes import chunk
+from src.impact_estimation import ImpactReport, DEFAULT_WRITES_PER_SECOND
+from src.sqlite_mirror import EngagementDatabaseMirror
+
 log = Logger(__name__)
 
+BATCH_SIZE = 500
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Archives messages that are the best matches for each of the messages in the referenced dataset. \n"
                     "For example, to archive duplicated messages, provide a dataset of known duplicates identified "
-                    "by an external script that searched for identical messages sent very close to each other in time."
+                    "by detect_duplicate_messages.py, which searches for identical messages sent very close to each "
+                    "other in time."
     )
 
     parser.add_argument("--dry-run", const=True, default=False, action="store_const")
+    parser.add_argument("--estimate-impact", const=True, default=False, action="store_const",
+                        help="Quickly reports the number of documents, history entries and writes archiving would "
+                             "touch, without searching the database for matching messages or updating anything")
+    parser.add_argument("--estimated-writes-per-second", type=float, default=DEFAULT_WRITES_PER_SECOND,
+                        help=f"Write throughput to use when estimating the duration of the archive with "
+                             f"--estimate-impact. Defaults to {DEFAULT_WRITES_PER_SECOND}")
+    parser.add_argument("--sqlite-mirror-path",
+                        help="Path to a SQLite mirror of the database maintained by export_engagement_database.py. "
+                             "If provided, matching messages are searched for in the mirror, and only the matched "
+                             "messages are re-read from Firestore, in transactions, when they are archived")
     parser.add_argument("user", help="Identifier of the user launching this program")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
                         help="Path to a Google Cloud service account credentials file to use to access the "
@@ -40,6 +58,9 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     dry_run = args.dry_run
+    estimate_impact = args.estimate_impact
+    estimated_writes_per_second = args.estimated_writes_per_second
+    sqlite_mirror_path = args.sqlite_mirror_path
     user = args.user
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
     engagement_database_credentials_file_url = args.engagement_database_credentials_file_url
@@ -52,6 +73,20 @@ if __name__ == "__main__":
 
     dry_run_text = ' (dry run)' if dry_run else ''
 
+    log.info(f"Loading messages to be archived from {messages_to_archive_csv_url}...")
+    messages_to_archive_csv = \
+        google_cloud_utils.download_blob_to_string(google_cloud_credentials_file_path, messages_to_archive_csv_url)
+    messages_to_archive = list(csv.DictReader(StringIO(messages_to_archive_csv)))
+    log.info(f"Downloaded {len(messages_to_archive)} messages to archive")
+
+    if estimate_impact:
+        # Each matching message is updated and gets one new history entry
+        ImpactReport(
+            f"Archive messages matching {messages_to_archive_csv_url}", len(messages_to_archive),
+            len(messages_to_archive), 2 * len(messages_to_archive)
+        ).log(estimated_writes_per_second)
+        exit(0)
+
     log.info("Downloading engagement database credentials...")
     engagement_database_credentials = json.loads(google_cloud_utils.download_blob_to_string(
         google_cloud_credentials_file_path,
@@ -59,31 +94,39 @@ if __name__ == "__main__":
     ))
     engagement_db = EngagementDatabase.init_from_credentials(engagement_database_credentials, database_path)
 
+    mirror = None
+    if sqlite_mirror_path is not None:
+        log.info(f"Searching for matching messages in the SQLite mirror at {sqlite_mirror_path}")
+        mirror = EngagementDatabaseMirror.open(sqlite_mirror_path)
+        if mirror.get_seeded_by_full_export_at() is None:
+            log.error(f"The SQLite mirror at {sqlite_mirror_path} was not seeded by a full export, so may be missing "
+                      f"messages. Refusing to search for matching messages in it")
+            exit(1)
+
     if not dry_run:
         engagement_db.set_command_log_entry(CommandLogEntry(status=CommandStatuses.STARTED))
 
-    log.info(f"Loading messages to be archived from {messages_to_archive_csv_url}...")
-    messages_to_archive_csv = \
-        google_cloud_utils.download_blob_to_string(google_cloud_credentials_file_path, messages_to_archive_csv_url)
-    messages_to_archive = list(csv.DictReader(StringIO(messages_to_archive_csv)))
-    log.info(f"Downloaded {len(messages_to_archive)} messages to archive")
+    def get_possible_matching_messages(participant_uuid, text):
+        if mirror is not None:
+            return mirror.get_messages_with_text(participant_uuid, text)
+        return engagement_db.get_messages(
+            firestore_query_filter=lambda q: q
+                .where("text", "==", text)
+                .where("participant_uuid", "==", participant_uuid)
+        )
 
-    log.info(f"Archiving {len(messages_to_archive)} messages{dry_run_text}...")
+    log.info(f"Finding the best matching message for each of the {len(messages_to_archive)} messages to archive...")
     matched_message_ids = set()
+    matched_messages = []
+    message_id_to_duplicate = dict()  # of message_id -> the row in messages_to_archive it was matched to
     for i, msg_to_archive in enumerate(messages_to_archive):
         # Get the possible matching messages from the database
-        possible_matching_messages = engagement_db.get_messages(
-            firestore_query_filter=lambda q: q
-                .where("text", "==", msg_to_archive["text"])
-                .where("participant_uuid", "==", msg_to_archive["avf-participant-uuid"])
+        possible_matching_messages = get_possible_matching_messages(
+            msg_to_archive["avf-participant-uuid"], msg_to_archive["text"]
         )
 
         if len(possible_matching_messages) == 0 and msg_to_archive["text"] == "":
-            possible_matching_messages = engagement_db.get_messages(
-                firestore_query_filter=lambda q: q
-                    .where("text", "==", None)
-                    .where("participant_uuid", "==", msg_to_archive["avf-participant-uuid"])
-            )
+            possible_matching_messages = get_possible_matching_messages(msg_to_archive["avf-participant-uuid"], None)
 
         # Make sure we don't match a message we already saw
         possible_matching_messages = [msg for msg in possible_matching_messages if msg.message_id not in matched_message_ids]
@@ -97,14 +140,33 @@ if __name__ == "__main__":
         log.info(f"Found best matching message with message_id '{nearest_match.message_id}' for message {i + 1}. "
                  f"Timedelta is {nearest_match.timestamp - timestamp_of_duplicate}")
 
-        # Archive the message in the database
         if nearest_match.status == MessageStatuses.ARCHIVED:
             log.warning(f"Message {nearest_match.message_id} already has status {MessageStatuses.ARCHIVED}")
 
-        nearest_match.status = MessageStatuses.ARCHIVED
-        origin = HistoryEntryOrigin("Archive Duplicate Message", {"duplicate": msg_to_archive})
-        engagement_db.set_message(nearest_match, origin)
+        matched_message_ids.add(nearest_match.message_id)
+        matched_messages.append(nearest_match)
+        message_id_to_duplicate[nearest_match.message_id] = msg_to_archive
+
+    def archive_message(message):
+        message.status = MessageStatuses.ARCHIVED
+        return message
+
+    log.info(f"Archiving {len(matched_messages)} messages{dry_run_text}...")
+    if mirror is None:
+        pages = chunk(matched_messages, BATCH_SIZE)
+    else:
+        # Messages from the mirror may be out of date, so re-read each one in the transaction that archives it
+        pages = iter_message_pages_by_id(engagement_db, [msg.message_id for msg in matched_messages], BATCH_SIZE)
+    report = BulkMessageMutation(
+        engagement_db,
+        transform=archive_message,
+        origin=lambda msg: HistoryEntryOrigin(
+            "Archive Duplicate Message", {"duplicate": message_id_to_duplicate[msg.message_id]}
+        ),
+        transactional=mirror is not None
+    ).run(pages=pages, dry_run=dry_run)
+    report.log(dry_run)
 
     if not dry_run:
         engagement_db.set_command_log_entry(CommandLogEntry(status=CommandStatuses.COMPLETED_SUCCESSFULLY))
-    log.info(f"Archived {len(messages_to_archive)} messages{dry_run_text}.")
+    log.info(f"Archived {report.messages_updated} messages{dry_run_text}.")
@@ -2,24 +2,39 @@ import argparse
 import json
 
 from core_data_modules.logging import Logger
-from google.cloud import firestore
 from storage.google_cloud import google_cloud_utils
 from engagement_database import EngagementDatabase
 
+from src.bulk_mutation import BulkMessageMutation, DELETE_MESSAGE, DEFAULT_MAX_CONCURRENT_BATCHES
+from src.bulk_writes import Checkpoint
+from src.impact_estimation import ImpactEstimator, ImpactReport, DEFAULT_WRITES_PER_SECOND
+from src.sqlite_mirror import EngagementDatabaseMirror
+
 log = Logger(__name__)
 
 BATCH_SIZE = 500
 
-
-@firestore.transactional
-def delete_message_and_history(transaction, message_id):
-    engagement_db.delete_message_and_history(message_id, transaction=transaction)
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Deletes messages for given datasets in engagement database")
 
     parser.add_argument("--dry-run", action="store_true",
                         help="Logs the updates that would be made without updating anything.")
+    parser.add_argument("--estimate-impact", action="store_true",
+                        help="Quickly estimates the number of documents, history entries and writes the deletion "
+                             "would touch, without downloading any messages or updating anything")
+    parser.add_argument("--estimated-writes-per-second", type=float, default=DEFAULT_WRITES_PER_SECOND,
+                        help=f"Write throughput to use when estimating the duration of the deletion with "
+                             f"--estimate-impact. Defaults to {DEFAULT_WRITES_PER_SECOND}")
+    parser.add_argument("--checkpoint-file-path",
+                        help="Path to a file to record deletion progress in. If this file exists, deletion resumes "
+                             "from the progress recorded there")
+    parser.add_argument("--max-concurrent-batches", type=int, default=DEFAULT_MAX_CONCURRENT_BATCHES,
+                        help=f"Maximum number of pages of messages to delete concurrently. "
+                             f"Defaults to {DEFAULT_MAX_CONCURRENT_BATCHES}")
+    parser.add_argument("--sqlite-mirror-path",
+                        help="Path to a SQLite mirror of the database maintained by export_engagement_database.py. "
+                             "If provided, the deleted messages and history entries are also deleted from the "
+                             "mirror, which incremental exports can't do")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
                         help="Path to a Google Cloud service account credentials file to use to access the "
                              "credentials bucket")
@@ -33,6 +48,11 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     dry_run = args.dry_run
+    estimate_impact = args.estimate_impact
+    estimated_writes_per_second = args.estimated_writes_per_second
+    checkpoint_file_path = args.checkpoint_file_path
+    max_concurrent_batches = args.max_concurrent_batches
+    sqlite_mirror_path = args.sqlite_mirror_path
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
     engagement_database_credentials_file_url = args.engagement_database_credentials_file_url
     database_path = args.database_path
@@ -47,14 +67,41 @@ if __name__ == "__main__":
         engagement_database_credentials_file_url
     ))
 
+    if estimate_impact:
+        impact_estimator = ImpactEstimator.init_from_credentials(engagement_database_credentials, database_path)
+        for engagement_db_dataset in engagement_db_datasets:
+            log.info(f"Estimating the impact of deleting dataset {engagement_db_dataset}...")
+            messages_count, history_entries_count = impact_estimator.estimate_history_for_messages(
+                lambda q: q.where("dataset", "==", engagement_db_dataset)
+            )
+            ImpactReport(
+                f"Delete dataset '{engagement_db_dataset}'", messages_count, history_entries_count,
+                messages_count + history_entries_count, estimated=True
+            ).log(estimated_writes_per_second)
+        exit(0)
+
     engagement_db = EngagementDatabase.init_from_credentials(engagement_database_credentials, database_path)
 
+    checkpoint = None
+    if checkpoint_file_path is not None:
+        checkpoint = Checkpoint(checkpoint_file_path)
+
+    mirror = None
+    if sqlite_mirror_path is not None:
+        log.info(f"Also deleting from the SQLite mirror at {sqlite_mirror_path}")
+        mirror = EngagementDatabaseMirror.open(sqlite_mirror_path)
+
     for engagement_db_dataset in engagement_db_datasets:
-        messages_filter = lambda q: q.where("dataset", "==", engagement_db_dataset)
-        messages = engagement_db.get_messages(firestore_query_filter=messages_filter, batch_size=BATCH_SIZE)
-        log.info(f"Downloaded {len(messages)} messages from dataset {engagement_db_dataset}")
-
-        for count, msg in enumerate(messages, start=1):
-            log.info(f"Deleting engagement db message {count}/{len(messages)} with id {msg.message_id} and its history entries")
-            if not dry_run:
-                delete_message_and_history(engagement_db.transaction(), msg.message_id)
+        log.info(f"Deleting messages and their history entries from dataset {engagement_db_dataset} {dry_run_text}")
+        report = BulkMessageMutation(
+            engagement_db,
+            transform=lambda msg: DELETE_MESSAGE,
+            firestore_query_filter=lambda q: q.where("dataset", "==", engagement_db_dataset),
+            page_size=BATCH_SIZE,
+            max_concurrent_batches=max_concurrent_batches,
+            mirror=mirror
+        ).run(dry_run=dry_run, checkpoint=checkpoint, task_name=engagement_db_dataset)
+        report.log(dry_run)
+
+    if mirror is not None:
+        mirror.close()
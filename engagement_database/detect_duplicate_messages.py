@@ -0,0 +1,87 @@
+import argparse
+import tempfile
+
+from core_data_modules.logging import Logger
+from storage.google_cloud import google_cloud_utils
+
+from src.duplicate_detection import (iter_exported_messages, partition_messages, find_duplicates_in_partition,
+                                     write_duplicates_csv)
+
+log = Logger(__name__)
+
+DEFAULT_PARTITIONS = 256
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Searches engagement database exports for duplicate messages, that is identical messages from "
+                    "the same participant sent very close to each other in time, and writes them to a csv in the "
+                    "format expected by archive_matching_messages.py. "
+                    "Messages are streamed from the exports and hash-partitioned to disk, so memory use is bounded "
+                    "regardless of the size of the database."
+    )
+
+    parser.add_argument("--window-seconds", type=float, default=60,
+                        help="Maximum time between two identical messages for the later one to be treated as a "
+                             "duplicate. Defaults to 60 seconds")
+    parser.add_argument("--partitions", type=int, default=DEFAULT_PARTITIONS,
+                        help=f"Number of on-disk partitions to split the messages into. Increase this to reduce "
+                             f"peak memory use on very large exports. Defaults to {DEFAULT_PARTITIONS}")
+    parser.add_argument("--csv-output-file-path",
+                        help="csv file to write the duplicates to")
+    parser.add_argument("--gcs-upload-path",
+                        help="GS URL to upload the duplicates csv to")
+    parser.add_argument("--google-cloud-credentials-file-path",
+                        help="Path to a Google Cloud service account credentials file to use to upload to "
+                             "--gcs-upload-path")
+    parser.add_argument("export_file_paths", metavar="export-file-paths", nargs="+",
+                        help="Paths to engagement database exports generated by export_engagement_database.py. "
+                             "When searching a full export followed by its incremental exports, pass them in the "
+                             "order they were exported")
+
+    args = parser.parse_args()
+
+    window_seconds = args.window_seconds
+    partitions = args.partitions
+    csv_output_file_path = args.csv_output_file_path
+    gcs_upload_path = args.gcs_upload_path
+    google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
+    export_file_paths = args.export_file_paths
+
+    if csv_output_file_path is None and gcs_upload_path is None:
+        log.error(f"No output locations specified. Please provide at least one of --csv-output-file-path or "
+                  f"--gcs-upload-path")
+        exit(1)
+
+    if gcs_upload_path is not None and google_cloud_credentials_file_path is None:
+        log.error(f"--gcs-upload-path requires --google-cloud-credentials-file-path")
+        exit(1)
+
+    with tempfile.TemporaryDirectory() as dir_path:
+        log.info(f"Partitioning messages from {len(export_file_paths)} export(s) into {partitions} partitions in "
+                 f"temporary directory '{dir_path}'...")
+        partition_paths, total_messages = partition_messages(
+            iter_exported_messages(export_file_paths), dir_path, partitions
+        )
+        log.info(f"Partitioned {total_messages} messages")
+
+        def iter_duplicates():
+            for i, partition_path in enumerate(partition_paths):
+                duplicates = find_duplicates_in_partition(partition_path, window_seconds)
+                log.debug(f"Found {len(duplicates)} duplicates in partition {i + 1}/{len(partition_paths)}")
+                yield from duplicates
+
+        if csv_output_file_path is None:
+            csv_output_file_path = f"{dir_path}/duplicates.csv"
+
+        log.info(f"Searching for duplicates sent within {window_seconds} seconds of each other, and writing them to "
+                 f"'{csv_output_file_path}'...")
+        with open(csv_output_file_path, "w", newline="") as f:
+            total_duplicates = write_duplicates_csv(iter_duplicates(), f)
+        log.info(f"Found {total_duplicates} duplicate messages")
+
+        if gcs_upload_path is not None:
+            log.info(f"Uploading the duplicates csv to {gcs_upload_path}...")
+            with open(csv_output_file_path, "rb") as f:
+                google_cloud_utils.upload_file_to_blob(google_cloud_credentials_file_path, gcs_upload_path, f)
+
+    log.info(f"Done. Searched {total_messages} messages and found {total_duplicates} duplicates")
@@ -17,6 +17,10 @@ while [[ $# -gt 0 ]]; do
         --gcs-upload-path)
             GCS_UPLOAD_PATH_ARG="--gcs-upload-path $2"
             shift 2;;
+        --sqlite-mirror-file-path)
+            SQLITE_MIRROR_PATH_ARG="--sqlite-mirror-path /data/mirror.sqlite"
+            SQLITE_MIRROR_FILE_PATH="$2"
+            shift 2;;
         --)
             shift
             break;;
@@ -31,6 +35,7 @@ if [[ $# -ne 3 ]]; then
     [--incremental-cache-volume <incremental-cache-volume>]
     [--gzip-export-file-path <gzip-export-file-path>]
     [--gcs-upload-path <gcs-upload-path>]
+    [--sqlite-mirror-file-path <sqlite-mirror-file-path>]
     <google-cloud-credentials-file-path> <engagement-database-credentials-file-url> <database-path>"
     exit
 fi
@@ -45,7 +50,7 @@ docker build -t "$IMAGE_NAME" .
 
 # Create a container from the image that was just built.
 CMD="pipenv run python -u export_engagement_database.py ${INCREMENTAL_ARG} \
-    ${GZIP_EXPORT_FILE_PATH_ARG} ${GCS_UPLOAD_PATH_ARG} \
+    ${GZIP_EXPORT_FILE_PATH_ARG} ${GCS_UPLOAD_PATH_ARG} ${SQLITE_MIRROR_PATH_ARG} \
     /credentials/google-cloud-credentials.json ${ENGAGEMENT_DATABASE_CREDENTIALS_FILE_URL} ${DATABASE_PATH}"
 
 if [[ "$INCREMENTAL_ARG" ]]; then
@@ -61,6 +66,12 @@ container_short_id=${container:0:7}
 echo "Copying $GOOGLE_CLOUD_CREDENTIALS_PATH -> $container_short_id:/credentials/google-cloud-credentials.json"
 docker cp "$GOOGLE_CLOUD_CREDENTIALS_PATH" "$container:/credentials/google-cloud-credentials.json"
 
+# If we're maintaining a SQLite mirror that already exists, copy it into the container so it can be updated
+if [[ "$SQLITE_MIRROR_FILE_PATH" && -f "$SQLITE_MIRROR_FILE_PATH" ]]; then
+    echo "Copying $SQLITE_MIRROR_FILE_PATH -> $container_short_id:/data/mirror.sqlite"
+    docker cp "$SQLITE_MIRROR_FILE_PATH" "$container:/data/mirror.sqlite"
+fi
+
 # Run the container
 echo "Starting container $container_short_id"
 docker start -a -i "$container"
@@ -71,5 +82,11 @@ if [[ "$GZIP_EXPORT_FILE_PATH" ]]; then
     docker cp "$container:/data/output.jsonl.gzip" "$GZIP_EXPORT_FILE_PATH"
 fi
 
+# If we're maintaining a SQLite mirror, copy the updated mirror out of the container
+if [[ "$SQLITE_MIRROR_FILE_PATH" ]]; then
+    echo "Copying $container_short_id:/data/mirror.sqlite -> $SQLITE_MIRROR_FILE_PATH"
+    docker cp "$container:/data/mirror.sqlite" "$SQLITE_MIRROR_FILE_PATH"
+fi
+
 # Tear down the container when it has run successfully
 docker container rm "$container" >/dev/null
@@ -0,0 +1,36 @@
+#!/bin/bash
+
+set -e
+
+IMAGE_NAME=docker-export-engagement-database
+
+while [[ $# -gt 0 ]]; do
+    case "$1" in
+        --generation)
+            GENERATION_ARG="--generation $2"
+            shift 2;;
+        --)
+            shift
+            break;;
+        *)
+            break;;
+    esac
+done
+
+# Check that the correct number of arguments were provided.
+if [[ $# -ne 1 ]]; then
+    echo "Usage: $0
+    [--generation <generation>]
+    <incremental-cache-volume>"
+    exit
+fi
+
+# Assign the program arguments to bash variables.
+INCREMENTAL_CACHE_VOLUME_NAME=$1
+
+# Build an image for this pipeline stage.
+docker build -t "$IMAGE_NAME" .
+
+# Run the rollback in a container with the incremental cache volume mounted.
+CMD="pipenv run python -u rollback_incremental_cache.py ${GENERATION_ARG} /cache"
+docker run --rm -w /app --mount source="$INCREMENTAL_CACHE_VOLUME_NAME",target=/cache "$IMAGE_NAME" /bin/bash -c "$CMD"
@@ -3,6 +3,7 @@ import gzip
 import json
 import shutil
 import tempfile
+from datetime import datetime, timezone
 
 from core_data_modules.logging import Logger
 from engagement_database import EngagementDatabase
@@ -10,6 +11,7 @@ from engagement_database.data_models import Message, HistoryEntry, CommandLogEnt
 from storage.google_cloud import google_cloud_utils
 
 from src.cache import Cache
+from src.sqlite_mirror import EngagementDatabaseMirror
 
 log = Logger(__name__)
 
@@ -23,6 +25,12 @@ if __name__ == "__main__":
                         help="Path to a directory to use to cache the most recently exported items in each collection. "
                              "If this argument is provided and the cache files exist, this will only export documents "
                              "modified since the last export.")
+    parser.add_argument("--sqlite-mirror-path",
+                        help="Path to a local SQLite file to upsert every exported document into, so that tools can "
+                             "answer planning queries from an indexed local copy of the database. Use with "
+                             "--incremental-cache-path to keep the mirror up to date cheaply. A full export (re)seeds "
+                             "the mirror from scratch. Tools will only plan from a mirror that has been seeded by a "
+                             "full export")
     parser.add_argument("--gzip-export-file-path",
                         help="json.gzip file to write the exported data to")
     parser.add_argument("--gcs-upload-path",
@@ -38,6 +46,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     cache_dir = args.incremental_cache_path
+    sqlite_mirror_path = args.sqlite_mirror_path
     gzip_export_file_path = args.gzip_export_file_path
     gcs_upload_path = args.gcs_upload_path
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
@@ -56,6 +65,34 @@ if __name__ == "__main__":
         cache = Cache(cache_dir)
         log.info(f"Initialised cache at {cache_dir}")
 
+    export_start_timestamp = datetime.now(timezone.utc)
+    full_export = cache is None or all(
+        cache.get_doc(entry_name, doc_type) is None for entry_name, doc_type in [
+            ("last_message", Message), ("last_history_entry", HistoryEntry),
+            ("last_command_log_entry", CommandLogEntry)
+        ]
+    )
+
+    mirror = None
+    if sqlite_mirror_path is not None:
+        mirror = EngagementDatabaseMirror.open(sqlite_mirror_path)
+        log.info(f"Opened SQLite mirror at {sqlite_mirror_path}")
+        if full_export:
+            # A full export is a complete snapshot of the database, so re-seed the mirror from scratch, so that it
+            # doesn't keep any documents which have since been deleted
+            log.info("Performing a full export, so clearing the SQLite mirror to re-seed it")
+            mirror.clear()
+        elif mirror.get_seeded_by_full_export_at() is None:
+            log.warning(f"The SQLite mirror at {sqlite_mirror_path} was not seeded by a full export, so it will be "
+                        f"missing documents, and tools will refuse to plan from it. Run a full export to seed it")
+
+    def export_doc(doc, f):
+        serialized_doc = doc.to_dict(serialize_datetimes_to_str=True)
+        json.dump({"type": doc.DOC_TYPE, "data": serialized_doc}, f)
+        f.write("\n")
+        if mirror is not None:
+            mirror.upsert_serialized_doc(doc.DOC_TYPE, serialized_doc)
+
     log.info("Downloading Firestore engagement database credentials...")
     engagement_database_credentials = json.loads(google_cloud_utils.download_blob_to_string(
         google_cloud_credentials_file_path,
@@ -92,8 +129,10 @@ if __name__ == "__main__":
                 log.info(f"Fetched {len(batch_messages)} messages in this batch ({total_messages} total)")
 
                 for msg in batch_messages:
-                    json.dump({"type": msg.DOC_TYPE, "data": msg.to_dict(serialize_datetimes_to_str=True)}, f)
-                    f.write("\n")
+                    export_doc(msg, f)
+
+                if mirror is not None:
+                    mirror.commit()
 
                 # Fetch the next batch
                 last_message = batch_messages[-1]
@@ -122,8 +161,10 @@ if __name__ == "__main__":
                 log.info(f"Fetched {len(batch_history_entries)} history entries in this batch ({total_history_entries} total)")
 
                 for entry in batch_history_entries:
-                    json.dump({"type": entry.DOC_TYPE, "data": entry.to_dict(serialize_datetimes_to_str=True)}, f)
-                    f.write("\n")
+                    export_doc(entry, f)
+
+                if mirror is not None:
+                    mirror.commit()
 
                 # Fetch the next batch
                 last_history_entry = batch_history_entries[-1]
@@ -156,8 +197,10 @@ if __name__ == "__main__":
                          f"({total_command_log_entries} total)")
 
                 for entry in batch_command_log_entries:
-                    json.dump({"type": entry.DOC_TYPE, "data": entry.to_dict(serialize_datetimes_to_str=True)}, f)
-                    f.write("\n")
+                    export_doc(entry, f)
+
+                if mirror is not None:
+                    mirror.commit()
 
                 # Fetch the next batch
                 last_command_log_entry = batch_command_log_entries[-1]
@@ -181,14 +224,24 @@ if __name__ == "__main__":
                 google_cloud_utils.upload_file_to_blob(google_cloud_credentials_file_path, gcs_upload_path, f)
 
         # Now that the backup has run successfully and files exported and uploaded, cache the last exported documents
-        # so we have the option to run in incremental mode next time.
+        # so we have the option to run in incremental mode next time. All the cursors are committed together, so a
+        # crash here leaves the cache at the previous run's cursors rather than a mix of old and new.
         if cache is not None:
             if last_message is not None:
                 cache.set_doc("last_message", last_message)
-            if last_message is not None:
+            if last_history_entry is not None:
                 cache.set_doc("last_history_entry", last_history_entry)
             if last_command_log_entry is not None:
                 cache.set_doc("last_command_log_entry", last_command_log_entry)
+            cache.commit()
+            log.info(f"Committed incremental cache generation {cache.generation}")
+
+        if mirror is not None:
+            if full_export:
+                mirror.set_seeded_by_full_export(export_start_timestamp)
+                log.info(f"Recorded that the SQLite mirror was seeded by a full export at "
+                         f"{export_start_timestamp.isoformat()}")
+            mirror.close()
 
         log.info(f"Done. {total_messages} messages, {total_history_entries} history entries, and "
                  f"{total_command_log_entries} command log entries were exported")
@@ -5,35 +5,48 @@ import subprocess
 from core_data_modules.logging import Logger
 from engagement_database import EngagementDatabase
 from engagement_database.data_models import HistoryEntryOrigin, CommandLogEntry, CommandStatuses
-from google.cloud import firestore
 from storage.google_cloud import google_cloud_utils
 
+from src.bulk_mutation import (BulkMessageMutation, iter_message_pages_by_id, MESSAGES_PER_TRANSACTION,
+                               DEFAULT_PAGE_SIZE)
+from src.query_filters import where_clauses_to_query_filter
+
 log = Logger(__name__)
 
+DEFAULT_MAX_CONCURRENT_PAGES = 4
+
 
-@firestore.transactional
-def reset_message_labels(transaction, engagement_db, message_id, dry_run=False):
-    message = engagement_db.get_message(message_id, transaction)
-    assert message is not None, f"Message '{message_id}' does not exist in database"
+def reset_message_labels(message):
+    # Messages which have never been moved, or which have already been reset, have no original dataset to return to,
+    # so leave them unchanged
+    if len(message.previous_datasets) == 0:
+        log.info(f"Message '{message.message_id}' has no previous datasets, so there is nothing to reset; skipping")
+        return None
 
     # Reset the message's labels and previous_datasets, and return the message to its original dataset
     message.labels = []
     message.dataset = message.previous_datasets[0]
     message.previous_datasets = []
-
-    if not dry_run:
-        engagement_db.set_message(
-            message,
-            HistoryEntryOrigin("Reset message labels", {}),
-            transaction
-        )
+    return message
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Resets all of a message's labels and previous_datasets, and returns "
-                                                 "the message back to its original dataset")
+                                                 "the message back to its original dataset. To reset many messages, "
+                                                 "pass either --message-ids-file-path or --where instead of a "
+                                                 "message-id")
 
     parser.add_argument("--dry-run", const=True, default=False, action="store_const")
+    parser.add_argument("--message-ids-file-path",
+                        help="Path to a file containing the ids of the messages to reset labels for, one per line")
+    parser.add_argument("--where", nargs=3, action="append", metavar=("FIELD", "OPERATOR", "VALUE"),
+                        help="Reset labels for all the messages matching this Firestore where clause e.g. "
+                             "--where dataset == s01e01. Values are parsed as JSON if possible, otherwise as "
+                             "strings. May be repeated to combine several clauses")
+    parser.add_argument("--max-concurrent-pages", type=int, default=DEFAULT_MAX_CONCURRENT_PAGES,
+                        help=f"Maximum number of pages of {DEFAULT_PAGE_SIZE} messages to reset concurrently. Each page "
+                             f"is reset in transactions of {MESSAGES_PER_TRANSACTION} messages. "
+                             f"Defaults to {DEFAULT_MAX_CONCURRENT_PAGES}")
     parser.add_argument("user", help="Identifier of the user launching this program")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
                         help="Path to a Google Cloud service account credentials file to use to access the "
@@ -42,18 +55,26 @@ if __name__ == "__main__":
                         help="GS URL to the Firestore credentials file for the engagement database")
     parser.add_argument("database_path", metavar="database-path",
                         help="Path to the engagement database to update e.g. engagement_databases/test")
-    parser.add_argument("message_id", metavar="message-id",
+    parser.add_argument("message_id", metavar="message-id", nargs="?",
                         help="Id of message to reset labels for")
 
     args = parser.parse_args()
 
     dry_run = args.dry_run
+    message_ids_file_path = args.message_ids_file_path
+    where_clauses = args.where
+    max_concurrent_pages = args.max_concurrent_pages
     user = args.user
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
     engagement_database_credentials_file_url = args.engagement_database_credentials_file_url
     database_path = args.database_path
     message_id = args.message_id
 
+    message_sources = [source for source in [message_id, message_ids_file_path, where_clauses] if source is not None]
+    if len(message_sources) != 1:
+        log.error("Please provide exactly one of message-id, --message-ids-file-path, or --where")
+        exit(1)
+
     dry_run_text = " (dry run)" if dry_run else ""
 
     commit = subprocess.check_output(["git", "rev-parse", "HEAD"]).decode().strip()
@@ -68,14 +89,39 @@ if __name__ == "__main__":
     engagement_db = EngagementDatabase.init_from_credentials(engagement_database_credentials, database_path)
     log.info(f"Initialised the Engagement Database client")
 
+    query_filter = lambda q: q
+    if where_clauses is not None:
+        query_filter = where_clauses_to_query_filter(where_clauses)
+
+    mutation = BulkMessageMutation(
+        engagement_db,
+        transform=reset_message_labels,
+        origin=HistoryEntryOrigin("Reset message labels", {}),
+        firestore_query_filter=query_filter,
+        max_concurrent_batches=max_concurrent_pages,
+        transactional=True
+    )
+
+    if message_id is not None:
+        pages = iter_message_pages_by_id(engagement_db, [message_id])
+    elif message_ids_file_path is not None:
+        log.info(f"Loading the ids of the messages to reset from '{message_ids_file_path}'...")
+        with open(message_ids_file_path) as f:
+            message_ids = [line.strip() for line in f if line.strip() != ""]
+        log.info(f"Loaded {len(message_ids)} message ids")
+        pages = iter_message_pages_by_id(engagement_db, message_ids)
+    else:
+        # Reset all the messages matching the mutation's query filter
+        pages = None
+
     if not dry_run:
         engagement_db.set_command_log_entry(CommandLogEntry(status=CommandStatuses.STARTED))
 
-    log.info(f"Resetting labels for message '{message_id}'{dry_run_text}...")
-    transaction = engagement_db.transaction()
-    reset_message_labels(transaction, engagement_db, message_id, dry_run)
+    log.info(f"Resetting labels{dry_run_text}...")
+    report = mutation.run(pages, dry_run)
 
     if not dry_run:
         engagement_db.set_command_log_entry(CommandLogEntry(status=CommandStatuses.COMPLETED_SUCCESSFULLY))
 
-    log.info(f"Done. Reset labels for message '{message_id}'{dry_run_text}")
+    report.log(dry_run)
+    log.info(f"Done. Reset labels for {report.messages_updated} messages{dry_run_text}")
@@ -10,6 +10,9 @@ from engagement_database.data_models import HistoryEntryOrigin, Message
 from google.cloud import firestore
 from storage.google_cloud import google_cloud_utils
 
+from src.impact_estimation import ImpactEstimator, ImpactReport, DEFAULT_WRITES_PER_SECOND
+from src.sqlite_mirror import EngagementDatabaseMirror
+
 log = Logger(__name__)
 
 BATCH_SIZE = 500
@@ -24,6 +27,18 @@ if __name__ == "__main__":
     )
 
     parser.add_argument("--dry-run", const=True, default=False, action="store_const")
+    parser.add_argument("--estimate-impact", const=True, default=False, action="store_const",
+                        help="Quickly estimates the documents, history entries and writes the rollback would "
+                             "touch from a sample of the history, without downloading all the history entries or "
+                             "updating anything")
+    parser.add_argument("--estimated-writes-per-second", type=float, default=DEFAULT_WRITES_PER_SECOND,
+                        help=f"Write throughput to use when estimating the duration of the rollback with "
+                             f"--estimate-impact. Defaults to {DEFAULT_WRITES_PER_SECOND}")
+    parser.add_argument("--sqlite-mirror-path",
+                        help="Path to a SQLite mirror of the database maintained by export_engagement_database.py. "
+                             "If provided, the history entries to roll back are looked up in the mirror rather than "
+                             "Firestore. The mirror must have been seeded by a full export and updated after the last "
+                             "write to the database. The docs the rollback deletes are also deleted from the mirror")
     parser.add_argument("user", help="Identifier of the user launching this program")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
                         help="Path to a Google Cloud service account credentials file to use to access the "
@@ -38,6 +53,9 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     dry_run = args.dry_run
+    estimate_impact = args.estimate_impact
+    estimated_writes_per_second = args.estimated_writes_per_second
+    sqlite_mirror_path = args.sqlite_mirror_path
     user = args.user
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
     engagement_database_credentials_file_url = args.engagement_database_credentials_file_url
@@ -53,11 +71,37 @@ if __name__ == "__main__":
         google_cloud_credentials_file_path,
         engagement_database_credentials_file_url
     ))
+
+    if estimate_impact:
+        log.info(f"Estimating the impact of rolling back to {rollback_timestamp_inclusive}...")
+        impact_estimator = ImpactEstimator.init_from_credentials(engagement_database_credentials, database_path)
+        history_entries_count, docs_count = impact_estimator.estimate_distinct_history_update_paths(
+            rollback_timestamp_inclusive)
+        # Each doc is either reverted or deleted, and each newer history entry is deleted, so both cost one write each
+        ImpactReport(
+            f"Rollback to {rollback_timestamp_inclusive}", docs_count, history_entries_count,
+            docs_count + history_entries_count, estimated=True
+        ).log(estimated_writes_per_second)
+        exit(0)
+
     engagement_db = EngagementDatabase.init_from_credentials(engagement_database_credentials, database_path)
 
+    mirror = None
+    if sqlite_mirror_path is not None:
+        log.warning(f"Planning the rollback using the SQLite mirror at {sqlite_mirror_path}. Any changes made to the "
+                    f"database since this mirror was last updated will not be rolled back")
+        mirror = EngagementDatabaseMirror.open(sqlite_mirror_path)
+        if mirror.get_seeded_by_full_export_at() is None:
+            log.error(f"The SQLite mirror at {sqlite_mirror_path} was not seeded by a full export, so may be missing "
+                      f"history entries. Refusing to plan the rollback from it")
+            exit(1)
+
     log.info(f"Fetching history entries modified on or since {rollback_timestamp_inclusive} that need rollback...")
-    history_entries_to_rollback = engagement_db.get_history(
-        firestore_query_filter=lambda q: q.where("timestamp", ">=", rollback_timestamp_inclusive))
+    if mirror is None:
+        history_entries_to_rollback = engagement_db.get_history(
+            firestore_query_filter=lambda q: q.where("timestamp", ">=", rollback_timestamp_inclusive))
+    else:
+        history_entries_to_rollback = mirror.get_history_since(rollback_timestamp_inclusive)
     log.info(f"Fetched {len(history_entries_to_rollback)} history entries to rollback")
 
     db_update_path_to_history_entries = defaultdict(list)
@@ -74,13 +118,17 @@ if __name__ == "__main__":
     deleted_history_entries = 0
     for i, db_update_path in enumerate(db_update_paths):
         # Get the last history entry made before `rollback_timestamp`, if it exists
-        last_valid_history_entries = engagement_db.get_history(
-            firestore_query_filter=lambda q: q
-                .where("db_update_path", "==", db_update_path)
-                .where("timestamp", "<", rollback_timestamp_inclusive)
-                .order_by("timestamp", firestore.Query.DESCENDING)
-                .limit(1)
-        )
+        if mirror is None:
+            last_valid_history_entries = engagement_db.get_history(
+                firestore_query_filter=lambda q: q
+                    .where("db_update_path", "==", db_update_path)
+                    .where("timestamp", "<", rollback_timestamp_inclusive)
+                    .order_by("timestamp", firestore.Query.DESCENDING)
+                    .limit(1)
+            )
+        else:
+            last_valid_history_entry = mirror.get_latest_history_entry_before(db_update_path, rollback_timestamp_inclusive)
+            last_valid_history_entries = [] if last_valid_history_entry is None else [last_valid_history_entry]
 
         batch = engagement_db.batch()
         if len(last_valid_history_entries) < 1:
@@ -107,6 +155,18 @@ if __name__ == "__main__":
             deleted_history_entries += 1
         batch.commit()
 
+        # Incremental exports never see deletions, so remove the deleted docs from the mirror too, so that later plans
+        # made from the mirror don't act on them
+        if mirror is not None and not dry_run:
+            deleted_paths = [f"history/{entry.history_entry_id}"
+                             for entry in db_update_path_to_history_entries[db_update_path]]
+            if len(last_valid_history_entries) < 1:
+                deleted_paths.append(db_update_path)
+            mirror.delete_docs(deleted_paths)
+
+    if mirror is not None:
+        mirror.close()
+
     log.info(f"Done. Summary of actions{dry_run_text}:")
     log.info(f"Deleted {deleted_docs} docs (excluding history entries)")
     log.info(f"Reverted {reverted_docs} docs (excluding history entries)")
@@ -0,0 +1,36 @@
+import argparse
+
+from core_data_modules.logging import Logger
+
+from src.cache import Cache
+
+log = Logger(__name__)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rolls an export_engagement_database.py incremental cache back to an "
+                                                 "earlier generation of cursors, so that the next incremental export "
+                                                 "re-exports everything exported since that generation was committed. "
+                                                 "The generations newer than the one rolled back to are deleted")
+
+    parser.add_argument("--generation", type=int,
+                        help="Generation to roll back to. Defaults to the generation before the current one")
+    parser.add_argument("--list", const=True, default=False, action="store_const",
+                        help="Lists the generations available to roll back to, without rolling back")
+    parser.add_argument("incremental_cache_path", metavar="incremental-cache-path",
+                        help="Path to the incremental cache directory to roll back")
+
+    args = parser.parse_args()
+
+    generation = args.generation
+    list_generations = args.list
+    incremental_cache_path = args.incremental_cache_path
+
+    cache = Cache(incremental_cache_path)
+    older_generations = [g for g in cache.list_generations() if cache.generation is None or g < cache.generation]
+    log.info(f"Current generation: {cache.generation}. Generations available to roll back to: {older_generations}")
+
+    if list_generations:
+        exit(0)
+
+    cache.rollback(generation)
+    log.info(f"Rolled back to generation {cache.generation}. Newer generations have been deleted")
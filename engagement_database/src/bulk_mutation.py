@@ -0,0 +1,301 @@
+import time
+
+from core_data_modules.logging import Logger
+from google.cloud import firestore
+
+from src.bulk_writes import (iter_message_pages, chunk, pack_write_groups, commit_batch_with_retry,
+                             ConcurrentPageProcessor, MAX_WRITES_PER_BATCH)
+
+log = Logger(__name__)
+
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_MAX_CONCURRENT_BATCHES = 8
+
+# Number of messages to re-read and mutate in each transaction in transactional mode. Each message update makes
+# 2 writes, so this stays well within Firestore's limit of 500 writes per transaction while keeping transactions short.
+MESSAGES_PER_TRANSACTION = 100
+
+# Firestore 'in' queries accept at most 10 values in older client/server versions
+MAX_IN_QUERY_VALUES = 10
+
+
+class _DeleteMessage:
+    def __repr__(self):
+        return "DELETE_MESSAGE"
+
+
+# Returned by a transform to request that the message and all of its history entries are deleted.
+DELETE_MESSAGE = _DeleteMessage()
+
+
+def iter_message_pages_by_id(engagement_db, message_ids, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Streams the messages with the given ids from an engagement database, one page at a time.
+
+    Ids which don't exist in the database are logged and skipped.
+
+    :param engagement_db: Engagement database to read from.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param message_ids: Ids of the messages to fetch.
+    :type message_ids: iterable of str
+    :param page_size: Maximum number of messages in each page.
+    :type page_size: int
+    :return: Generator of non-empty pages of messages.
+    :rtype: iterator of list of engagement_database.data_models.Message
+    """
+    for page_message_ids in chunk(message_ids, page_size):
+        page = []
+        for query_message_ids in chunk(page_message_ids, MAX_IN_QUERY_VALUES):
+            page.extend(engagement_db.get_messages(
+                firestore_query_filter=lambda q: q.where("message_id", "in", query_message_ids)
+            ))
+
+        missing_message_ids = set(page_message_ids) - {msg.message_id for msg in page}
+        for message_id in sorted(missing_message_ids):
+            log.warning(f"Message '{message_id}' does not exist in database; skipping")
+
+        if len(page) > 0:
+            yield page
+
+
+class ThroughputReport:
+    """
+    Counts of the work done by a `BulkMessageMutation`, and the throughput it achieved.
+    """
+    def __init__(self, pages=0, messages_read=0, messages_updated=0, messages_deleted=0, history_entries_deleted=0,
+                 writes=0, duration_seconds=0):
+        self.pages = pages
+        self.messages_read = messages_read
+        self.messages_updated = messages_updated
+        self.messages_deleted = messages_deleted
+        self.history_entries_deleted = history_entries_deleted
+        self.writes = writes
+        self.duration_seconds = duration_seconds
+
+    @classmethod
+    def combine(cls, reports, duration_seconds):
+        """
+        :param reports: Reports to sum, for example one report for each page processed.
+        :type reports: iterable of ThroughputReport
+        :param duration_seconds: Wall-clock time taken to produce all the reports.
+        :type duration_seconds: float
+        :rtype: ThroughputReport
+        """
+        combined = cls(duration_seconds=duration_seconds)
+        for report in reports:
+            combined.pages += report.pages
+            combined.messages_read += report.messages_read
+            combined.messages_updated += report.messages_updated
+            combined.messages_deleted += report.messages_deleted
+            combined.history_entries_deleted += report.history_entries_deleted
+            combined.writes += report.writes
+        return combined
+
+    def log(self, dry_run=False):
+        dry_run_text = " (dry run)" if dry_run else ""
+        duration_seconds = max(self.duration_seconds, 0.001)
+        log.info(f"Bulk mutation summary{dry_run_text}:")
+        log.info(f"  Read {self.messages_read} messages in {self.pages} pages")
+        log.info(f"  Updated {self.messages_updated} messages")
+        log.info(f"  Deleted {self.messages_deleted} messages and {self.history_entries_deleted} history entries")
+        log.info(f"  Made {self.writes} writes")
+        log.info(f"  Took {duration_seconds:.1f} seconds: {self.messages_read / duration_seconds:.1f} messages read/s, "
+                 f"{self.writes / duration_seconds:.1f} writes/s")
+
+
+class BulkMessageMutation:
+    """
+    Applies a transform to many messages in an engagement database, with streaming pagination, batched writes,
+    bounded concurrency, checkpoint/resume and dry-run planning.
+
+    The transform is called once per message and decides what should happen to it. It must not write to the database
+    itself; the engine makes all the writes. It may modify and return the message it is given.
+
+    :param engagement_db: Engagement database to mutate.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param transform: Function which is given a message, and returns the updated message to write, None to leave the
+                      message unchanged, or `DELETE_MESSAGE` to delete the message and all of its history entries.
+    :type transform: function of engagement_database.data_models.Message ->
+                     (engagement_database.data_models.Message | None | DELETE_MESSAGE)
+    :param origin: Origin to record in the history entry of each updated message, or a function which returns the
+                   origin for a given updated message. Only required if the transform can return updated messages.
+    :type origin: engagement_database.data_models.HistoryEntryOrigin |
+                  function of engagement_database.data_models.Message ->
+                  engagement_database.data_models.HistoryEntryOrigin | None
+    :param firestore_query_filter: Filter selecting the messages to transform, when running over a query.
+    :type firestore_query_filter: function of google.cloud.firestore.Query -> google.cloud.firestore.Query
+    :param page_size: Number of messages to fetch in each page.
+    :type page_size: int
+    :param max_concurrent_batches: Maximum number of pages to transform and write concurrently.
+    :type max_concurrent_batches: int
+    :param transactional: If False, each page's messages are transformed as read and written in batched writes.
+                          If True, each message is re-read, transformed and written in a transaction, in groups of
+                          `MESSAGES_PER_TRANSACTION`, so updates can't overwrite concurrent changes.
+    :type transactional: bool
+    :param prepare_page: Optional function called with each page before any of its messages are transformed, for
+                         example to fetch data the transform needs in bulk.
+    :type prepare_page: (function of list of engagement_database.data_models.Message -> None) | None
+    :param mirror: SQLite mirror of the database to also delete the deleted messages and history entries from, once
+                   they have been deleted from the database, or None.
+    :type mirror: src.sqlite_mirror.EngagementDatabaseMirror | None
+    """
+    def __init__(self, engagement_db, transform, origin=None, firestore_query_filter=lambda q: q,
+                 page_size=DEFAULT_PAGE_SIZE, max_concurrent_batches=DEFAULT_MAX_CONCURRENT_BATCHES,
+                 transactional=False, prepare_page=None, mirror=None):
+        self._engagement_db = engagement_db
+        self._transform = transform
+        self._origin = origin
+        self._firestore_query_filter = firestore_query_filter
+        self._page_size = page_size
+        self._max_concurrent_batches = max_concurrent_batches
+        self._transactional = transactional
+        self._prepare_page = prepare_page
+        self._mirror = mirror
+
+    def run(self, pages=None, dry_run=False, checkpoint=None, task_name="messages"):
+        """
+        Runs the mutation.
+
+        :param pages: Pages of messages to transform. If None, transforms all the messages matching this mutation's
+                      query filter, streamed in pages ordered by message_id.
+        :type pages: iterable of list of engagement_database.data_models.Message | None
+        :param dry_run: If True, plans and logs the mutation without writing anything.
+        :type dry_run: bool
+        :param checkpoint: Checkpoint to resume from and record progress in. Only used when running over this
+                           mutation's query (i.e. when `pages` is None), and never advanced in dry-run mode.
+        :type checkpoint: src.bulk_writes.Checkpoint | None
+        :param task_name: Name to record this mutation's progress under in the checkpoint.
+        :type task_name: str
+        :return: Summary of the work done and the throughput achieved.
+        :rtype: ThroughputReport
+        """
+        start_time = time.perf_counter()
+
+        if pages is None:
+            start_after_message_id = None if checkpoint is None else checkpoint.get(task_name)
+            if start_after_message_id is not None:
+                log.info(f"Resuming '{task_name}' after message '{start_after_message_id}'")
+            pages = iter_message_pages(
+                self._engagement_db, self._firestore_query_filter, self._page_size, start_after_message_id
+            )
+        else:
+            checkpoint = None
+
+        if dry_run:
+            checkpoint = None
+
+        page_reports = ConcurrentPageProcessor(self._max_concurrent_batches, checkpoint, task_name).run(
+            pages, lambda page: self._process_page(page, dry_run), lambda page: page[-1].message_id
+        )
+
+        return ThroughputReport.combine(page_reports, time.perf_counter() - start_time)
+
+    def _origin_for(self, message):
+        if callable(self._origin):
+            return self._origin(message)
+        return self._origin
+
+    def _plan(self, messages):
+        updates = []
+        deletes = []
+        for msg in messages:
+            result = self._transform(msg)
+            if result is None:
+                continue
+            if result is DELETE_MESSAGE:
+                deletes.append(msg)
+            else:
+                updates.append(result)
+        return updates, deletes
+
+    def _apply_write(self, batch, write):
+        write_type, value = write
+        if write_type == "set":
+            self._engagement_db.set_message(value, self._origin_for(value), batch)
+        else:
+            self._engagement_db.delete_doc(value, transaction=batch)
+
+    def _process_page(self, page, dry_run):
+        if self._prepare_page is not None:
+            self._prepare_page(page)
+
+        if self._transactional and not dry_run:
+            page_reports = [self._mutate_in_transaction(message_ids)
+                            for message_ids in chunk([msg.message_id for msg in page], MESSAGES_PER_TRANSACTION)]
+            page_report = ThroughputReport.combine(page_reports, 0)
+            page_report.pages = 1
+            page_report.messages_read = len(page)
+        else:
+            page_report = self._mutate_in_batches(page, dry_run)
+
+        log.info(f"Processed a page of {len(page)} messages{' (dry run)' if dry_run else ''}: updated "
+                 f"{page_report.messages_updated}, deleted {page_report.messages_deleted}")
+        return page_report
+
+    def _mutate_in_batches(self, page, dry_run):
+        updates, deletes = self._plan(page)
+        report = ThroughputReport(pages=1, messages_read=len(page), messages_updated=len(updates),
+                                  messages_deleted=len(deletes))
+        if dry_run:
+            return report
+
+        # Each message is deleted in the same batch as its history entries, so a message is never left without its
+        # history or vice versa.
+        delete_groups = []
+        for msg in deletes:
+            history_entries = self._engagement_db.get_history_for_message(msg.message_id)
+            report.history_entries_deleted += len(history_entries)
+            delete_groups.append(
+                [("delete", f"messages/{msg.message_id}")] +
+                [("delete", f"history/{entry.history_entry_id}") for entry in history_entries]
+            )
+        for batch_writes in pack_write_groups(delete_groups):
+            commit_batch_with_retry(self._engagement_db, batch_writes, self._apply_write)
+            report.writes += len(batch_writes)
+            if self._mirror is not None:
+                self._mirror.delete_docs([path for _, path in batch_writes])
+
+        # Each message update writes both the message and a new history entry
+        for batch_writes in pack_write_groups([[("set", msg)] for msg in updates], writes_per_item=2):
+            commit_batch_with_retry(self._engagement_db, batch_writes, self._apply_write)
+            report.writes += 2 * len(batch_writes)
+
+        return report
+
+    def _mutate_in_transaction(self, message_ids):
+        @firestore.transactional
+        def mutate(transaction):
+            # Firestore transactions require all reads to happen before any writes
+            messages = []
+            for message_id in message_ids:
+                msg = self._engagement_db.get_message(message_id, transaction)
+                if msg is None:
+                    log.warning(f"Message '{message_id}' no longer exists in database; skipping")
+                    continue
+                messages.append(msg)
+
+            updates, deletes = self._plan(messages)
+            delete_paths = []
+            for msg in deletes:
+                delete_paths.append(f"messages/{msg.message_id}")
+                for entry in self._engagement_db.get_history_for_message(msg.message_id, transaction):
+                    delete_paths.append(f"history/{entry.history_entry_id}")
+
+            assert 2 * len(updates) + len(delete_paths) <= MAX_WRITES_PER_BATCH, \
+                f"Too many writes to commit in one transaction ({2 * len(updates) + len(delete_paths)})"
+
+            for msg in updates:
+                self._apply_write(transaction, ("set", msg))
+            for path in delete_paths:
+                self._apply_write(transaction, ("delete", path))
+
+            report = ThroughputReport(
+                messages_updated=len(updates), messages_deleted=len(deletes),
+                history_entries_deleted=len(delete_paths) - len(deletes), writes=2 * len(updates) + len(delete_paths)
+            )
+            return report, delete_paths
+
+        report, delete_paths = mutate(self._engagement_db.transaction())
+        if self._mirror is not None and len(delete_paths) > 0:
+            self._mirror.delete_docs(delete_paths)
+        return report
@@ -0,0 +1,280 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from core_data_modules.logging import Logger
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore
+
+log = Logger(__name__)
+
+# Firestore rejects batched writes and transactions containing more than 500 writes.
+MAX_WRITES_PER_BATCH = 500
+
+RETRYABLE_EXCEPTIONS = (
+    google_exceptions.Aborted,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.TooManyRequests
+)
+
+
+def iter_message_pages(engagement_db, firestore_query_filter=lambda q: q, page_size=500,
+                       start_after_message_id=None):
+    """
+    Streams the messages matching a query from an engagement database, one page at a time.
+
+    Pages are ordered by document id, which is the message_id and never changes when a message is updated, so it is
+    safe to modify or delete the messages in each page before requesting the next one. Ordering by document id rather
+    than by the message_id field means that queries with an equality filter (e.g. on dataset) only need Firestore's
+    automatic single-field indexes, rather than a composite index.
+
+    :param engagement_db: Engagement database to read from.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param firestore_query_filter: Filter to apply to the messages query.
+    :type firestore_query_filter: function of google.cloud.firestore.Query -> google.cloud.firestore.Query
+    :param page_size: Maximum number of messages to fetch per page.
+    :type page_size: int
+    :param start_after_message_id: If set, only returns messages with message_ids after this one, for example to
+                                   resume from a `Checkpoint`.
+    :type start_after_message_id: str | None
+    :return: Generator of non-empty pages of messages.
+    :rtype: iterator of list of engagement_database.data_models.Message
+    """
+    page_filter = lambda q: firestore_query_filter(q).order_by(firestore.FieldPath.document_id()).limit(page_size)
+
+    last_message_id = start_after_message_id
+    while True:
+        if last_message_id is None:
+            page = engagement_db.get_messages(firestore_query_filter=page_filter)
+        else:
+            page = engagement_db.get_messages(
+                firestore_query_filter=lambda q: page_filter(q).start_after(
+                    {firestore.FieldPath.document_id(): last_message_id}
+                )
+            )
+
+        if len(page) == 0:
+            return
+        yield page
+
+        last_message_id = page[-1].message_id
+
+
+def chunk(items, chunk_size):
+    """
+    Splits items into lists of at most `chunk_size` items, without loading all the items into memory.
+
+    :param items: Items to split.
+    :type items: iterable
+    :param chunk_size: Maximum number of items in each chunk.
+    :type chunk_size: int
+    :return: Generator of non-empty chunks.
+    :rtype: iterator of list
+    """
+    group = []
+    for item in items:
+        group.append(item)
+        if len(group) >= chunk_size:
+            yield group
+            group = []
+    if len(group) > 0:
+        yield group
+
+
+def pack_write_groups(write_groups, max_writes_per_batch=MAX_WRITES_PER_BATCH, writes_per_item=1):
+    """
+    Packs groups of writes into as few batches as possible, without splitting any group across batches.
+
+    A group that is bigger than a whole batch on its own is split, because Firestore could not commit it atomically
+    anyway.
+
+    :param write_groups: Groups of writes. Each item is an opaque object, which will be passed to the function that
+                         applies it to a batch.
+    :type write_groups: iterable of list
+    :param max_writes_per_batch: Maximum number of writes to put in each batch.
+    :type max_writes_per_batch: int
+    :param writes_per_item: Number of Firestore writes each item makes when applied to a batch e.g. 2 for items which
+                            are applied with `EngagementDatabase.set_message`, which also writes a history entry.
+    :type writes_per_item: int
+    :return: Generator of batches of items.
+    :rtype: iterator of list
+    """
+    max_items_per_batch = max_writes_per_batch // writes_per_item
+    batch = []
+    for group in write_groups:
+        if len(group) > max_items_per_batch:
+            log.warning(f"Found a write group with {len(group) * writes_per_item} writes, which is more than can be "
+                        f"committed in a single batch. This group will be split across multiple batches")
+            if len(batch) > 0:
+                yield batch
+                batch = []
+            for i in range(0, len(group), max_items_per_batch):
+                yield group[i:i + max_items_per_batch]
+            continue
+
+        if len(batch) + len(group) > max_items_per_batch:
+            yield batch
+            batch = []
+        batch.extend(group)
+
+    if len(batch) > 0:
+        yield batch
+
+
+def commit_batch_with_retry(engagement_db, writes, apply_write, max_attempts=5, initial_backoff_seconds=1):
+    """
+    Commits writes to an engagement database in a single batched write, retrying with exponential backoff if the
+    commit fails with an error that is likely to be transient.
+
+    :param engagement_db: Engagement database to commit to.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param writes: Writes to commit.
+    :type writes: list
+    :param apply_write: Function which adds a write to a batch. A new batch is built for each attempt.
+    :type apply_write: function of (google.cloud.firestore.WriteBatch, any) -> None
+    :param max_attempts: Maximum number of times to attempt the commit before re-raising the last error.
+    :type max_attempts: int
+    :param initial_backoff_seconds: Time to wait before the first retry. This doubles after each failed attempt.
+    :type initial_backoff_seconds: float
+    """
+    backoff_seconds = initial_backoff_seconds
+    for attempt in range(1, max_attempts + 1):
+        batch = engagement_db.batch()
+        for write in writes:
+            apply_write(batch, write)
+
+        try:
+            batch.commit()
+            return
+        except RETRYABLE_EXCEPTIONS as e:
+            if attempt == max_attempts:
+                raise
+            log.warning(f"Failed to commit a batch of {len(writes)} writes (attempt {attempt}/{max_attempts}): {e}. "
+                        f"Retrying in {backoff_seconds} seconds...")
+            time.sleep(backoff_seconds)
+            backoff_seconds *= 2
+
+
+class Checkpoint:
+    """
+    Records how far through a paginated job each of its tasks has got, so that an interrupted job can resume where it
+    left off.
+
+    The checkpoint is written with a temp file and rename, so a crash while saving never corrupts it.
+
+    :param file_path: Path to the checkpoint file. This is created if it does not exist.
+    :type file_path: str
+    """
+    def __init__(self, file_path):
+        self._file_path = file_path
+        self._lock = threading.Lock()
+        try:
+            with open(file_path) as f:
+                self._positions = json.load(f)
+        except FileNotFoundError:
+            self._positions = dict()
+
+    def get(self, task_name):
+        """
+        :param task_name: Name of the task to get the position of e.g. the dataset being processed.
+        :type task_name: str
+        :return: The last position recorded for this task, or None if this task has not recorded any progress.
+        :rtype: str | None
+        """
+        with self._lock:
+            return self._positions.get(task_name)
+
+    def set(self, task_name, position):
+        """
+        Records the position of a task, and saves the checkpoint to disk.
+
+        :param task_name: Name of the task to set the position of.
+        :type task_name: str
+        :param position: Position to record, for example the last message_id processed.
+        :type position: str
+        """
+        with self._lock:
+            self._positions[task_name] = position
+            temp_path = f"{self._file_path}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(self._positions, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self._file_path)
+
+
+class ConcurrentPageProcessor:
+    """
+    Processes pages of a paginated job on a bounded pool of worker threads, advancing a `Checkpoint` only when a page
+    and all the pages before it have completed.
+
+    :param max_workers: Maximum number of pages to process concurrently.
+    :type max_workers: int
+    :param checkpoint: Checkpoint to record progress in, or None to disable checkpointing.
+    :type checkpoint: Checkpoint | None
+    :param task_name: Name to record this job's progress under in the checkpoint.
+    :type task_name: str | None
+    """
+    def __init__(self, max_workers, checkpoint=None, task_name=None):
+        self._max_workers = max_workers
+        self._checkpoint = checkpoint
+        self._task_name = task_name
+
+    def run(self, pages, process_page, page_position):
+        """
+        Processes every page. Fetching is interleaved with processing, and at most `max_workers` pages are held in
+        memory at once.
+
+        If processing any page fails, no more pages are started and the error is re-raised once the in-flight pages
+        have finished.
+
+        :param pages: Pages to process.
+        :type pages: iterable
+        :param process_page: Function which processes a single page.
+        :type process_page: function of any -> any
+        :param page_position: Function which returns the checkpoint position to record once a page has completed.
+        :type page_position: function of any -> str
+        :return: The results of `process_page` for each page, in page order.
+        :rtype: list
+        """
+        results = dict()  # of page number -> result of process_page
+        positions = dict()  # of page number -> checkpoint position, for pages which have been submitted
+        next_page_to_checkpoint = 0
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            in_flight = dict()  # of future -> page number
+            try:
+                for page_number, page in enumerate(pages):
+                    positions[page_number] = page_position(page)
+                    in_flight[executor.submit(process_page, page)] = page_number
+
+                    if len(in_flight) >= self._max_workers:
+                        done, _ = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+                        for future in done:
+                            results[in_flight.pop(future)] = future.result()
+                        next_page_to_checkpoint = self._advance_checkpoint(results, positions, next_page_to_checkpoint)
+
+                for future in list(in_flight.keys()):
+                    results[in_flight.pop(future)] = future.result()
+                self._advance_checkpoint(results, positions, next_page_to_checkpoint)
+            finally:
+                for future in in_flight.keys():
+                    future.cancel()
+
+        return [results[page_number] for page_number in sorted(results.keys())]
+
+    def _advance_checkpoint(self, results, positions, next_page_to_checkpoint):
+        last_completed_position = None
+        while next_page_to_checkpoint in results:
+            last_completed_position = positions.pop(next_page_to_checkpoint)
+            next_page_to_checkpoint += 1
+
+        if self._checkpoint is not None and last_completed_position is not None:
+            self._checkpoint.set(self._task_name, last_completed_position)
+
+        return next_page_to_checkpoint
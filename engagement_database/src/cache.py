@@ -1,21 +1,144 @@
 import json
+import os
+import re
 
 from core_data_modules.util import IOUtils
 
 
 class Cache:
-    def __init__(self, cache_dir):
+    """
+    Transactional store for the cursors used by incremental exports.
+
+    Entries are held in memory while a program runs. Calling `commit` writes all of them to disk together as a new,
+    numbered generation, using a temp file and rename so that a crash can never leave a partially written cursor set.
+    The last `generations_to_keep` generations are kept on disk, so the cache can be rolled back to an earlier
+    cursor set if a later export turns out to be bad. Rolling back deletes the generations newer than the one rolled
+    back to, so that the bad cursor sets can never be made current again.
+
+    Caches written by older versions of this class, which stored one json file per entry, are read transparently and
+    are upgraded to the generational format on the next commit.
+
+    :param cache_dir: Directory to store the cache in.
+    :type cache_dir: str
+    :param generations_to_keep: Number of committed generations to keep on disk.
+    :type generations_to_keep: int
+    """
+    def __init__(self, cache_dir, generations_to_keep=5):
         self.cache_dir = cache_dir
+        self.generations_to_keep = generations_to_keep
+        self.generation = self._read_current_generation()
+        self._entries = self._read_generation(self.generation) if self.generation is not None else dict()
 
-    def set_doc(self, entry_name, doc):
-        export_path = f"{self.cache_dir}/{entry_name}.json"
-        IOUtils.ensure_dirs_exist_for_file(export_path)
-        with open(export_path, "w") as f:
-            json.dump(doc.to_dict(serialize_datetimes_to_str=True), f)
+    def _current_path(self):
+        return f"{self.cache_dir}/CURRENT"
 
-    def get_doc(self, entry_name, doc_type):
+    def _generation_path(self, generation):
+        return f"{self.cache_dir}/generation-{generation}.json"
+
+    def _read_current_generation(self):
         try:
-            with open(f"{self.cache_dir}/{entry_name}.json") as f:
-                return doc_type.from_dict(json.load(f))
+            with open(self._current_path()) as f:
+                return int(f.read().strip())
         except FileNotFoundError:
             return None
+
+    def _read_generation(self, generation):
+        with open(self._generation_path(generation)) as f:
+            return json.load(f)["entries"]
+
+    def list_generations(self):
+        """
+        :return: The generations available on disk, oldest first.
+        :rtype: list of int
+        """
+        if not os.path.exists(self.cache_dir):
+            return []
+        generations = []
+        for file_name in os.listdir(self.cache_dir):
+            match = re.fullmatch(r"generation-(\d+)\.json", file_name)
+            if match is not None:
+                generations.append(int(match.group(1)))
+        return sorted(generations)
+
+    @staticmethod
+    def _write_atomically(path, text):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    def set_doc(self, entry_name, doc):
+        """
+        Sets an entry in memory. The entry is only written to disk by the next call to `commit`.
+        """
+        self._entries[entry_name] = doc.to_dict(serialize_datetimes_to_str=True)
+
+    def get_doc(self, entry_name, doc_type):
+        if entry_name in self._entries:
+            return doc_type.from_dict(self._entries[entry_name])
+
+        if self.generation is None:
+            # Fall back to a cache written in the legacy, one file per entry format
+            try:
+                with open(f"{self.cache_dir}/{entry_name}.json") as f:
+                    self._entries[entry_name] = json.load(f)
+                    return doc_type.from_dict(self._entries[entry_name])
+            except FileNotFoundError:
+                pass
+
+        return None
+
+    def _delete_generations_after(self, generation):
+        for newer_generation in self.list_generations():
+            if newer_generation > generation:
+                os.remove(self._generation_path(newer_generation))
+
+    def commit(self):
+        """
+        Atomically writes all the entries as a new generation after the current one, makes that generation current,
+        and deletes any generations older than the most recent `generations_to_keep`.
+
+        Any generations newer than the current one, left on disk by a rollback that was interrupted before it could
+        delete them, are deleted rather than kept.
+        """
+        if self.generation is not None:
+            self._delete_generations_after(self.generation)
+        generations = self.list_generations()
+        new_generation = (generations[-1] if len(generations) > 0 else 0) + 1
+
+        IOUtils.ensure_dirs_exist(self.cache_dir)
+        self._write_atomically(
+            self._generation_path(new_generation),
+            json.dumps({"generation": new_generation, "entries": self._entries})
+        )
+        # Switching the CURRENT pointer is the commit point
+        self._write_atomically(self._current_path(), str(new_generation))
+        self.generation = new_generation
+
+        for old_generation in (generations + [new_generation])[:-self.generations_to_keep]:
+            os.remove(self._generation_path(old_generation))
+
+    def rollback(self, generation=None):
+        """
+        Makes an earlier generation current again, discarding any uncommitted entries, and deletes every generation
+        newer than it.
+
+        :param generation: Generation to roll back to. If None, rolls back to the generation before the current one.
+        :type generation: int | None
+        """
+        generations = [g for g in self.list_generations() if self.generation is None or g < self.generation]
+        if generation is None:
+            if len(generations) == 0:
+                raise ValueError(f"No generation older than the current generation {self.generation} to roll back to")
+            generation = generations[-1]
+        elif generation not in generations:
+            raise ValueError(f"Cannot roll back to generation {generation}. Available older generations are "
+                             f"{generations}")
+
+        self._write_atomically(self._current_path(), str(generation))
+        self.generation = generation
+        self._entries = self._read_generation(generation)
+        # Only delete the newer generations once CURRENT no longer points at any of them
+        self._delete_generations_after(generation)
@@ -0,0 +1,173 @@
+import csv
+import gzip
+import hashlib
+import json
+import os
+
+from core_data_modules.logging import Logger
+from dateutil.parser import isoparse
+from engagement_database.data_models import Message, MessageStatuses
+
+log = Logger(__name__)
+
+DUPLICATES_CSV_HEADERS = ["avf-participant-uuid", "text", "timestamp"]
+
+
+def open_export_file(export_file_path):
+    """
+    Opens an export produced by export_engagement_database.py for reading line by line.
+
+    :param export_file_path: Path to a jsonl export. Paths ending in .gz or .gzip are decompressed on the fly.
+    :type export_file_path: str
+    :return: Text file object.
+    :rtype: io.TextIOBase
+    """
+    if export_file_path.endswith(".gz") or export_file_path.endswith(".gzip"):
+        return gzip.open(export_file_path, "rt")
+    return open(export_file_path)
+
+
+def iter_exported_messages(export_file_paths):
+    """
+    Streams the serialized messages in one or more engagement database exports, skipping all other doc types.
+
+    :param export_file_paths: Paths to the exports to read, in the order they were exported.
+    :type export_file_paths: iterable of str
+    :return: Generator of serialized messages, as dicts in the format returned by `Message.to_dict`.
+    :rtype: iterator of dict
+    """
+    for export_file_path in export_file_paths:
+        with open_export_file(export_file_path) as f:
+            for line in f:
+                d = json.loads(line)
+                if d["type"] == Message.DOC_TYPE:
+                    yield d["data"]
+
+
+def normalise_text(text):
+    """
+    Normalises message text so that messages which only differ by case or whitespace compare as identical.
+
+    :param text: Text to normalise. None is treated as the empty string.
+    :type text: str | None
+    :return: Normalised text.
+    :rtype: str
+    """
+    if text is None:
+        return ""
+    return " ".join(text.split()).casefold()
+
+
+def duplicate_key(participant_uuid, text):
+    """
+    :return: A stable hash of (participant_uuid, normalised text), which is the same for messages that would be
+             considered duplicates of each other.
+    :rtype: str
+    """
+    return hashlib.sha256(json.dumps([participant_uuid, normalise_text(text)]).encode("utf-8")).hexdigest()
+
+
+def partition_messages(messages, partitions_dir, partitions_count):
+    """
+    Hash-partitions messages to disk by their `duplicate_key`, so that all the messages that could be duplicates of
+    each other, and all the exported versions of each message, end up in the same partition file.
+
+    Only the fields needed for duplicate detection are written, so each partition is much smaller than the export.
+
+    :param messages: Serialized messages to partition.
+    :type messages: iterable of dict
+    :param partitions_dir: Directory to write the partition files to.
+    :type partitions_dir: str
+    :param partitions_count: Number of partitions to write. Peak memory in `find_duplicates_in_partition` is
+                             proportional to (number of messages / partitions_count).
+    :type partitions_count: int
+    :return: Paths to the partition files written, and the number of messages partitioned.
+    :rtype: (list of str, int)
+    """
+    partition_paths = [os.path.join(partitions_dir, f"partition-{i}.jsonl") for i in range(partitions_count)]
+    partition_files = [open(path, "w") for path in partition_paths]
+    total_messages = 0
+    try:
+        for msg in messages:
+            key = duplicate_key(msg["participant_uuid"], msg["text"])
+            f = partition_files[int(key[:8], 16) % partitions_count]
+            json.dump([key, msg["message_id"], msg["last_updated"], msg["timestamp"], msg["participant_uuid"],
+                       msg["text"], msg["status"]], f)
+            f.write("\n")
+
+            total_messages += 1
+            if total_messages % 100000 == 0:
+                log.info(f"Partitioned {total_messages} messages")
+    finally:
+        for f in partition_files:
+            f.close()
+
+    return partition_paths, total_messages
+
+
+def find_duplicates_in_partition(partition_path, window_seconds):
+    """
+    Finds the duplicate messages in a partition written by `partition_messages`.
+
+    Only the latest exported version of each message is considered, and archived messages are ignored.
+    The remaining messages are grouped by duplicate key and sorted by timestamp. A message is a duplicate if the
+    previous message with the same key was sent at most `window_seconds` before it, so a burst of repeated messages
+    keeps the first and reports the rest.
+
+    :param partition_path: Path to the partition file to search.
+    :type partition_path: str
+    :param window_seconds: Maximum number of seconds between two identical messages for the later message to be
+                           considered a duplicate.
+    :type window_seconds: float
+    :return: Rows for the duplicates csv, with the headers in `DUPLICATES_CSV_HEADERS`.
+    :rtype: list of dict
+    """
+    # Keep only the latest version of each message, because incremental exports can contain several versions.
+    latest_versions = dict()  # of message_id -> partition record
+    with open(partition_path) as f:
+        for line in f:
+            record = json.loads(line)
+            message_id, last_updated = record[1], record[2]
+            if message_id not in latest_versions or \
+                    isoparse(last_updated) > isoparse(latest_versions[message_id][2]):
+                latest_versions[message_id] = record
+
+    key_to_messages = dict()  # of duplicate key -> list of (timestamp, record)
+    for record in latest_versions.values():
+        if record[6] == MessageStatuses.ARCHIVED:
+            continue
+        key_to_messages.setdefault(record[0], []).append((isoparse(record[3]), record))
+
+    duplicates = []
+    for key in sorted(key_to_messages.keys()):
+        messages = sorted(key_to_messages[key], key=lambda m: (m[0], m[1][1]))
+        for (previous_timestamp, _), (timestamp, record) in zip(messages, messages[1:]):
+            if (timestamp - previous_timestamp).total_seconds() <= window_seconds:
+                duplicates.append({
+                    "avf-participant-uuid": record[4],
+                    # archive_matching_messages.py matches "" against messages with text None
+                    "text": "" if record[5] is None else record[5],
+                    "timestamp": record[3]
+                })
+
+    return duplicates
+
+
+def write_duplicates_csv(duplicates, f):
+    """
+    Writes duplicates in the csv format consumed by archive_matching_messages.py.
+
+    :param duplicates: Duplicate rows, as returned by `find_duplicates_in_partition`.
+    :type duplicates: iterable of dict
+    :param f: File to write the csv to.
+    :type f: file-like
+    :return: Number of rows written.
+    :rtype: int
+    """
+    writer = csv.DictWriter(f, fieldnames=DUPLICATES_CSV_HEADERS)
+    writer.writeheader()
+    rows = 0
+    for row in duplicates:
+        writer.writerow(row)
+        rows += 1
+    return rows
@@ -0,0 +1,205 @@
+import datetime
+import random
+import uuid
+
+from core_data_modules.logging import Logger
+from google.cloud import firestore
+
+log = Logger(__name__)
+
+# Firestore's documented "500/50/5" guidance is to start at no more than 500 writes per second to a collection, so
+# this is a realistic sustained rate for the maintenance tools.
+DEFAULT_WRITES_PER_SECOND = 500
+
+DEFAULT_HISTORY_SAMPLE_SIZE = 100
+
+# Number of random points to draw samples from, so that samples aren't biased towards any one part of a collection
+SAMPLE_PROBES = 10
+
+
+class ImpactReport:
+    """
+    Summary of the data a destructive operation on an engagement database would touch.
+
+    :param operation: Description of the operation e.g. "Delete dataset 'test'".
+    :type operation: str
+    :param documents: Number of documents (excluding history entries) the operation would modify or delete.
+    :type documents: int
+    :param history_entries: Number of history entries the operation would create or delete.
+    :type history_entries: int
+    :param writes: Number of Firestore writes the operation would make.
+    :type writes: int
+    :param estimated: Whether any of these counts were extrapolated from a sample rather than counted exactly.
+    :type estimated: bool
+    """
+    def __init__(self, operation, documents, history_entries, writes, estimated=False):
+        self.operation = operation
+        self.documents = documents
+        self.history_entries = history_entries
+        self.writes = writes
+        self.estimated = estimated
+
+    def estimated_duration(self, writes_per_second=DEFAULT_WRITES_PER_SECOND):
+        """
+        :param writes_per_second: Write throughput to estimate with.
+        :type writes_per_second: float
+        :return: Estimated time the operation will take to run.
+        :rtype: datetime.timedelta
+        """
+        return datetime.timedelta(seconds=round(self.writes / writes_per_second))
+
+    def log(self, writes_per_second=DEFAULT_WRITES_PER_SECOND):
+        approx_text = "~" if self.estimated else ""
+        log.info(f"Impact estimate for operation: {self.operation}")
+        log.info(f"  Documents: {approx_text}{self.documents}")
+        log.info(f"  History entries: {approx_text}{self.history_entries}")
+        log.info(f"  Writes: {approx_text}{self.writes}")
+        log.info(f"  Estimated duration at {writes_per_second} writes/second: "
+                 f"{self.estimated_duration(writes_per_second)}")
+
+
+class ImpactEstimator:
+    """
+    Estimates the impact of operations on an engagement database using Firestore aggregation count queries and
+    key-only projections, so that no full documents are downloaded.
+
+    This uses its own Firestore client rather than an `EngagementDatabase`, because `EngagementDatabase`'s query
+    methods always deserialize whole documents.
+
+    :param firestore_client: Firestore client for the project containing the engagement database.
+    :type firestore_client: google.cloud.firestore.Client
+    :param database_path: Path to the engagement database e.g. engagement_databases/test.
+    :type database_path: str
+    """
+    def __init__(self, firestore_client, database_path):
+        self._client = firestore_client
+        self._database_path = database_path
+
+    @classmethod
+    def init_from_credentials(cls, credentials, database_path):
+        """
+        :param credentials: Firestore service account credentials, in the same format as passed to
+                            `EngagementDatabase.init_from_credentials`.
+        :type credentials: dict
+        :param database_path: Path to the engagement database e.g. engagement_databases/test.
+        :type database_path: str
+        :rtype: ImpactEstimator
+        """
+        return cls(firestore.Client.from_service_account_info(credentials), database_path)
+
+    def _messages_ref(self):
+        return self._client.document(self._database_path).collection("messages")
+
+    def _history_ref(self):
+        return self._client.document(self._database_path).collection("history")
+
+    @staticmethod
+    def _count(query):
+        return query.count().get()[0][0].value
+
+    def count_messages(self, firestore_query_filter=lambda q: q):
+        """
+        :param firestore_query_filter: Filter to apply to the messages query.
+        :type firestore_query_filter: function of google.cloud.firestore.Query -> google.cloud.firestore.Query
+        :return: Number of messages matching the filter.
+        :rtype: int
+        """
+        return self._count(firestore_query_filter(self._messages_ref()))
+
+    def count_history(self, firestore_query_filter=lambda q: q):
+        """
+        :param firestore_query_filter: Filter to apply to the history query.
+        :type firestore_query_filter: function of google.cloud.firestore.Query -> google.cloud.firestore.Query
+        :return: Number of history entries matching the filter.
+        :rtype: int
+        """
+        return self._count(firestore_query_filter(self._history_ref()))
+
+    def estimate_distinct_history_update_paths(self, since_inclusive, sample_size=DEFAULT_HISTORY_SAMPLE_SIZE):
+        """
+        Estimates the number of distinct documents that have history entries on or after a timestamp, without
+        downloading all of those history entries.
+
+        History entries are sampled from random timestamps between `since_inclusive` and now. For each sampled entry,
+        the number of entries its document has since `since_inclusive` is counted, and the number of distinct
+        documents is estimated as the total number of entries multiplied by the mean of the reciprocals of those
+        counts. The sample is spread evenly over time rather than over entries, so the estimate is less accurate if
+        the writes were very bursty.
+
+        :param since_inclusive: Timestamp to count the documents with history on or after.
+        :type since_inclusive: datetime.datetime
+        :param sample_size: Maximum number of history entries to sample.
+        :type sample_size: int
+        :return: Number of history entries on or after `since_inclusive`, and the estimated number of distinct
+                 documents they belong to.
+        :rtype: (int, int)
+        """
+        history_filter = lambda q: q.where("timestamp", ">=", since_inclusive)
+        history_count = self.count_history(history_filter)
+        if history_count == 0:
+            return 0, 0
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        entries_per_probe = max(1, sample_size // SAMPLE_PROBES)
+        sampled_entries = dict()  # of history entry id -> db_update_path
+        for _ in range(SAMPLE_PROBES):
+            probe_timestamp = since_inclusive + (now - since_inclusive) * random.random()
+            probe_query = history_filter(self._history_ref()).order_by("timestamp") \
+                .start_at({"timestamp": probe_timestamp})
+            for doc in probe_query.select(["db_update_path"]).limit(entries_per_probe).stream():
+                sampled_entries[doc.id] = doc.get("db_update_path")
+        if len(sampled_entries) == 0:
+            # Every probe landed after the latest entry, so fall back to the latest entries
+            latest_query = history_filter(self._history_ref()) \
+                .order_by("timestamp", direction=firestore.Query.DESCENDING)
+            for doc in latest_query.select(["db_update_path"]).limit(entries_per_probe).stream():
+                sampled_entries[doc.id] = doc.get("db_update_path")
+
+        entries_per_doc = dict()  # of db_update_path -> number of history entries since `since_inclusive`
+        for db_update_path in set(sampled_entries.values()):
+            entries_per_doc[db_update_path] = self.count_history(
+                lambda q: history_filter(q).where("db_update_path", "==", db_update_path)
+            )
+        mean_reciprocal = sum(1 / entries_per_doc[path] for path in sampled_entries.values()) / len(sampled_entries)
+
+        return history_count, round(history_count * mean_reciprocal)
+
+    def estimate_history_for_messages(self, firestore_query_filter=lambda q: q,
+                                      sample_size=DEFAULT_HISTORY_SAMPLE_SIZE):
+        """
+        Estimates the number of history entries belonging to the messages matching a filter.
+
+        The history of a sample of the matching messages is counted exactly, and the average is extrapolated to all
+        the matching messages. The sample is drawn from several random points across the message id keyspace, rather
+        than from the messages with the lowest ids. Message ids are UUIDs, so random UUIDs are used as the points.
+
+        :param firestore_query_filter: Filter to apply to the messages query.
+        :type firestore_query_filter: function of google.cloud.firestore.Query -> google.cloud.firestore.Query
+        :param sample_size: Maximum number of messages to count the history of.
+        :type sample_size: int
+        :return: Number of matching messages, and the estimated number of history entries they have.
+        :rtype: (int, int)
+        """
+        messages_count = self.count_messages(firestore_query_filter)
+        if messages_count == 0:
+            return 0, 0
+
+        # Key-only projections, so only the message ids are downloaded
+        messages_per_probe = max(1, sample_size // SAMPLE_PROBES)
+        sampled_message_ids = set()
+        for _ in range(SAMPLE_PROBES):
+            probe_query = firestore_query_filter(self._messages_ref()).order_by(firestore.FieldPath.document_id()) \
+                .start_at({firestore.FieldPath.document_id(): str(uuid.uuid4())})
+            sampled_message_ids.update(doc.id for doc in probe_query.select([]).limit(messages_per_probe).stream())
+        if len(sampled_message_ids) == 0:
+            # Every probe landed after the last matching message, so fall back to the first matching messages
+            first_messages_query = firestore_query_filter(self._messages_ref()).select([]).limit(messages_per_probe)
+            sampled_message_ids.update(doc.id for doc in first_messages_query.stream())
+
+        sampled_history_entries = 0
+        for message_id in sampled_message_ids:
+            sampled_history_entries += self.count_history(
+                lambda q: q.where("db_update_path", "==", f"messages/{message_id}")
+            )
+
+        return messages_count, round(sampled_history_entries / len(sampled_message_ids) * messages_count)
@@ -0,0 +1,44 @@
+import json
+
+# Firestore query operators that can be passed on the command line
+WHERE_OPERATORS = {"<", "<=", "==", "!=", ">=", ">", "array-contains", "array-contains-any", "in", "not-in"}
+
+
+def parse_where_value(value):
+    """
+    Parses a value passed on the command line, as JSON if possible (so numbers, booleans, null and lists can be
+    expressed), or as a plain string otherwise.
+
+    :param value: Value to parse.
+    :type value: str
+    :return: Parsed value.
+    :rtype: any
+    """
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
+
+def where_clauses_to_query_filter(where_clauses):
+    """
+    Converts where clauses passed on the command line to a Firestore query filter.
+
+    :param where_clauses: Where clauses, each of the form (field_path, operator, value), for example
+                          ("dataset", "==", "s01e01").
+    :type where_clauses: list of (str, str, str)
+    :return: Filter which applies all the where clauses to a query.
+    :rtype: function of google.cloud.firestore.Query -> google.cloud.firestore.Query
+    """
+    parsed_clauses = []
+    for field_path, operator, value in where_clauses:
+        if operator not in WHERE_OPERATORS:
+            raise ValueError(f"Unsupported where operator '{operator}'. Supported operators are {WHERE_OPERATORS}")
+        parsed_clauses.append((field_path, operator, parse_where_value(value)))
+
+    def query_filter(q):
+        for field_path, operator, value in parsed_clauses:
+            q = q.where(field_path, operator, value)
+        return q
+
+    return query_filter
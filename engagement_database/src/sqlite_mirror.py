@@ -0,0 +1,230 @@
+import json
+import sqlite3
+import threading
+from datetime import timezone
+
+from core_data_modules.logging import Logger
+from dateutil.parser import isoparse
+from engagement_database.data_models import Message, HistoryEntry, CommandLogEntry
+
+log = Logger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    message_id TEXT PRIMARY KEY,
+    participant_uuid TEXT,
+    dataset TEXT,
+    text TEXT,
+    status TEXT,
+    timestamp TEXT,
+    last_updated TEXT,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_participant_uuid ON messages (participant_uuid);
+CREATE INDEX IF NOT EXISTS messages_dataset ON messages (dataset);
+CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp);
+
+CREATE TABLE IF NOT EXISTS history (
+    history_entry_id TEXT PRIMARY KEY,
+    db_update_path TEXT,
+    timestamp TEXT,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_db_update_path_timestamp ON history (db_update_path, timestamp);
+CREATE INDEX IF NOT EXISTS history_timestamp ON history (timestamp);
+
+CREATE TABLE IF NOT EXISTS command_log (
+    command_log_entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT,
+    doc TEXT NOT NULL UNIQUE
+);
+CREATE INDEX IF NOT EXISTS command_log_timestamp ON command_log (timestamp);
+
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _normalise_timestamp(timestamp):
+    # Store every timestamp as a UTC ISO 8601 string so that timestamps sort and compare correctly as strings
+    if timestamp is None:
+        return None
+    if isinstance(timestamp, str):
+        timestamp = isoparse(timestamp)
+    return timestamp.astimezone(timezone.utc).isoformat()
+
+
+class EngagementDatabaseMirror:
+    """
+    Local, indexed SQLite copy of an engagement database's messages, history and command log, kept up to date by
+    export_engagement_database.py.
+
+    Tools can use the mirror to answer read-heavy planning queries locally, and only touch Firestore for the writes.
+    The mirror is only as fresh as the last export, so anything it returns should be re-read from Firestore before
+    it is written back.
+
+    Incremental exports only see documents which were created or updated, so tools which delete documents must also
+    delete them from the mirror with `delete_docs`. A mirror is only complete if it was seeded by a full export, which
+    is recorded with `set_seeded_by_full_export`. Tools must check `is_seeded_by_full_export` before planning from it.
+
+    :param connection: Connection to the SQLite database to use.
+    :type connection: sqlite3.Connection
+    """
+    def __init__(self, connection):
+        self._connection = connection
+        self._connection.executescript(_SCHEMA)
+        # Deletes may be made from the worker threads of a bulk mutation
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, file_path):
+        """
+        :param file_path: Path to the SQLite file. This is created if it does not exist.
+        :type file_path: str
+        :rtype: EngagementDatabaseMirror
+        """
+        return cls(sqlite3.connect(file_path, check_same_thread=False))
+
+    def close(self):
+        self._connection.close()
+
+    def commit(self):
+        """
+        Commits all the documents upserted since the last commit.
+        """
+        self._connection.commit()
+
+    def upsert_serialized_doc(self, doc_type, data):
+        """
+        Inserts or updates a document in the mirror.
+
+        :param doc_type: Type of the document, one of `Message.DOC_TYPE`, `HistoryEntry.DOC_TYPE` or
+                         `CommandLogEntry.DOC_TYPE`.
+        :type doc_type: str
+        :param data: Document, serialized with `to_dict(serialize_datetimes_to_str=True)`.
+        :type data: dict
+        """
+        doc = json.dumps(data)
+        if doc_type == Message.DOC_TYPE:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (data["message_id"], data["participant_uuid"], data["dataset"], data["text"], data["status"],
+                 _normalise_timestamp(data["timestamp"]), _normalise_timestamp(data["last_updated"]), doc)
+            )
+        elif doc_type == HistoryEntry.DOC_TYPE:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?)",
+                (data["history_entry_id"], data["db_update_path"], _normalise_timestamp(data["timestamp"]), doc)
+            )
+        elif doc_type == CommandLogEntry.DOC_TYPE:
+            # Command log entries have no id, so de-duplicate entries exported more than once on their contents
+            self._connection.execute(
+                "INSERT OR IGNORE INTO command_log (timestamp, doc) VALUES (?, ?)",
+                (_normalise_timestamp(data["timestamp"]), doc)
+            )
+        else:
+            raise ValueError(f"Unknown doc type '{doc_type}'")
+
+    def clear(self):
+        """
+        Deletes every document from the mirror, and the record that it was seeded by a full export, ready to be
+        re-seeded by a new full export.
+        """
+        self._connection.executescript("""
+            DELETE FROM messages;
+            DELETE FROM history;
+            DELETE FROM command_log;
+            DELETE FROM metadata WHERE key = 'seeded_by_full_export_at';
+        """)
+        self._connection.commit()
+
+    def set_seeded_by_full_export(self, export_start_timestamp):
+        """
+        Records that the mirror contains a full export of the database, then commits. Only call this once the full
+        export has completed.
+
+        :param export_start_timestamp: Time the full export started.
+        :type export_start_timestamp: datetime.datetime
+        """
+        self._connection.execute(
+            "INSERT OR REPLACE INTO metadata VALUES ('seeded_by_full_export_at', ?)",
+            (_normalise_timestamp(export_start_timestamp),)
+        )
+        self._connection.commit()
+
+    def get_seeded_by_full_export_at(self):
+        """
+        :return: The start time of the full export which seeded this mirror, or None if the mirror was not seeded by a
+                 full export and so may be missing documents.
+        :rtype: datetime.datetime | None
+        """
+        row = self._connection.execute(
+            "SELECT value FROM metadata WHERE key = 'seeded_by_full_export_at'"
+        ).fetchone()
+        return None if row is None else isoparse(row[0])
+
+    def delete_docs(self, db_update_paths):
+        """
+        Deletes documents from the mirror, and commits. Call this after deleting the documents from the database.
+
+        :param db_update_paths: Paths of the documents to delete, relative to the database e.g. "messages/<id>" or
+                                "history/<id>". Paths to any other collections are ignored.
+        :type db_update_paths: iterable of str
+        """
+        with self._lock:
+            for db_update_path in db_update_paths:
+                collection, doc_id = db_update_path.split("/", 1)
+                if collection == "messages":
+                    self._connection.execute("DELETE FROM messages WHERE message_id = ?", (doc_id,))
+                elif collection == "history":
+                    self._connection.execute("DELETE FROM history WHERE history_entry_id = ?", (doc_id,))
+            self._connection.commit()
+
+    def get_messages_with_text(self, participant_uuid, text):
+        """
+        :param participant_uuid: Participant to get the messages of.
+        :type participant_uuid: str
+        :param text: Text of the messages to get. If None, gets the participant's messages which have no text.
+        :type text: str | None
+        :return: The participant's messages with exactly the given text.
+        :rtype: list of engagement_database.data_models.Message
+        """
+        # `IS` rather than `=` so that a text of None matches messages with NULL text
+        rows = self._connection.execute(
+            "SELECT doc FROM messages WHERE participant_uuid = ? AND text IS ? ORDER BY timestamp",
+            (participant_uuid, text)
+        )
+        return [Message.from_dict(json.loads(doc)) for doc, in rows]
+
+    def get_history_since(self, timestamp_inclusive):
+        """
+        :param timestamp_inclusive: Timestamp to get the history entries since.
+        :type timestamp_inclusive: datetime.datetime
+        :return: All the history entries made on or after the given timestamp.
+        :rtype: list of engagement_database.data_models.HistoryEntry
+        """
+        rows = self._connection.execute(
+            "SELECT doc FROM history WHERE timestamp >= ? ORDER BY timestamp",
+            (_normalise_timestamp(timestamp_inclusive),)
+        )
+        return [HistoryEntry.from_dict(json.loads(doc)) for doc, in rows]
+
+    def get_latest_history_entry_before(self, db_update_path, timestamp_exclusive):
+        """
+        :param db_update_path: Path of the document to get the history entry for.
+        :type db_update_path: str
+        :param timestamp_exclusive: Timestamp to get the latest history entry before.
+        :type timestamp_exclusive: datetime.datetime
+        :return: The latest history entry for the document made before the given timestamp, or None if there is no
+                 such history entry.
+        :rtype: engagement_database.data_models.HistoryEntry | None
+        """
+        row = self._connection.execute(
+            "SELECT doc FROM history WHERE db_update_path = ? AND timestamp < ? ORDER BY timestamp DESC LIMIT 1",
+            (db_update_path, _normalise_timestamp(timestamp_exclusive))
+        ).fetchone()
+        if row is None:
+            return None
+        return HistoryEntry.from_dict(json.loads(row[0]))
@@ -10,6 +10,8 @@ from google.cloud import firestore
 from id_infrastructure.firestore_uuid_table import FirestoreUuidTable
 from storage.google_cloud import google_cloud_utils
 
+from src.bulk_mutation import BulkMessageMutation
+
 log = Logger(__name__)
 
 BATCH_SIZE = 500
@@ -52,12 +54,56 @@ def update_next_message_with_operator_nc(transaction, engagement_db, uuid_table,
     return message
 
 
+def update_messages_with_operator_nc_in_batches(engagement_db, uuid_table):
+    """
+    Updates the channel_operator of all messages labelled with operator NC, processing the messages in pages of
+    `BATCH_SIZE`.
+
+    The URNs for all the participants in a page are re-identified with a single bulk lookup, and each participant's
+    operator is only looked up and computed once per run. Updates are committed in batched writes.
+
+    :return: Summary of the messages processed and updated.
+    :rtype: src.bulk_mutation.ThroughputReport
+    """
+    participant_operators = dict()  # of participant_uuid -> operator
+
+    def lookup_operators(page):
+        uuids_to_lookup = {msg.participant_uuid for msg in page} - participant_operators.keys()
+        if len(uuids_to_lookup) > 0:
+            log.info(f"Re-identifying {len(uuids_to_lookup)} new participants...")
+            uuid_to_urn_lut = uuid_table.uuid_to_data_batch(list(uuids_to_lookup))
+            for participant_uuid, urn in uuid_to_urn_lut.items():
+                participant_operators[participant_uuid] = URNCleaner.clean_operator(urn)
+
+    def update_operator(message):
+        operator = participant_operators[message.participant_uuid]
+        if operator == Codes.NOT_CODED:
+            log.warning(f"Message {message.message_id} still has operator {Codes.NOT_CODED}")
+            return None
+        message.channel_operator = operator
+        return message
+
+    # Pages are processed one at a time so that each participant is only re-identified once
+    return BulkMessageMutation(
+        engagement_db,
+        transform=update_operator,
+        origin=HistoryEntryOrigin("Update operator", {}),
+        firestore_query_filter=lambda q: q.where("channel_operator", "==", Codes.NOT_CODED),
+        page_size=BATCH_SIZE,
+        max_concurrent_batches=1,
+        prepare_page=lookup_operators
+    ).run(dry_run=dry_run)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Updates the channel_operator of all messages in an engagement "
                                                  "database that are labelled with channel_operator 'NC', by "
                                                  "redetermining the channel operator from the message urn")
 
     parser.add_argument("--dry-run", const=True, default=False, action="store_const")
+    parser.add_argument("--batch", const=True, default=False, action="store_const",
+                        help=f"Process messages in pages of {BATCH_SIZE}, re-identifying participants in bulk and "
+                             f"committing updates in batched writes, rather than in one transaction per message")
     parser.add_argument("user", help="Identifier of the user launching this program")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
                         help="Path to a Google Cloud service account credentials file to use to access the "
@@ -76,6 +122,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     dry_run = args.dry_run
+    batch_mode = args.batch
     user = args.user
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
     engagement_database_credentials_file_url = args.engagement_database_credentials_file_url
@@ -114,12 +161,17 @@ if __name__ == "__main__":
         engagement_db.set_command_log_entry(CommandLogEntry(status=CommandStatuses.STARTED))
 
     log.info(f"Updating messages labelled with channel_operator {Codes.NOT_CODED}{dry_run_text}...")
-    total_messages = 0
-    msg = update_next_message_with_operator_nc(engagement_db.transaction(), engagement_db, uuid_table)
-    while msg is not None:
-        total_messages += 1
-        log.info(f"Processed {total_messages} messages so far")
-        msg = update_next_message_with_operator_nc(engagement_db.transaction(), engagement_db, uuid_table, msg)
+    if batch_mode:
+        report = update_messages_with_operator_nc_in_batches(engagement_db, uuid_table)
+        report.log(dry_run)
+        total_messages = report.messages_read
+    else:
+        total_messages = 0
+        msg = update_next_message_with_operator_nc(engagement_db.transaction(), engagement_db, uuid_table)
+        while msg is not None:
+            total_messages += 1
+            log.info(f"Processed {total_messages} messages so far")
+            msg = update_next_message_with_operator_nc(engagement_db.transaction(), engagement_db, uuid_table, msg)
 
     if not dry_run:
         engagement_db.set_command_log_entry(CommandLogEntry(status=CommandStatuses.COMPLETED_SUCCESSFULLY))
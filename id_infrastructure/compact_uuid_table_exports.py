@@ -0,0 +1,36 @@
+import argparse
+import gzip
+
+from core_data_modules.logging import Logger
+
+from src.incremental_export import compact_exports
+from src.uuid_table_export import EXPORT_WRITERS
+
+log = Logger(__name__)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merges a full uuid table export and the incremental exports made "
+                                                 "after it by export_firestore_uuid_tables.py into a single full "
+                                                 "export")
+
+    parser.add_argument("--format", choices=EXPORT_WRITERS.keys(), default="json",
+                        help="Format of the input exports, and of the compacted export to write. Defaults to 'json'")
+    parser.add_argument("output_file_path", metavar="output-file-path",
+                        help="json.gzip file to write the compacted export to")
+    parser.add_argument("export_file_paths", metavar="export-file-paths", nargs="+",
+                        help="Paths to the exports to merge, starting with the full export")
+
+    args = parser.parse_args()
+
+    export_format = args.format
+    output_file_path = args.output_file_path
+    export_file_paths = args.export_file_paths
+
+    log.warning(f"Writing compacted mappings to local disk at '{output_file_path}'...")
+    with gzip.open(output_file_path, "wt", encoding="utf-8") as f:
+        writer = EXPORT_WRITERS[export_format](f)
+        mappings_counts = compact_exports(export_file_paths, export_format, writer)
+        writer.close()
+
+    log.info(f"Compaction complete. Wrote {sum(mappings_counts.values())} mappings from {len(mappings_counts)} "
+             f"table(s)")
@@ -11,10 +11,32 @@ while [[ $# -gt 0 ]]; do
             GZIP_EXPORT_FILE_PATH=$2
             shift
             shift;;
+        --index-export-file-path)
+            INDEX_EXPORT_FILE_PATH_ARG="--index-export-file-path /data/export.uuidx"
+            INDEX_EXPORT_FILE_PATH=$2
+            shift
+            shift;;
         --gcs-upload-path)
             GCS_UPLOAD_PATH_ARG="--gcs-upload-path \"$2\""
             shift
             shift;;
+        --incremental-cache-volume)
+            INCREMENTAL_ARG="--incremental-cache-path /cache/seen_mappings.sqlite"
+            INCREMENTAL_CACHE_VOLUME_NAME=$2
+            shift
+            shift;;
+        --format)
+            FORMAT_ARG="--format $2"
+            shift
+            shift;;
+        --max-workers)
+            MAX_WORKERS_ARG="--max-workers $2"
+            shift
+            shift;;
+        --shards-per-table)
+            SHARDS_PER_TABLE_ARG="--shards-per-table $2"
+            shift
+            shift;;
         --)
             shift
             break;;
@@ -26,6 +48,9 @@ done
 # Check that the correct number of arguments were provided.
 if [[ $# -lt 2 ]]; then
     echo "Usage: ./docker-run-export-firestore-uuid-tables.sh [--gzip-export-file-path <path>] [--gcs-upload-path <path>]
+    [--index-export-file-path <path>] [--format <json|jsonl>]
+    [--max-workers <max-workers>] [--shards-per-table <shards-per-table>]
+    [--incremental-cache-volume <incremental-cache-volume>]
     <google-cloud-credentials-file-path> <firebase-credentials-file-url> [<table-name-1> ... <table-name-n>]"
     exit
 fi
@@ -38,10 +63,15 @@ TABLE_NAMES=${*:3}
 # Build an image for this pipeline stage.
 docker build -t "$IMAGE_NAME" .
 
-CMD="pipenv run python -u export_firestore_uuid_tables.py $GZIP_EXPORT_FILE_PATH_ARG $GCS_UPLOAD_PATH_ARG \
+CMD="pipenv run python -u export_firestore_uuid_tables.py $FORMAT_ARG $MAX_WORKERS_ARG $SHARDS_PER_TABLE_ARG $INCREMENTAL_ARG \
+     $GZIP_EXPORT_FILE_PATH_ARG $INDEX_EXPORT_FILE_PATH_ARG $GCS_UPLOAD_PATH_ARG \
      /credentials/google-cloud-credentials.json \"$FIREBASE_CREDENTIALS_FILE_URL\" $TABLE_NAMES
 "
-container="$(docker container create -w /app "$IMAGE_NAME" /bin/bash -c "$CMD")"
+if [[ "$INCREMENTAL_ARG" ]]; then
+    container="$(docker container create -w /app --mount source="$INCREMENTAL_CACHE_VOLUME_NAME",target=/cache "$IMAGE_NAME" /bin/bash -c "$CMD")"
+else
+    container="$(docker container create -w /app "$IMAGE_NAME" /bin/bash -c "$CMD")"
+fi
 echo "Created container $container"
 container_short_id=${container:0:7}
 
@@ -58,6 +88,10 @@ if [ -n "$GZIP_EXPORT_FILE_PATH" ]; then
     echo "Copying $container_short_id:/data/export.json.gzip -> $GZIP_EXPORT_FILE_PATH"
     docker cp "$container:/data/export.json.gzip" "$GZIP_EXPORT_FILE_PATH"
 fi
+if [ -n "$INDEX_EXPORT_FILE_PATH" ]; then
+    echo "Copying $container_short_id:/data/export.uuidx -> $INDEX_EXPORT_FILE_PATH"
+    docker cp "$container:/data/export.uuidx" "$INDEX_EXPORT_FILE_PATH"
+fi
 
 # Tear down the container, now that all expected output files have been copied out successfully
 docker container rm "$container" >/dev/null
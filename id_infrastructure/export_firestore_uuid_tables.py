@@ -1,19 +1,48 @@
 import argparse
 import gzip
 import json
+import tempfile
+import time
 
 from core_data_modules.logging import Logger
-
-from id_infrastructure.firestore_uuid_table import FirestoreUuidInfrastructure
 from storage.google_cloud import google_cloud_utils
 
+from src.incremental_export import SeenMappingsCache
+from src.uuid_index import UuidIndexWriter
+from src.uuid_table_export import UuidTableMappingsReader, EXPORT_WRITERS, DEFAULT_PAGE_SIZE, export_tables
+
 log = Logger(__name__)
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Exports Firestore uuid table mappings to a zipped json file")
+    parser = argparse.ArgumentParser(description="Exports Firestore uuid table mappings to a zipped json file. "
+                                                 "Mappings are streamed to the file a page at a time, so memory use "
+                                                 "does not grow with the size of the tables")
 
+    parser.add_argument("--format", choices=EXPORT_WRITERS.keys(), default="json",
+                        help="Format to export the mappings in. 'json' writes a single object of "
+                             "{table_name: {\"mappings\": {data: uuid}}}. 'jsonl' writes one "
+                             "{\"table_name\", \"data\", \"uuid\"} object per line, which can be read back without "
+                             "loading the whole export into memory. Defaults to 'json'")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE,
+                        help=f"Number of mappings to fetch from Firestore at a time. Defaults to {DEFAULT_PAGE_SIZE}")
+    parser.add_argument("--max-workers", type=int, default=1,
+                        help="Maximum number of tables, or shards of tables, to fetch from Firestore concurrently. "
+                             "Defaults to 1")
+    parser.add_argument("--shards-per-table", type=int, default=1,
+                        help="Number of uuid ranges to split each table into, so that large tables can be fetched by "
+                             "several workers concurrently. Must be between 1 and 256. Defaults to 1")
+    parser.add_argument("--incremental-cache-path",
+                        help="Path to a SQLite file to use to record which mappings have been exported. If this "
+                             "argument is provided, only mappings which are not already in the cache are exported, "
+                             "so the export is a delta against the previous exports made with this cache. Use "
+                             "compact_uuid_table_exports.py to merge deltas into a full export. Mappings are still "
+                             "read from every table, because uuid tables don't record when each mapping was added")
     parser.add_argument("--gzip-export-file-path",
                         help="json.gzip file to write the exported data to")
+    parser.add_argument("--index-export-file-path",
+                        help="File to also write the exported mappings to in an indexed binary format, which "
+                             "src.uuid_index.UuidIndexReader can look mappings up in, in either direction, without "
+                             "loading the file into memory")
     parser.add_argument("--gcs-upload-path",
                         help="GS URL to upload the exported json.gzip to")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
@@ -26,7 +55,13 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    export_format = args.format
+    page_size = args.page_size
+    max_workers = args.max_workers
+    shards_per_table = args.shards_per_table
+    incremental_cache_path = args.incremental_cache_path
     gzip_export_file_path = args.gzip_export_file_path
+    index_export_file_path = args.index_export_file_path
     gcs_upload_path = args.gcs_upload_path
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
     firebase_credentials_file_url = args.firebase_credentials_file_url
@@ -43,32 +78,63 @@ if __name__ == "__main__":
         firebase_credentials_file_url
     ))
 
-    id_tables = FirestoreUuidInfrastructure.init_from_credentials(firestore_uuid_table_credentials)
+    mappings_reader = UuidTableMappingsReader.init_from_credentials(firestore_uuid_table_credentials)
     if len(table_names) == 0:
-        table_names = id_tables.list_table_names()
+        table_names = mappings_reader.list_table_names()
     log.info(f"Found {len(table_names)} uuid tables to export")
 
-    export = dict()  # of table_name -> {mappings: dict of data -> uuid}
-    for i, table_name in enumerate(table_names):
-        log.info(f"Fetching mappings from table {i + 1}/{len(table_names)}: {table_name}...")
-        mappings = id_tables.get_table(table_name, None).get_all_mappings()
-        export[table_name] = {
-            "mappings": mappings
-        }
-        log.info(f"Fetched {len(mappings)} mappings")
-
-    log.info(f"Converting fetched data to zipped json for export...")
-    json_blob = json.dumps(export)
-    export_compressed = gzip.compress(bytes(json_blob, "utf-8"))
-
-    if gzip_export_file_path is not None:
-        log.warning(f"Writing mappings to local disk at '{gzip_export_file_path}'...")
-        with open(gzip_export_file_path, "wb") as f:
-            f.write(export_compressed)
-
-    if gcs_upload_path is not None:
-        log.info(f"Uploading the mappings to {gcs_upload_path}...")
-        google_cloud_utils.upload_string_to_blob(google_cloud_credentials_file_path, gcs_upload_path,
-                                                 export_compressed)
+    if incremental_cache_path is None:
+        seen_mappings = None
+        log.info("No incremental cache specified, will perform a complete export")
+    else:
+        seen_mappings = SeenMappingsCache.open(incremental_cache_path)
+        log.info(f"Initialised incremental cache at {incremental_cache_path}")
+
+    index_file = None
+    index_writer = None
+    if index_export_file_path is not None:
+        log.warning(f"Writing indexed mappings to local disk at '{index_export_file_path}'...")
+        index_file = open(index_export_file_path, "wb")
+        index_writer = UuidIndexWriter(index_file)
+
+    def filter_mappings(table_name, mappings):
+        if seen_mappings is not None:
+            mappings = seen_mappings.filter_new_mappings(table_name, mappings)
+        if index_writer is not None:
+            mappings = index_writer.index_mappings(table_name, mappings)
+        return mappings
+
+    # Write the export to the requested local file, or to a temporary file if we're only uploading to GCS, so that the
+    # compressed export is streamed to disk rather than built up in memory.
+    with tempfile.NamedTemporaryFile(suffix=".gzip") as temp_file:
+        if gzip_export_file_path is not None:
+            log.warning(f"Writing mappings to local disk at '{gzip_export_file_path}'...")
+            export_path = gzip_export_file_path
+        else:
+            export_path = temp_file.name
+
+        log.info(f"Exporting mappings using up to {max_workers} concurrent worker(s)...")
+        start_time = time.perf_counter()
+        with gzip.open(export_path, "wt", encoding="utf-8") as f:
+            writer = EXPORT_WRITERS[export_format](f)
+            export_counts = export_tables(mappings_reader, writer, table_names, page_size, max_workers,
+                                          shards_per_table, filter_mappings)
+            writer.close()
+        if index_writer is not None:
+            index_writer.close()
+            index_file.close()
+        log.info(f"Fetched {sum(fetched for fetched, _ in export_counts.values())} mappings and exported "
+                 f"{sum(written for _, written in export_counts.values())} in {time.perf_counter() - start_time:.1f}s")
+
+        if gcs_upload_path is not None:
+            log.info(f"Uploading the mappings to {gcs_upload_path}...")
+            with open(export_path, "rb") as f:
+                google_cloud_utils.upload_file_to_blob(google_cloud_credentials_file_path, gcs_upload_path, f)
+
+    # Now that the export has been written and uploaded successfully, record the exported mappings in the cache so
+    # the next incremental export doesn't include them again.
+    if seen_mappings is not None:
+        seen_mappings.commit()
+        seen_mappings.close()
 
     log.info(f"Export complete ({len(table_names)} table(s))")
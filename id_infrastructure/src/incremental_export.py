@@ -0,0 +1,258 @@
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+from itertools import chain
+from json.decoder import scanstring
+
+from core_data_modules.logging import Logger
+
+from src.uuid_table_export import write_mappings_fragment, read_mappings_fragment
+
+log = Logger(__name__)
+
+# Maximum number of mappings from each table to buffer in memory while compacting, before writing them to a fragment
+_COMPACTION_FRAGMENT_SIZE = 10000
+
+# Number of characters to read from a "json" format export at a time while stream-parsing it
+_JSON_READ_CHUNK_SIZE = 1024 * 1024
+
+
+def _mapping_key(table_name, data):
+    # Store hashes rather than the data itself, so the cache stays small and doesn't hold any identifiable data
+    return hashlib.sha256(json.dumps([table_name, data]).encode("utf-8")).digest()
+
+
+class SeenMappingsCache:
+    """
+    Records which uuid table mappings have already been exported, so that incremental exports only need to write the
+    mappings added since the last export.
+
+    Mappings are recorded in a SQLite database by a hash of their table name and data. Newly seen mappings are only
+    persisted by `commit`, so an export that fails part way through leaves the cache as it was.
+
+    :param connection: Connection to the SQLite database to use.
+    :type connection: sqlite3.Connection
+    """
+    def __init__(self, connection):
+        self._connection = connection
+        self._connection.execute("CREATE TABLE IF NOT EXISTS seen_mappings (key BLOB PRIMARY KEY)")
+
+    @classmethod
+    def open(cls, file_path):
+        """
+        :param file_path: Path to the SQLite file. This is created if it does not exist.
+        :type file_path: str
+        :rtype: SeenMappingsCache
+        """
+        return cls(sqlite3.connect(file_path))
+
+    def close(self):
+        self._connection.close()
+
+    def commit(self):
+        self._connection.commit()
+
+    def filter_new_mappings(self, table_name, mappings):
+        """
+        Filters mappings down to those which haven't been seen before, recording them as seen.
+
+        :param table_name: Name of the table the mappings are from.
+        :type table_name: str
+        :param mappings: (data, uuid) tuples to filter.
+        :type mappings: iterable of (str, str)
+        :return: Generator of the (data, uuid) tuples which had not been seen before.
+        :rtype: iterator of (str, str)
+        """
+        for data, uuid in mappings:
+            cursor = self._connection.execute(
+                "INSERT OR IGNORE INTO seen_mappings VALUES (?)", (_mapping_key(table_name, data),)
+            )
+            if cursor.rowcount == 1:
+                yield data, uuid
+
+
+class _StreamingJsonReader:
+    """
+    Reads the tokens of a json document from a text stream a chunk at a time, so that documents much bigger than
+    memory can be parsed.
+
+    :param f: Text stream to read from.
+    :type f: file-like
+    """
+    def __init__(self, f):
+        self._f = f
+        self._buffer = ""
+        self._pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def _read_chunk(self):
+        chunk = self._f.read(_JSON_READ_CHUNK_SIZE)
+        if chunk == "":
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek_char(self):
+        """
+        :return: The next non-whitespace character, without consuming it.
+        :rtype: str
+        """
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in " \t\n\r":
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read_chunk():
+                raise ValueError("Unexpected end of json document")
+
+    def next_char(self):
+        """
+        :return: The next non-whitespace character.
+        :rtype: str
+        """
+        c = self.peek_char()
+        self._pos += 1
+        return c
+
+    def expect_char(self, expected):
+        c = self.next_char()
+        if c != expected:
+            raise ValueError(f"Expected '{expected}' in json document, but found '{c}'")
+
+    def read_string(self):
+        """
+        :return: The next value, which must be a string.
+        :rtype: str
+        """
+        self.expect_char('"')
+        while True:
+            try:
+                value, self._pos = scanstring(self._buffer, self._pos)
+                return value
+            except json.JSONDecodeError:
+                # The string continues past the end of the buffer
+                if not self._read_chunk():
+                    raise
+
+    def read_value(self):
+        """
+        :return: The next value, of any type. The whole value is loaded into memory.
+        :rtype: any
+        """
+        self.peek_char()
+        while True:
+            try:
+                value, self._pos = self._decoder.raw_decode(self._buffer, self._pos)
+                return value
+            except json.JSONDecodeError:
+                if not self._read_chunk():
+                    raise
+
+
+def _iter_object_keys(reader):
+    # Consumes a json object's braces and separators, yielding each key. The caller must consume each key's value
+    # before requesting the next key.
+    reader.expect_char("{")
+    if reader.peek_char() == "}":
+        reader.next_char()
+        return
+    while True:
+        key = reader.read_string()
+        reader.expect_char(":")
+        yield key
+        c = reader.next_char()
+        if c == "}":
+            return
+        if c != ",":
+            raise ValueError(f"Expected ',' or '}}' in json document, but found '{c}'")
+
+
+def _iter_json_export_mappings(f):
+    # Stream-parses an export in the "json" format written by `src.uuid_table_export.JsonExportWriter`,
+    # i.e. {table_name: {"mappings": {data: uuid}}}, one mapping at a time
+    reader = _StreamingJsonReader(f)
+    for table_name in _iter_object_keys(reader):
+        for key in _iter_object_keys(reader):
+            if key != "mappings":
+                reader.read_value()
+                continue
+            for data in _iter_object_keys(reader):
+                yield table_name, data, reader.read_string()
+
+
+def iter_export_mappings(file_path, export_format):
+    """
+    Streams all the mappings in a gzipped export made by export_firestore_uuid_tables.py, one mapping at a time, so
+    that memory use stays flat however big the export is.
+
+    :param file_path: Path to the export to read.
+    :type file_path: str
+    :param export_format: Format of the export, "json" or "jsonl".
+    :type export_format: str
+    :return: Generator of (table_name, data, uuid) tuples.
+    :rtype: iterator of (str, str, str)
+    """
+    with gzip.open(file_path, "rt", encoding="utf-8") as f:
+        if export_format == "jsonl":
+            for line in f:
+                mapping = json.loads(line)
+                yield mapping["table_name"], mapping["data"], mapping["uuid"]
+        else:
+            yield from _iter_json_export_mappings(f)
+
+
+def compact_exports(file_paths, export_format, writer):
+    """
+    Merges a full export and any number of incremental exports into a single full export.
+
+    Mappings are grouped by table via temporary fragment files on disk, and de-duplicated via a temporary
+    `SeenMappingsCache`, and inputs in both formats are stream-parsed, so memory use stays flat.
+
+    :param file_paths: Paths to the exports to merge, each written by export_firestore_uuid_tables.py.
+    :type file_paths: list of str
+    :param export_format: Format of the input exports, "json" or "jsonl".
+    :type export_format: str
+    :param writer: Writer to write the compacted export with, one of `src.uuid_table_export.EXPORT_WRITERS`.
+                   The caller is responsible for closing this.
+    :type writer: src.uuid_table_export.JsonExportWriter | src.uuid_table_export.JsonlExportWriter
+    :return: Number of mappings written for each table.
+    :rtype: dict of str -> int
+    """
+    mappings_counts = dict()  # of table_name -> number of mappings written
+    with tempfile.TemporaryDirectory() as temp_dir:
+        seen_mappings = SeenMappingsCache.open(os.path.join(temp_dir, "seen_mappings.sqlite"))
+        fragments = dict()  # of table_name -> list of fragment paths
+
+        def write_fragment(table_name, mappings):
+            fragment_path = os.path.join(temp_dir, f"fragment-{sum(len(paths) for paths in fragments.values())}.jsonl")
+            write_mappings_fragment(fragment_path, mappings)
+            fragments.setdefault(table_name, []).append(fragment_path)
+
+        for i, file_path in enumerate(file_paths):
+            log.info(f"Reading export {i + 1}/{len(file_paths)}: {file_path}...")
+            table_mappings = dict()  # of table_name -> list of (data, uuid) read from this export
+            for table_name, data, uuid in iter_export_mappings(file_path, export_format):
+                if table_name not in table_mappings:
+                    table_mappings[table_name] = []
+                table_mappings[table_name].append((data, uuid))
+
+                if len(table_mappings[table_name]) >= _COMPACTION_FRAGMENT_SIZE:
+                    write_fragment(table_name, table_mappings.pop(table_name))
+
+            for table_name, mappings in table_mappings.items():
+                write_fragment(table_name, mappings)
+
+        for table_name, fragment_paths in fragments.items():
+            mappings = chain.from_iterable(read_mappings_fragment(path) for path in fragment_paths)
+            mappings_counts[table_name] = writer.write_table(
+                table_name, seen_mappings.filter_new_mappings(table_name, mappings)
+            )
+            log.info(f"Wrote {mappings_counts[table_name]} mappings for table '{table_name}'")
+
+        seen_mappings.close()
+
+    return mappings_counts
@@ -0,0 +1,282 @@
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+# File layout:
+#   header: magic (8 bytes), format version (uint32), directory offset (uint64), directory length (uint64)
+#   for each table:
+#     heap: one entry per mapping, (data length (uint32), data utf-8, uuid length (uint32), uuid utf-8)
+#     data index: one record per mapping, sorted by hash of data
+#     uuid index: one record per mapping, sorted by hash of uuid
+#   directory: json object of table name -> offsets and counts of that table's sections
+# Each index record is (first 16 bytes of the sha256 of the key, offset of the mapping's entry in the table's heap).
+MAGIC = b"AVFUUIDX"
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<8sIQQ")
+_RECORD = struct.Struct("<16sQ")
+_LENGTH = struct.Struct("<I")
+_HASH_LENGTH = 16
+
+# Maximum number of index records to sort in memory at once. Larger tables are sorted in runs on disk which are then
+# merged, so writing an index never needs more than about this many records (24 bytes each) in memory.
+DEFAULT_MAX_RECORDS_IN_MEMORY = 1000000
+
+
+def _hash_key(key):
+    return hashlib.sha256(key.encode("utf-8")).digest()[:_HASH_LENGTH]
+
+
+class _ExternalRecordSorter:
+    """
+    Sorts index records which may not fit in memory, by sorting them in runs written to temporary files and then
+    merging the runs.
+    """
+    def __init__(self, temp_dir, max_records_in_memory):
+        self._temp_dir = temp_dir
+        self._max_records_in_memory = max_records_in_memory
+        self._records = []
+        self._run_paths = []
+
+    def add(self, key_hash, heap_offset):
+        self._records.append((key_hash, heap_offset))
+        if len(self._records) >= self._max_records_in_memory:
+            self._write_run()
+
+    def _write_run(self):
+        self._records.sort()
+        run_path = os.path.join(self._temp_dir, f"run-{id(self)}-{len(self._run_paths)}")
+        with open(run_path, "wb") as f:
+            for record in self._records:
+                f.write(_RECORD.pack(*record))
+        self._run_paths.append(run_path)
+        self._records = []
+
+    @staticmethod
+    def _read_run(run_path):
+        with open(run_path, "rb") as f:
+            while True:
+                record = f.read(_RECORD.size)
+                if len(record) == 0:
+                    return
+                yield _RECORD.unpack(record)
+
+    def write_sorted(self, f):
+        """
+        Writes all the added records to a binary stream in sorted order, then deletes the temporary runs.
+        """
+        if len(self._run_paths) == 0:
+            self._records.sort()
+            for record in self._records:
+                f.write(_RECORD.pack(*record))
+        else:
+            if len(self._records) > 0:
+                self._write_run()
+            for record in heapq.merge(*[self._read_run(path) for path in self._run_paths]):
+                f.write(_RECORD.pack(*record))
+            for path in self._run_paths:
+                os.remove(path)
+        self._records = []
+        self._run_paths = []
+
+
+class UuidIndexWriter:
+    """
+    Writes uuid table mappings to an indexed binary file which `UuidIndexReader` can look mappings up in, in both
+    directions, without loading the file into memory.
+
+    This has the same `write_table`/`close` interface as the writers in `src.uuid_table_export.EXPORT_WRITERS`.
+
+    :param f: Seekable binary stream to write to.
+    :type f: file-like
+    :param max_records_in_memory: Maximum number of index records to sort in memory at once.
+    :type max_records_in_memory: int
+    """
+    def __init__(self, f, max_records_in_memory=DEFAULT_MAX_RECORDS_IN_MEMORY):
+        self._f = f
+        self._max_records_in_memory = max_records_in_memory
+        self._directory = dict()  # of table_name -> dict of section offsets and counts
+        self._f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, 0, 0))
+
+    def index_mappings(self, table_name, mappings):
+        """
+        Writes a table's mappings to the index as they are iterated over, passing each mapping through unchanged.
+
+        This allows the mappings to be indexed while they are written to another export e.g. by passing this function
+        as the `filter_mappings` argument of `src.uuid_table_export.export_tables`. The table's indexes are written
+        once all the mappings have been iterated over.
+
+        :param table_name: Name of the table to write.
+        :type table_name: str
+        :param mappings: (data, uuid) tuples to write for this table.
+        :type mappings: iterable of (str, str)
+        :return: Generator of the same (data, uuid) tuples.
+        :rtype: iterator of (str, str)
+        """
+        assert table_name not in self._directory, f"Table '{table_name}' has already been written to this index"
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            data_records = _ExternalRecordSorter(temp_dir, self._max_records_in_memory)
+            uuid_records = _ExternalRecordSorter(temp_dir, self._max_records_in_memory)
+
+            heap_offset = self._f.tell()
+            count = 0
+            for data, uuid in mappings:
+                entry_offset = self._f.tell() - heap_offset
+                for value in (data, uuid):
+                    encoded_value = value.encode("utf-8")
+                    self._f.write(_LENGTH.pack(len(encoded_value)))
+                    self._f.write(encoded_value)
+                data_records.add(_hash_key(data), entry_offset)
+                uuid_records.add(_hash_key(uuid), entry_offset)
+                count += 1
+                yield data, uuid
+
+            data_index_offset = self._f.tell()
+            data_records.write_sorted(self._f)
+            uuid_index_offset = self._f.tell()
+            uuid_records.write_sorted(self._f)
+
+        self._directory[table_name] = {
+            "count": count,
+            "heap_offset": heap_offset,
+            "data_index_offset": data_index_offset,
+            "uuid_index_offset": uuid_index_offset
+        }
+
+    def write_table(self, table_name, mappings):
+        """
+        :param table_name: Name of the table to write.
+        :type table_name: str
+        :param mappings: (data, uuid) tuples to write for this table.
+        :type mappings: iterable of (str, str)
+        :return: Number of mappings written.
+        :rtype: int
+        """
+        mappings_written = 0
+        for _ in self.index_mappings(table_name, mappings):
+            mappings_written += 1
+        return mappings_written
+
+    def close(self):
+        """
+        Writes the table directory and the header. The index can't be read until this has been called.
+        """
+        directory = json.dumps(self._directory).encode("utf-8")
+        directory_offset = self._f.tell()
+        self._f.write(directory)
+        self._f.seek(0)
+        self._f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, directory_offset, len(directory)))
+        self._f.seek(0, os.SEEK_END)
+
+
+class UuidIndexReader:
+    """
+    Looks up mappings in an index written by `UuidIndexWriter`.
+
+    The file is memory-mapped, so opening it is instant, lookups are binary searches that only touch the pages they
+    need, and the pages are shared between every process reading the same file.
+
+    :param file_path: Path to the index file to read.
+    :type file_path: str
+    """
+    def __init__(self, file_path):
+        self._file = open(file_path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, directory_offset, directory_length = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"'{file_path}' is not a uuid index file")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"'{file_path}' has unsupported uuid index format version {version}")
+        self._directory = json.loads(self._mmap[directory_offset:directory_offset + directory_length])
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def list_table_names(self):
+        """
+        :return: The names of all the tables in the index.
+        :rtype: list of str
+        """
+        return list(self._directory.keys())
+
+    def count_mappings(self, table_name):
+        """
+        :param table_name: Name of the table to count the mappings of.
+        :type table_name: str
+        :return: Number of mappings in the table.
+        :rtype: int
+        """
+        return self._directory[table_name]["count"]
+
+    def _read_entry(self, table, entry_offset):
+        offset = table["heap_offset"] + entry_offset
+        values = []
+        for _ in range(2):
+            length, = _LENGTH.unpack_from(self._mmap, offset)
+            offset += _LENGTH.size
+            values.append(self._mmap[offset:offset + length].decode("utf-8"))
+            offset += length
+        data, uuid = values
+        return data, uuid
+
+    def _lookup(self, table_name, index_offset_key, key, key_position):
+        table = self._directory[table_name]
+        index_offset = table[index_offset_key]
+        key_hash = _hash_key(key)
+
+        # Binary search for the first record with this key's hash
+        lo, hi = 0, table["count"]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record_offset = index_offset + mid * _RECORD.size
+            if self._mmap[record_offset:record_offset + _HASH_LENGTH] < key_hash:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # Check every record with this hash, in case of hash collisions
+        while lo < table["count"]:
+            record_hash, entry_offset = _RECORD.unpack_from(self._mmap, index_offset + lo * _RECORD.size)
+            if record_hash != key_hash:
+                break
+            entry = self._read_entry(table, entry_offset)
+            if entry[key_position] == key:
+                return entry[1 - key_position]
+            lo += 1
+
+        return None
+
+    def data_to_uuid(self, table_name, data):
+        """
+        :param table_name: Name of the table to look the data up in.
+        :type table_name: str
+        :param data: Data to look up.
+        :type data: str
+        :return: The uuid the data is mapped to, or None if the data isn't in the table.
+        :rtype: str | None
+        """
+        return self._lookup(table_name, "data_index_offset", data, 0)
+
+    def uuid_to_data(self, table_name, uuid):
+        """
+        :param table_name: Name of the table to look the uuid up in.
+        :type table_name: str
+        :param uuid: Uuid to look up.
+        :type uuid: str
+        :return: The data the uuid is mapped to, or None if the uuid isn't in the table.
+        :rtype: str | None
+        """
+        return self._lookup(table_name, "uuid_index_offset", uuid, 1)
@@ -0,0 +1,317 @@
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain
+
+from core_data_modules.logging import Logger
+from google.cloud import firestore
+
+log = Logger(__name__)
+
+DEFAULT_PAGE_SIZE = 1000
+
+# Length of the random uuid4 string that FirestoreUuidTable appends to a table's uuid prefix
+_UUID4_STRING_LENGTH = 36
+
+
+class UuidTableMappingsReader:
+    """
+    Streams the mappings out of Firestore uuid tables one page at a time, so that exports never need to hold a whole
+    table in memory.
+
+    This reads the same collections as `id_infrastructure.firestore_uuid_table.FirestoreUuidTable`, where each
+    table's mappings are stored in `tables/{table_name}/mappings`, with the data as the document id and the uuid in
+    the document's "uuid" field. It uses its own Firestore client because `FirestoreUuidTable.get_all_mappings` can
+    only return a whole table at once.
+
+    :param firestore_client: Firestore client for the project containing the uuid tables.
+    :type firestore_client: google.cloud.firestore.Client
+    """
+    def __init__(self, firestore_client):
+        self._client = firestore_client
+
+    @classmethod
+    def init_from_credentials(cls, credentials):
+        """
+        :param credentials: Firestore service account credentials, in the same format as passed to
+                            `FirestoreUuidInfrastructure.init_from_credentials`.
+        :type credentials: dict
+        :rtype: UuidTableMappingsReader
+        """
+        return cls(firestore.Client.from_service_account_info(credentials))
+
+    def _mappings_ref(self, table_name):
+        return self._client.collection("tables").document(table_name).collection("mappings")
+
+    def list_table_names(self):
+        """
+        :return: The names of all the uuid tables in Firestore.
+        :rtype: list of str
+        """
+        return [table_ref.id for table_ref in self._client.collection("tables").list_documents()]
+
+    def iter_mappings(self, table_name, page_size=DEFAULT_PAGE_SIZE, uuid_range=None):
+        """
+        Streams all the mappings in a table, or in a range of its uuids.
+
+        :param table_name: Name of the table to read.
+        :type table_name: str
+        :param page_size: Number of mappings to fetch from Firestore at a time.
+        :type page_size: int
+        :param uuid_range: (lower bound inclusive, upper bound exclusive) of the uuids to read, as returned by
+                           `split_uuid_range`. Either bound may be None to leave that end of the range open. If None,
+                           reads the whole table ordered by data, otherwise reads the range ordered by uuid.
+        :type uuid_range: (str | None, str | None) | None
+        :return: Generator of (data, uuid) tuples.
+        :rtype: iterator of (str, str)
+        """
+        query = self._mappings_ref(table_name)
+        if uuid_range is None:
+            query = query.order_by("__name__")
+        else:
+            lower_bound, upper_bound = uuid_range
+            if lower_bound is not None:
+                query = query.where("uuid", ">=", lower_bound)
+            if upper_bound is not None:
+                query = query.where("uuid", "<", upper_bound)
+            query = query.order_by("uuid")
+        query = query.select(["uuid"]).limit(page_size)
+
+        last_snapshot = None
+        while True:
+            page_query = query if last_snapshot is None else query.start_after(last_snapshot)
+            page = list(page_query.stream())
+
+            for snapshot in page:
+                yield snapshot.id, snapshot.get("uuid")
+
+            if len(page) < page_size:
+                return
+            last_snapshot = page[-1]
+
+    def split_uuid_range(self, table_name, shards):
+        """
+        Splits a table into ranges of uuids that can be read concurrently with `iter_mappings`.
+
+        Every uuid in a table is its table's uuid prefix followed by a random uuid4, so splitting on the first hex
+        digits after the prefix gives shards of roughly equal size. The first and last ranges are open-ended, so
+        together the ranges always cover every mapping in the table, even one with an unexpected uuid format.
+
+        :param table_name: Name of the table to split.
+        :type table_name: str
+        :param shards: Number of ranges to split the table into, between 1 and 256.
+        :type shards: int
+        :return: (lower bound inclusive, upper bound exclusive) uuid ranges, where None is an open bound, or [None] if
+                 the table should be read whole.
+        :rtype: list of (str | None, str | None) | list of None
+        """
+        assert 1 <= shards <= 256, f"Cannot split a table into {shards} shards"
+        if shards == 1:
+            return [None]
+
+        first_mapping = list(self._mappings_ref(table_name).select(["uuid"]).limit(1).stream())
+        if len(first_mapping) == 0:
+            return [None]
+        uuid_prefix = first_mapping[0].get("uuid")[:-_UUID4_STRING_LENGTH]
+
+        hex_digits = 1 if shards <= 16 else 2
+        boundaries = [uuid_prefix + f"{(i * 16 ** hex_digits) // shards:0{hex_digits}x}" for i in range(1, shards)]
+        return list(zip([None] + boundaries, boundaries + [None]))
+
+
+class JsonExportWriter:
+    """
+    Writes uuid table mappings to a text stream as a single json object, one table at a time.
+
+    The output has the same structure as the exports made before streaming was supported, i.e.
+    {table_name: {"mappings": {data: uuid}}}, so it can still be read with `json.load`.
+
+    :param f: Text stream to write to.
+    :type f: file-like
+    """
+    def __init__(self, f):
+        self._f = f
+        self._tables_written = 0
+        self._f.write("{")
+
+    def write_table(self, table_name, mappings):
+        """
+        :param table_name: Name of the table to write.
+        :type table_name: str
+        :param mappings: (data, uuid) tuples to write for this table.
+        :type mappings: iterable of (str, str)
+        :return: Number of mappings written.
+        :rtype: int
+        """
+        if self._tables_written > 0:
+            self._f.write(", ")
+        self._f.write(f"{json.dumps(table_name)}: {{\"mappings\": {{")
+
+        mappings_written = 0
+        for data, uuid in mappings:
+            if mappings_written > 0:
+                self._f.write(", ")
+            self._f.write(f"{json.dumps(data)}: {json.dumps(uuid)}")
+            mappings_written += 1
+
+        self._f.write("}}")
+        self._tables_written += 1
+        return mappings_written
+
+    def close(self):
+        self._f.write("}")
+
+
+class JsonlExportWriter:
+    """
+    Writes uuid table mappings to a text stream as json lines, with one {"table_name", "data", "uuid"} object per
+    mapping. Unlike `JsonExportWriter`'s output, this can be read back one mapping at a time.
+
+    :param f: Text stream to write to.
+    :type f: file-like
+    """
+    def __init__(self, f):
+        self._f = f
+
+    def write_table(self, table_name, mappings):
+        """
+        :param table_name: Name of the table to write.
+        :type table_name: str
+        :param mappings: (data, uuid) tuples to write for this table.
+        :type mappings: iterable of (str, str)
+        :return: Number of mappings written.
+        :rtype: int
+        """
+        mappings_written = 0
+        for data, uuid in mappings:
+            self._f.write(json.dumps({"table_name": table_name, "data": data, "uuid": uuid}))
+            self._f.write("\n")
+            mappings_written += 1
+        return mappings_written
+
+    def close(self):
+        pass
+
+
+EXPORT_WRITERS = {
+    "json": JsonExportWriter,
+    "jsonl": JsonlExportWriter
+}
+
+
+def write_mappings_fragment(path, mappings):
+    """
+    Writes mappings to a temporary fragment file, as json lines of [data, uuid].
+
+    :param path: Path to write the fragment to.
+    :type path: str
+    :param mappings: (data, uuid) tuples to write.
+    :type mappings: iterable of (str, str)
+    :return: Number of mappings written.
+    :rtype: int
+    """
+    mappings_count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for data, uuid in mappings:
+            f.write(json.dumps([data, uuid]))
+            f.write("\n")
+            mappings_count += 1
+    return mappings_count
+
+
+def read_mappings_fragment(path):
+    """
+    :param path: Path to a fragment written by `write_mappings_fragment`.
+    :type path: str
+    :return: Generator of the (data, uuid) tuples in the fragment.
+    :rtype: iterator of (str, str)
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            data, uuid = json.loads(line)
+            yield data, uuid
+
+
+def export_tables(mappings_reader, writer, table_names, page_size=DEFAULT_PAGE_SIZE, max_workers=1,
+                  shards_per_table=1, filter_mappings=None):
+    """
+    Exports uuid tables, fetching up to `max_workers` tables or uuid ranges of tables from Firestore concurrently.
+
+    Each worker streams the mappings it fetches to a temporary fragment file on disk. As soon as all of a table's
+    fragments are complete, they are appended to the export and deleted, so tables are written in the order they
+    complete and memory use stays flat however large the tables are.
+
+    :param mappings_reader: Reader to fetch the mappings with.
+    :type mappings_reader: UuidTableMappingsReader
+    :param writer: Writer to write the export with, one of the `EXPORT_WRITERS`. The caller is responsible for
+                   closing this.
+    :type writer: JsonExportWriter | JsonlExportWriter
+    :param table_names: Names of the tables to export.
+    :type table_names: list of str
+    :param page_size: Number of mappings to fetch from Firestore at a time.
+    :type page_size: int
+    :param max_workers: Maximum number of fetches to run concurrently.
+    :type max_workers: int
+    :param shards_per_table: Number of uuid ranges to split each table into, so that large tables can be fetched by
+                             several workers at once.
+    :type shards_per_table: int
+    :param filter_mappings: Optional function which filters each table's fetched mappings down to the mappings to
+                            write, for example `src.incremental_export.SeenMappingsCache.filter_new_mappings`. This is
+                            only ever called from the calling thread.
+    :type filter_mappings: (function of (str, iterable of (str, str)) -> iterable of (str, str)) | None
+    :return: Number of mappings fetched and number of mappings written for each table.
+    :rtype: dict of str -> (int, int)
+    """
+    def fetch_shard(table_name, uuid_range, fragment_path):
+        start_time = time.perf_counter()
+        mappings_count = write_mappings_fragment(
+            fragment_path, mappings_reader.iter_mappings(table_name, page_size, uuid_range)
+        )
+        return mappings_count, start_time, time.perf_counter()
+
+    mappings_counts = dict()  # of table_name -> number of mappings fetched
+    export_counts = dict()  # of table_name -> (number of mappings fetched, number of mappings written)
+    with tempfile.TemporaryDirectory() as fragments_dir, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict()  # of future -> table_name
+        fragments = dict()  # of table_name -> list of fragment paths
+        shard_timings = dict()  # of table_name -> list of (start time, end time) of the completed shards
+        for table_index, table_name in enumerate(table_names):
+            uuid_ranges = mappings_reader.split_uuid_range(table_name, shards_per_table)
+            fragments[table_name] = []
+            shard_timings[table_name] = []
+            for shard_index, uuid_range in enumerate(uuid_ranges):
+                fragment_path = os.path.join(fragments_dir, f"{table_index}-{shard_index}.jsonl")
+                fragments[table_name].append(fragment_path)
+                futures[executor.submit(fetch_shard, table_name, uuid_range, fragment_path)] = table_name
+
+        try:
+            for future in as_completed(futures.keys()):
+                table_name = futures[future]
+                mappings_count, start_time, end_time = future.result()
+                mappings_counts[table_name] = mappings_counts.get(table_name, 0) + mappings_count
+                shard_timings[table_name].append((start_time, end_time))
+                if len(shard_timings[table_name]) < len(fragments[table_name]):
+                    continue
+
+                append_start_time = time.perf_counter()
+                mappings = chain.from_iterable(read_mappings_fragment(path) for path in fragments[table_name])
+                if filter_mappings is not None:
+                    mappings = filter_mappings(table_name, mappings)
+                export_counts[table_name] = (mappings_counts[table_name], writer.write_table(table_name, mappings))
+                for path in fragments[table_name]:
+                    os.remove(path)
+
+                fetch_start_time = min(start for start, _ in shard_timings[table_name])
+                fetch_end_time = max(end for _, end in shard_timings[table_name])
+                log.info(f"Exported table '{table_name}' ({len(fragments[table_name])} shard(s)): "
+                         f"fetched {mappings_counts[table_name]} mappings in "
+                         f"{fetch_end_time - fetch_start_time:.1f}s, wrote {export_counts[table_name][1]} mappings in "
+                         f"{time.perf_counter() - append_start_time:.1f}s")
+        except Exception:
+            for future in futures.keys():
+                future.cancel()
+            raise
+
+    return export_counts
@@ -7,6 +7,9 @@ from core_data_modules.util import TimeUtils
 from rapid_pro_tools.rapid_pro_client import RapidProClient
 from storage.google_cloud import google_cloud_utils
 
+from src.incremental_archive import ArchiveManifest, WatermarkTracker, incremental_get_kwargs
+from src.workspace_archive import ArchiveOutputs, write_streaming_archive, DEFAULT_MAX_CONCURRENT_RESOURCES
+
 log = Logger(__name__)
 
 if __name__ == "__main__":
@@ -17,6 +20,23 @@ if __name__ == "__main__":
                         help="tar.gzip file to write the exported data to")
     parser.add_argument("--gcs-upload-path",
                         help="GS URL to upload the exported tar.gzip to")
+    parser.add_argument("--streaming", const=True, default=False, action="store_const",
+                        help="Download the workspace's resources concurrently, streaming them into the tar.gzip and "
+                             "straight to the outputs as they arrive, rather than exporting everything to a "
+                             "temporary directory first. Each resource is archived as a series of JSONL files")
+    parser.add_argument("--max-concurrent-resources", type=int, default=DEFAULT_MAX_CONCURRENT_RESOURCES,
+                        help=f"When using --streaming, the maximum number of resources to download at once. "
+                             f"Defaults to {DEFAULT_MAX_CONCURRENT_RESOURCES}")
+    parser.add_argument("--incremental-manifest-path",
+                        help="JSON file recording the chain of incremental archives of this workspace. If this file "
+                             "doesn't exist, a full base archive is made and the file is created. Otherwise, only the "
+                             "contacts, runs, messages, broadcasts, flow starts and channel events created or "
+                             "modified since the last archive in the chain are archived, into a delta archive. "
+                             "Use consolidate_rapid_pro_archives.py to combine a chain into one full archive. "
+                             "Implies --streaming")
+    parser.add_argument("--full", const=True, default=False, action="store_const",
+                        help="When using --incremental-manifest-path, start a new chain with a full base archive even "
+                             "if the manifest already exists")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
                         help="Path to a Google Cloud service account credentials file to use to access the "
                              "credentials bucket")
@@ -28,6 +48,10 @@ if __name__ == "__main__":
 
     gzip_export_file_path = args.gzip_export_file_path
     gcs_upload_path = args.gcs_upload_path
+    streaming = args.streaming
+    max_concurrent_resources = args.max_concurrent_resources
+    incremental_manifest_path = args.incremental_manifest_path
+    full = args.full
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
     rapid_pro_domain = args.rapid_pro_domain
     rapid_pro_token_file_url = args.rapid_pro_token_file_url
@@ -36,6 +60,9 @@ if __name__ == "__main__":
         log.error(f"No output locations specified. Please provide at least one of --gzip-export-file-path or "
                   f"--gcs-upload-path")
         exit(1)
+    if full and incremental_manifest_path is None:
+        log.error("--full can only be used with --incremental-manifest-path")
+        exit(1)
 
     export_start_date = TimeUtils.utc_now_as_iso_string()
 
@@ -47,21 +74,67 @@ if __name__ == "__main__":
 
     rapid_pro = RapidProClient(rapid_pro_domain, rapid_pro_token)
 
-    with tempfile.TemporaryDirectory() as export_directory_path:
-        log.info(f"Downloading all data from the Rapid Pro workspace to temporary directory '{export_directory_path}'...")
-        rapid_pro.export_all_data(export_directory_path)
+    if incremental_manifest_path is not None:
+        manifest = None if full else ArchiveManifest.load(incremental_manifest_path)
+        outputs = ArchiveOutputs(google_cloud_credentials_file_path, gzip_export_file_path, gcs_upload_path)
+        archive_location = gcs_upload_path if gcs_upload_path is not None else gzip_export_file_path
+
+        if manifest is None:
+            archive_name = f"export-{export_start_date}"
+            log.info("Downloading all data from the Rapid Pro workspace into a new base archive...")
+            watermark_tracker = WatermarkTracker()
+            write_streaming_archive(rapid_pro.rapid_pro, outputs.writer, archive_name, max_concurrent_resources,
+                                    on_chunk_archived=watermark_tracker.on_chunk_archived)
+        else:
+            archive_name = f"delta-{export_start_date}"
+            log.info(f"Downloading the data changed since the last archive into a delta archive, from "
+                     f"watermarks {manifest.watermarks}...")
+            resource_get_kwargs = incremental_get_kwargs(manifest)
+            watermark_tracker = WatermarkTracker(
+                {resource: kwargs["after"] for resource, kwargs in resource_get_kwargs.items()})
+            write_streaming_archive(rapid_pro.rapid_pro, outputs.writer, archive_name, max_concurrent_resources,
+                                    resource_get_kwargs=resource_get_kwargs,
+                                    on_chunk_archived=watermark_tracker.on_chunk_archived)
+        outputs.close()
+
+        # Only record the archive in the manifest once it is complete, so that a failed run is retried from the same
+        # watermarks next time.
+        if manifest is None:
+            manifest = ArchiveManifest.for_base(archive_location, archive_name, watermark_tracker.to_dict())
+        else:
+            manifest.add_delta(archive_location, archive_name, watermark_tracker.to_dict())
+        manifest.save(incremental_manifest_path)
+        log.info(f"Updated the manifest at '{incremental_manifest_path}'. The chain now has {len(manifest.deltas)} "
+                 f"deltas since the base archive")
+    elif streaming:
+        outputs = ArchiveOutputs(google_cloud_credentials_file_path, gzip_export_file_path, gcs_upload_path)
+
+        log.info("Downloading all data from the Rapid Pro workspace...")
+        write_streaming_archive(rapid_pro.rapid_pro, outputs.writer, f"export-{export_start_date}",
+                                max_concurrent_resources)
+
+        # Only close the outputs once the archive is complete. If archiving failed, this isn't reached, and the
+        # resumable upload is never finalised, so no incomplete archive is ever created in GCS.
+        outputs.close()
+        log.info("Done")
+    else:
+        with tempfile.TemporaryDirectory() as export_directory_path:
+            log.info(f"Downloading all data from the Rapid Pro workspace to temporary directory "
+                     f"'{export_directory_path}'...")
+            rapid_pro.export_all_data(export_directory_path)
 
-        if gzip_export_file_path is None:
-            # The user didn't request a local export to their file system, so zip up the files to a location in the
-            # temporary directory ready for upload
-            gzip_export_file_path = f"{export_directory_path}/export.tar.gzip"
+            if gzip_export_file_path is None:
+                # The user didn't request a local export to their file system, so zip up the files to a location in
+                # the temporary directory ready for upload
+                gzip_export_file_path = f"{export_directory_path}/export.tar.gzip"
 
-        log.info(f"Zipping the exported data directory '{export_directory_path}' to '{gzip_export_file_path}'...")
-        with tarfile.open(gzip_export_file_path, "w:gz") as tar:
-            tar.add(export_directory_path, arcname=f"export-{export_start_date}")
+            log.info(f"Zipping the exported data directory '{export_directory_path}' to "
+                     f"'{gzip_export_file_path}'...")
+            with tarfile.open(gzip_export_file_path, "w:gz") as tar:
+                tar.add(export_directory_path, arcname=f"export-{export_start_date}")
 
-        if gcs_upload_path is not None:
-            log.info(f"Uploading the zipped file to {gcs_upload_path}...")
-            with open(gzip_export_file_path, "rb") as f:
-                google_cloud_utils.upload_file_to_blob(google_cloud_credentials_file_path, gcs_upload_path, f)
-            log.info("Done")
+            if gcs_upload_path is not None:
+                log.info(f"Uploading the zipped file to {gcs_upload_path}...")
+                with open(gzip_export_file_path, "rb") as f:
+                    google_cloud_utils.upload_file_to_blob(google_cloud_credentials_file_path, gcs_upload_path, f)
+                log.info("Done")
@@ -0,0 +1,66 @@
+import argparse
+import time
+
+from core_data_modules.logging import Logger
+
+from src.contact_writer import RapidProContactWriter
+from src.fake_rapid_pro import FakeRapidProServer
+
+log = Logger(__name__)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks writing contacts with RapidProContactWriter against a "
+                                                 "local fake Rapid Pro, which throttles writes above a rate limit. "
+                                                 "Runs once for each --max-concurrent-writes given, so that the "
+                                                 "throughput of the concurrent writer can be compared with writing "
+                                                 "one contact at a time")
+
+    parser.add_argument("--contacts", type=int, default=500,
+                        help="Number of contacts to write in each run. Defaults to 500")
+    parser.add_argument("--server-writes-per-second", type=float, default=50,
+                        help="Rate limit of the fake Rapid Pro, above which writes are throttled. Defaults to 50")
+    parser.add_argument("--server-latency-seconds", type=float, default=0.1,
+                        help="Number of seconds the fake Rapid Pro takes to respond to each write. Defaults to 0.1")
+    parser.add_argument("--retry-after-http-date", const=True, default=False, action="store_const",
+                        help="Make the fake Rapid Pro send Retry-After headers as HTTP-dates rather than seconds")
+    parser.add_argument("--max-concurrent-writes", type=int, nargs="+", default=[1, 4, 16],
+                        help="Maximum numbers of concurrent writes to benchmark. Defaults to 1 4 16")
+    parser.add_argument("--max-writes-per-second", type=float, default=100,
+                        help="Maximum rate for the writer to write at. This is set above the server's rate limit by "
+                             "default, so that the writer has to adapt to throttling. Defaults to 100")
+
+    args = parser.parse_args()
+
+    contacts_count = args.contacts
+    server_writes_per_second = args.server_writes_per_second
+    server_latency_seconds = args.server_latency_seconds
+    retry_after_http_date = args.retry_after_http_date
+    max_concurrent_writes_to_benchmark = args.max_concurrent_writes
+    max_writes_per_second = args.max_writes_per_second
+
+    contacts = [(f"tel:+2547{i:08d}", f"Contact {i}", {"district": str(i % 47), "gender": None})
+                for i in range(contacts_count)]
+
+    results = []
+    for max_concurrent_writes in max_concurrent_writes_to_benchmark:
+        server = FakeRapidProServer(server_writes_per_second, server_latency_seconds, retry_after_http_date)
+        server.start()
+        try:
+            writer = RapidProContactWriter(server.url, "fake-token", max_concurrent_writes, max_writes_per_second)
+            log.info(f"Writing {contacts_count} contacts with up to {max_concurrent_writes} concurrent writes...")
+            start = time.perf_counter()
+            writer.update_contacts(contacts)
+            duration_seconds = time.perf_counter() - start
+        finally:
+            server.stop()
+
+        assert len(server.contacts) == contacts_count, \
+            f"The fake Rapid Pro has {len(server.contacts)} contacts, but {contacts_count} were written"
+        results.append((max_concurrent_writes, duration_seconds, writer.token_bucket.rate, server.writes_throttled))
+
+    log.info(f"Results for {contacts_count} contacts, against a server limited to {server_writes_per_second} "
+             f"writes/s with {server_latency_seconds}s latency:")
+    for max_concurrent_writes, duration_seconds, final_rate, writes_throttled in results:
+        log.info(f"  {max_concurrent_writes} concurrent writes: {duration_seconds:.1f}s "
+                 f"({contacts_count / duration_seconds:.1f} writes/s), {writes_throttled} writes throttled, "
+                 f"final rate {final_rate:.1f} writes/s")
@@ -0,0 +1,80 @@
+import argparse
+import tempfile
+
+from core_data_modules.logging import Logger
+from core_data_modules.util import TimeUtils
+from storage.google_cloud import google_cloud_utils
+
+from src.incremental_archive import ArchiveManifest, consolidate_archives
+from src.workspace_archive import ArchiveOutputs
+
+log = Logger(__name__)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consolidates a chain of incremental Rapid Pro workspace archives, "
+                                                 "made by archive_rapid_pro_workspace.py --incremental-manifest-path, "
+                                                 "into a single full archive")
+
+    parser.add_argument("--gzip-export-file-path",
+                        help="tar.gzip file to write the consolidated archive to")
+    parser.add_argument("--gcs-upload-path",
+                        help="GS URL to upload the consolidated tar.gzip to")
+    parser.add_argument("--update-manifest", const=True, default=False, action="store_const",
+                        help="Replace the chain in the manifest with the consolidated archive, so that future deltas "
+                             "are based on it")
+    parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
+                        help="Path to a Google Cloud service account credentials file to use to access the "
+                             "archives bucket")
+    parser.add_argument("manifest_path", metavar="manifest-path",
+                        help="Path to the manifest of the chain of archives to consolidate")
+
+    args = parser.parse_args()
+
+    gzip_export_file_path = args.gzip_export_file_path
+    gcs_upload_path = args.gcs_upload_path
+    update_manifest = args.update_manifest
+    google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
+    manifest_path = args.manifest_path
+
+    if gzip_export_file_path is None and gcs_upload_path is None:
+        log.error(f"No output locations specified. Please provide at least one of --gzip-export-file-path or "
+                  f"--gcs-upload-path")
+        exit(1)
+
+    manifest = ArchiveManifest.load(manifest_path)
+    if manifest is None:
+        log.error(f"No manifest found at '{manifest_path}'")
+        exit(1)
+
+    consolidation_date = TimeUtils.utc_now_as_iso_string()
+    archive_locations = manifest.archive_locations_newest_first()
+    log.info(f"Consolidating {len(archive_locations)} archives...")
+
+    with tempfile.TemporaryDirectory() as download_directory_path:
+        archive_file_paths = []
+        for i, location in enumerate(archive_locations):
+            if location.startswith("gs://"):
+                archive_file_path = f"{download_directory_path}/archive-{i}.tar.gzip"
+                log.info(f"Downloading {location}...")
+                with open(archive_file_path, "wb") as f:
+                    google_cloud_utils.download_blob_to_file(google_cloud_credentials_file_path, location, f)
+                archive_file_paths.append(archive_file_path)
+            else:
+                archive_file_paths.append(location)
+
+        archive_files = [open(path, "rb") for path in archive_file_paths]
+        try:
+            archive_name = f"export-{consolidation_date}"
+            outputs = ArchiveOutputs(google_cloud_credentials_file_path, gzip_export_file_path, gcs_upload_path)
+            consolidate_archives(archive_files, outputs.writer, archive_name)
+            outputs.close()
+        finally:
+            for f in archive_files:
+                f.close()
+
+    if update_manifest:
+        archive_location = gcs_upload_path if gcs_upload_path is not None else gzip_export_file_path
+        manifest = ArchiveManifest.for_base(archive_location, archive_name, manifest.watermarks)
+        manifest.save(manifest_path)
+        log.info(f"Updated the manifest at '{manifest_path}' to use the consolidated archive as its base")
+    log.info("Done")
@@ -0,0 +1,85 @@
+#!/bin/bash
+
+set -e
+
+IMAGE_NAME=synchronise-contacts
+
+while [[ $# -gt 0 ]]; do
+    case "$1" in
+        -f)
+            FORCE="-f"
+            shift;;
+        --force)
+            FORCE="--force"
+            shift;;
+        --dry-run)
+            DRY_RUN="--dry-run"
+            shift;;
+        --workspaces-to-update)
+            WORKSPACES_TO_UPDATE="--workspaces-to-update $2"
+            shift
+            shift;;
+        --max-concurrent-writes)
+            MAX_CONCURRENT_WRITES="--max-concurrent-writes $2"
+            shift
+            shift;;
+        --max-writes-per-second)
+            MAX_WRITES_PER_SECOND="--max-writes-per-second $2"
+            shift
+            shift;;
+        --)
+            shift
+            break;;
+        *)
+            break;;
+    esac
+done
+
+# Check that the correct number of arguments were provided.
+if [[ $# -lt 6 || $(( $# % 2 )) -ne 0 ]]; then
+    echo "Usage: ./docker-run-synchronise-contacts-across-workspaces.sh [--force | -f] [--dry-run]
+    [--workspaces-to-update \"<workspace-number> ...\"]
+    [--max-concurrent-writes <max-concurrent-writes>] [--max-writes-per-second <max-writes-per-second>]
+    <google-cloud-credentials-file-path> <raw-data-log-directory>
+    <workspace-1-domain> <workspace-1-credentials-url> <workspace-2-domain> <workspace-2-credentials-url>
+    [<workspace-n-domain> <workspace-n-credentials-url> ...]"
+    exit
+fi
+
+# Assign the program arguments to bash variables.
+GOOGLE_CLOUD_CREDENTIALS_FILE_PATH=$1
+RAW_DATA_LOG_DIRECTORY=$2
+shift
+shift
+
+WORKSPACES=""
+while [[ $# -gt 0 ]]; do
+    WORKSPACES="$WORKSPACES --workspace \"$1\" \"$2\""
+    shift
+    shift
+done
+
+# Build an image for this pipeline stage.
+docker build -t "$IMAGE_NAME" .
+
+CMD="pipenv run python -u synchronise_contacts_across_workspaces.py $FORCE $DRY_RUN $WORKSPACES_TO_UPDATE \
+     $MAX_CONCURRENT_WRITES $MAX_WRITES_PER_SECOND $WORKSPACES \
+     /credentials/google-cloud-credentials.json /data/raw-data-logs
+"
+container="$(docker container create -w /app "$IMAGE_NAME" /bin/bash -c "$CMD")"
+echo "Created container $container"
+container_short_id=${container:0:7}
+
+# Copy input data into the container
+docker cp "$GOOGLE_CLOUD_CREDENTIALS_FILE_PATH" "$container:/credentials/google-cloud-credentials.json"
+
+# Run the container
+echo "Starting container $container_short_id"
+docker start -a -i "$container"
+
+# Copy the output data back out of the container
+echo "Copying $container_short_id:/data/raw-data-logs/. -> $RAW_DATA_LOG_DIRECTORY"
+docker cp "$container:/data/raw-data-logs/." "$RAW_DATA_LOG_DIRECTORY"
+
+# Tear down the container, now that all expected output files have been copied out successfully
+docker container rm "$container" >/dev/null
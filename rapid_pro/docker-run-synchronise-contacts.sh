@@ -19,6 +19,26 @@ while [[ $# -gt 0 ]]; do
             WORKSPACES_TO_UPDATE="--workspaces-to-update $2"
             shift
             shift;;
+        --incremental-state-file-path)
+            INCREMENTAL_STATE_FILE_PATH="$2"
+            shift
+            shift;;
+        --full-reconcile-interval-hours)
+            FULL_RECONCILE_INTERVAL_HOURS="--full-reconcile-interval-hours $2"
+            shift
+            shift;;
+        --merge-base-file-path)
+            MERGE_BASE_FILE_PATH="$2"
+            shift
+            shift;;
+        --max-concurrent-writes)
+            MAX_CONCURRENT_WRITES="--max-concurrent-writes $2"
+            shift
+            shift;;
+        --max-writes-per-second)
+            MAX_WRITES_PER_SECOND="--max-writes-per-second $2"
+            shift
+            shift;;
         --)
             shift
             break;;
@@ -30,6 +50,10 @@ done
 # Check that the correct number of arguments were provided.
 if [[ $# -ne 6 ]]; then
     echo "Usage: ./docker-run.sh [--force | -f] [--dry-run] [--workspaces-to-update {1, 2, both}]
+    [--incremental-state-file-path <incremental-state-file-path>]
+    [--full-reconcile-interval-hours <full-reconcile-interval-hours>]
+    [--merge-base-file-path <merge-base-file-path>]
+    [--max-concurrent-writes <max-concurrent-writes>] [--max-writes-per-second <max-writes-per-second>]
     <google-cloud-credentials-file-path> <workspace-1-domain> <workspace-1-credentials-url>
     <workspace-2-domain> <workspace-2-credentials-url> <raw-data-log-directory>"
     exit
@@ -43,10 +67,19 @@ WORKSPACE_2_DOMAIN=$4
 WORKSPACE_2_CREDENTIALS_URL=$5
 RAW_DATA_LOG_DIRECTORY=$6
 
+if [[ "$INCREMENTAL_STATE_FILE_PATH" != "" ]]; then
+    INCREMENTAL_STATE_ARG="--incremental-state-path /data/sync-state.sqlite"
+fi
+if [[ "$MERGE_BASE_FILE_PATH" != "" ]]; then
+    MERGE_BASE_ARG="--merge-base-path /data/merge-base.sqlite"
+fi
+
 # Build an image for this pipeline stage.
 docker build -t "$IMAGE_NAME" .
 
 CMD="pipenv run python -u synchronise_contacts.py $FORCE $DRY_RUN $WORKSPACES_TO_UPDATE \
+     $INCREMENTAL_STATE_ARG $FULL_RECONCILE_INTERVAL_HOURS $MERGE_BASE_ARG \
+     $MAX_CONCURRENT_WRITES $MAX_WRITES_PER_SECOND \
      /credentials/google-cloud-credentials.json \
      \"$WORKSPACE_1_DOMAIN\" \"$WORKSPACE_1_CREDENTIALS_URL\" \"$WORKSPACE_2_DOMAIN\" \"$WORKSPACE_2_CREDENTIALS_URL\" \
      /data/raw-data-logs
@@ -57,6 +90,12 @@ container_short_id=${container:0:7}
 
 # Copy input data into the container
 docker cp "$GOOGLE_CLOUD_CREDENTIALS_FILE_PATH" "$container:/credentials/google-cloud-credentials.json"
+if [[ "$INCREMENTAL_STATE_FILE_PATH" != "" && -f "$INCREMENTAL_STATE_FILE_PATH" ]]; then
+    docker cp "$INCREMENTAL_STATE_FILE_PATH" "$container:/data/sync-state.sqlite"
+fi
+if [[ "$MERGE_BASE_FILE_PATH" != "" && -f "$MERGE_BASE_FILE_PATH" ]]; then
+    docker cp "$MERGE_BASE_FILE_PATH" "$container:/data/merge-base.sqlite"
+fi
 
 # Run the container
 echo "Starting container $container_short_id"
@@ -66,5 +105,17 @@ docker start -a -i "$container"
 echo "Copying $container_short_id:/data/raw-data-logs/. -> $RAW_DATA_LOG_DIRECTORY"
 docker cp "$container:/data/raw-data-logs/." "$RAW_DATA_LOG_DIRECTORY"
 
+if [[ "$INCREMENTAL_STATE_FILE_PATH" != "" ]]; then
+    echo "Copying $container_short_id:/data/sync-state.sqlite -> $INCREMENTAL_STATE_FILE_PATH"
+    mkdir -p "$(dirname "$INCREMENTAL_STATE_FILE_PATH")"
+    docker cp "$container:/data/sync-state.sqlite" "$INCREMENTAL_STATE_FILE_PATH"
+fi
+
+if [[ "$MERGE_BASE_FILE_PATH" != "" ]]; then
+    echo "Copying $container_short_id:/data/merge-base.sqlite -> $MERGE_BASE_FILE_PATH"
+    mkdir -p "$(dirname "$MERGE_BASE_FILE_PATH")"
+    docker cp "$container:/data/merge-base.sqlite" "$MERGE_BASE_FILE_PATH"
+fi
+
 # Tear down the container, now that all expected output files have been copied out successfully
 docker container rm "$container" >/dev/null
@@ -1,11 +1,13 @@
 import argparse
 import csv
+import json
+import os
 
 from core_data_modules.logging import Logger
 from core_data_modules.util import TimeUtils
 from rapid_pro_tools.rapid_pro_client import RapidProClient
+from dateutil.parser import isoparse
 from storage.google_cloud import google_cloud_utils
-from temba_client.v2 import Message
 
 log = Logger(__name__)
 
@@ -13,6 +15,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Downloads all inbound messages from Rapid Pro and exports "
                                                  "the phone numbers we heard from")
 
+    parser.add_argument("--watermark-cache-path",
+                        help="JSON file to record the latest inbound message processed in. If this file exists, only "
+                             "the messages received since the last run are downloaded, and the phone numbers they "
+                             "are from are merged into the existing output CSV")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
                         help="Path to a Google Cloud service account credentials file to use to access the "
                              "credentials bucket")
@@ -28,6 +34,7 @@ if __name__ == "__main__":
     rapid_pro_domain = args.rapid_pro_domain
     rapid_pro_token_file_url = args.rapid_pro_token_file_url
     output_file_path = args.output_file_path
+    watermark_cache_path = args.watermark_cache_path
 
     log.info("Downloading the Rapid Pro access token...")
     rapid_pro_token = google_cloud_utils.download_blob_to_string(
@@ -35,21 +42,61 @@ if __name__ == "__main__":
 
     rapid_pro = RapidProClient(rapid_pro_domain, rapid_pro_token)
 
-    all_messages = rapid_pro.get_raw_messages()
-    inbound_messages = [msg for msg in all_messages if msg.direction == "in"]
-
-    inbound_phone_numbers = set()
-    for msg in inbound_messages:
-        if msg.urn.startswith("tel:"):
-            phone_number = msg.urn.split(":")[1]
-            inbound_phone_numbers.add(phone_number)
+    # Load the numbers exported previously, if this is an incremental run. The watermark is only trusted if the
+    # output it was recorded with still exists.
+    inbound_phone_numbers = dict()  # of phone number -> name
+    watermark = None
+    if watermark_cache_path is not None and os.path.exists(watermark_cache_path) and \
+            os.path.exists(output_file_path):
+        with open(watermark_cache_path) as f:
+            cache = json.load(f)
+        if cache["rapid_pro_domain"] == rapid_pro_domain:
+            watermark = isoparse(cache["latest_created_on"])
+            with open(output_file_path) as f:
+                for row in csv.DictReader(f):
+                    inbound_phone_numbers[row["URN:Tel"]] = row["Name"]
+            log.info(f"Loaded {len(inbound_phone_numbers)} inbound phone numbers from {output_file_path}. "
+                     f"Downloading the inbound messages received since {watermark.isoformat()}...")
         else:
-            log.warning(f"Skipped non-telephone URN type {msg.urn.split(':')[0]}")
+            log.warning(f"Watermark cache {watermark_cache_path} is for a different Rapid Pro server "
+                        f"({cache['rapid_pro_domain']}), so ignoring it")
+    if watermark is None:
+        log.info("Downloading all inbound messages...")
+
+    # Only request incoming messages, so the outbound messages aren't downloaded at all, and process each page of
+    # messages as it arrives rather than holding every message in memory.
+    # The `after` filter is inclusive, so the message at the watermark is downloaded again, which is harmless.
+    query = rapid_pro.rapid_pro.get_messages(folder="incoming", after=watermark)
+    existing_phone_numbers = len(inbound_phone_numbers)
+    downloaded = 0
+    latest_created_on = watermark
+    for page in query.iterfetches(retry_on_rate_exceed=True):
+        for msg in page:
+            downloaded += 1
+            if latest_created_on is None or msg.created_on > latest_created_on:
+                latest_created_on = msg.created_on
+            if msg.direction != "in":
+                continue
+            if msg.urn.startswith("tel:"):
+                phone_number = msg.urn.split(":")[1]
+                inbound_phone_numbers.setdefault(phone_number, "")
+            else:
+                log.warning(f"Skipped non-telephone URN type {msg.urn.split(':')[0]}")
+        log.info(f"Downloaded {downloaded} inbound messages so far")
+    log.info(f"Downloaded {downloaded} inbound messages, from {len(inbound_phone_numbers) - existing_phone_numbers} "
+             f"new phone numbers")
 
     log.warning(f"Exporting {len(inbound_phone_numbers)} inbound phone numbers to {output_file_path}...")
-    with open(output_file_path, "w") as f:
+    with open(f"{output_file_path}.tmp", "w") as f:
         writer = csv.DictWriter(f, fieldnames=["URN:Tel", "Name"])
         writer.writeheader()
-        for number in inbound_phone_numbers:
-            writer.writerow({"URN:Tel": number, "Name": ""})
+        for number, name in inbound_phone_numbers.items():
+            writer.writerow({"URN:Tel": number, "Name": name})
+    os.replace(f"{output_file_path}.tmp", output_file_path)
     log.info(f"Done. Wrote {len(inbound_phone_numbers)} inbound phone numbers to {output_file_path}")
+
+    # Only advance the watermark once the output has been written, so that a failed run is retried from the same point
+    if watermark_cache_path is not None and latest_created_on is not None:
+        with open(watermark_cache_path, "w") as f:
+            json.dump({"rapid_pro_domain": rapid_pro_domain, "latest_created_on": latest_created_on.isoformat()}, f)
+        log.info(f"Updated the watermark cache at {watermark_cache_path} to {latest_created_on.isoformat()}")
@@ -0,0 +1,55 @@
+import json
+
+from core_data_modules.logging import Logger
+
+from src.contacts import normalise_contacts
+
+log = Logger(__name__)
+
+PROGRESS_LOG_INTERVAL = 10000
+
+
+def download_contacts(rapid_pro_client, raw_log_file, last_modified_after_inclusive=None, invalid_uuids=None):
+    """
+    Downloads contacts from a workspace a page at a time, logging each raw contact to a JSONL file and keeping only a
+    compact normalised record of each valid contact.
+
+    Unlike `RapidProClient.get_raw_contacts`, this never holds more than one page of raw contacts in memory at once.
+
+    :param rapid_pro_client: Client for the workspace to download from.
+    :type rapid_pro_client: rapid_pro_tools.rapid_pro_client.RapidProClient
+    :param raw_log_file: File to write each raw contact to, as one serialized contact per line.
+    :type raw_log_file: file-like
+    :param last_modified_after_inclusive: Time to download the contacts modified at or after, or None to download
+                                          every contact.
+    :type last_modified_after_inclusive: datetime.datetime | None
+    :param invalid_uuids: List to append the UUIDs of the downloaded contacts that aren't valid to, or None.
+                          See `src.contacts.is_valid_contact`.
+    :type invalid_uuids: list of str | None
+    :return: Tuple of (records of the valid contacts keyed by URN, number of contacts downloaded,
+                       latest `modified_on` of the contacts downloaded or None if no contacts were downloaded).
+    :rtype: (dict of str -> src.contacts.ContactRecord, int, datetime.datetime | None)
+    """
+    records = dict()
+    downloaded = 0
+    latest_modified_on = None
+    pages = rapid_pro_client.rapid_pro.get_contacts(after=last_modified_after_inclusive) \
+        .iterfetches(retry_on_rate_exceed=True)
+    for page in pages:
+        for contact in page:
+            raw_log_file.write(json.dumps(contact.serialize()))
+            raw_log_file.write("\n")
+            if latest_modified_on is None or contact.modified_on > latest_modified_on:
+                latest_modified_on = contact.modified_on
+
+        page_records = normalise_contacts(page)
+        if invalid_uuids is not None:
+            valid_uuids = {record.uuid for record in page_records.values()}
+            invalid_uuids.extend(contact.uuid for contact in page if contact.uuid not in valid_uuids)
+        records.update(page_records)
+
+        if (downloaded + len(page)) // PROGRESS_LOG_INTERVAL > downloaded // PROGRESS_LOG_INTERVAL:
+            log.info(f"Downloaded {downloaded + len(page)} contacts so far...")
+        downloaded += len(page)
+
+    return records, downloaded, latest_modified_on
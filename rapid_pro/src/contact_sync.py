@@ -0,0 +1,309 @@
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+from core_data_modules.logging import Logger
+
+from src.three_way_merge import NAME_KEY, merge_contacts
+
+log = Logger(__name__)
+
+
+def workspace_indices_to_update(workspaces_to_update):
+    """
+    :param workspaces_to_update: Value of synchronise_contacts.py's --workspaces-to-update argument.
+    :type workspaces_to_update: str
+    :return: Indices of the workspaces that may be updated (0 for workspace 1, 1 for workspace 2).
+    :rtype: set of int
+    """
+    return {"1": {0}, "2": {1}, "both": {0, 1}}[workspaces_to_update]
+
+
+class ContactUpdate:
+    """
+    A planned write of a contact to a workspace.
+
+    :param target: Index of the workspace to write to.
+    :type target: int
+    :param record: Version of the contact to write.
+    :type record: src.contacts.ContactRecord
+    :param is_new: Whether the contact doesn't exist in the target workspace yet.
+    :type is_new: bool
+    :param fields: The only fields to write, with value None for fields to clear, or None to write all of the record's
+                   fields and clear every other field.
+    :type fields: dict of str -> (str | None) | None
+    """
+    __slots__ = ("target", "record", "is_new", "fields")
+
+    def __init__(self, target, record, is_new, fields=None):
+        self.target = target
+        self.record = record
+        self.is_new = is_new
+        self.fields = fields
+
+
+class SyncSummary:
+    """
+    Counts of the actions taken by a contact synchronisation, per workspace.
+    """
+    def __init__(self):
+        self.new_contact_fields = [0, 0]
+        self.new_contacts = [0, 0]
+        self.updated_contacts = [0, 0]
+        self.identical_contacts = 0
+        self.skipped_contacts = 0
+        self.merge_conflicts = 0
+
+    def log(self, workspace_names, dry_run, force_update, three_way_merge=False):
+        workspace_1_name, workspace_2_name = workspace_names
+        log.info(f"Contacts sync complete. Summary of actions{' (dry run)' if dry_run else ''}:")
+        log.info(f"Created {self.new_contact_fields[0]} new contact fields in workspace {workspace_1_name}")
+        log.info(f"Created {self.new_contact_fields[1]} new contact fields in workspace {workspace_2_name}")
+        log.info(f"Created {self.new_contacts[0]} new contacts in workspace {workspace_1_name} using the version in "
+                 f"{workspace_2_name}")
+        log.info(f"Created {self.new_contacts[1]} new contacts in workspace {workspace_2_name} using the version in "
+                 f"{workspace_1_name}")
+        if three_way_merge:
+            log.info(f"Merged changes into {self.updated_contacts[0]} contacts in workspace {workspace_1_name} from "
+                     f"workspace {workspace_2_name}")
+            log.info(f"Merged changes into {self.updated_contacts[1]} contacts in workspace {workspace_2_name} from "
+                     f"workspace {workspace_1_name}")
+            if force_update:
+                log.info(f"Resolved {self.merge_conflicts} conflicting field changes using the newer version")
+            else:
+                log.info(f"Skipped {self.skipped_contacts} contacts that had conflicting changes in both workspaces")
+        elif force_update:
+            log.info(f"Overwrote {self.updated_contacts[0]} contacts in workspace {workspace_1_name} with the newer "
+                     f"version in workspace {workspace_2_name}")
+            log.info(f"Overwrote {self.updated_contacts[1]} contacts in workspace {workspace_2_name} with the newer "
+                     f"version in workspace {workspace_1_name}")
+        else:
+            log.info(f"Skipped {self.skipped_contacts} contacts that differed between the workspaces")
+        log.info(f"Skipped {self.identical_contacts} contacts that were identical in both workspaces")
+
+
+def synchronise_fields(workspaces, workspace_names, workspace_fields, workspaces_to_update, dry_run, summary):
+    """
+    Creates the contact fields that exist in one workspace but not the other.
+
+    :param workspaces: Clients for the two workspaces. These may be None in dry-run mode.
+    :type workspaces: list of (rapid_pro_tools.rapid_pro_client.RapidProClient | None)
+    :param workspace_names: Names of the two workspaces.
+    :type workspace_names: list of str
+    :param workspace_fields: Fields in each of the two workspaces.
+    :type workspace_fields: list of list of temba_client.v2.types.Field
+    :param workspaces_to_update: Value of the --workspaces-to-update argument.
+    :type workspaces_to_update: str
+    :param dry_run: Whether to only log the fields that would be created.
+    :type dry_run: bool
+    :param summary: Summary to count the created fields in.
+    :type summary: SyncSummary
+    """
+    for target in sorted(workspace_indices_to_update(workspaces_to_update), reverse=True):
+        source = 1 - target
+        log.info(f"Synchronising fields from {workspace_names[source]} to {workspace_names[target]}...")
+        target_field_keys = {f.key for f in workspace_fields[target]}
+        for field in workspace_fields[source]:
+            if field.key not in target_field_keys:
+                summary.new_contact_fields[target] += 1
+                if dry_run:
+                    log.info(f"Would create field '{field.label}'")
+                    continue
+                workspaces[target].create_field(field.label, field.key)
+    log.info("Contact fields synchronised")
+
+
+def plan_contact_updates(workspace_names, workspace_contacts, urns, force_update, workspaces_to_update, summary,
+                         merge_base_store=None):
+    """
+    Compares contacts between two workspaces, and plans the writes needed to synchronise them.
+
+    Contacts present in only one workspace are planned to be created in the other. Contacts which differ between the
+    workspaces are only planned to be overwritten if `force_update` is set, in which case the most recently modified
+    version is written to the other workspace.
+    IMPORTANT: If the same contact has been changed on both Rapid Pro workspaces since the last sync was performed,
+               the older changes will be overwritten.
+
+    :param workspace_names: Names of the two workspaces.
+    :type workspace_names: list of str
+    :param workspace_contacts: Contacts in each of the two workspaces, keyed by URN.
+    :type workspace_contacts: list of (dict of str -> src.contacts.ContactRecord)
+    :param urns: URNs to compare, or None to compare every URN in either workspace.
+    :type urns: iterable of str | None
+    :param force_update: Whether to overwrite contacts which differ between the workspaces.
+    :type force_update: bool
+    :param workspaces_to_update: Value of the --workspaces-to-update argument.
+    :type workspaces_to_update: str
+    :param summary: Summary to count the planned actions in.
+    :type summary: SyncSummary
+    :param merge_base_store: Store of the versions of contacts at the end of the last successful sync, or None.
+                             If provided, contacts which differ are three-way merged against their stored version, and
+                             only the fields that changed are written to each workspace. Contacts with conflicting
+                             changes are only merged if `force_update` is set, in which case the conflicting fields
+                             take the value from the most recently modified version. The versions of the contacts that
+                             will be identical in both workspaces once the planned updates are applied are set in the
+                             store. The caller is responsible for only committing the store if the updates are applied
+                             successfully.
+    :type merge_base_store: src.three_way_merge.ContactMergeBaseStore | None
+    :return: The planned updates.
+    :rtype: list of ContactUpdate
+    """
+    targets = workspace_indices_to_update(workspaces_to_update)
+    workspace_1_contacts, workspace_2_contacts = workspace_contacts
+    workspace_1_name, workspace_2_name = workspace_names
+    if urns is None:
+        urns = workspace_1_contacts.keys() | workspace_2_contacts.keys()
+
+    urns_only_in_workspace = [[], []]
+    urns_in_both_workspaces = []
+    for urn in urns:
+        in_workspace_1 = urn in workspace_1_contacts
+        in_workspace_2 = urn in workspace_2_contacts
+        if in_workspace_1 and in_workspace_2:
+            urns_in_both_workspaces.append(urn)
+        elif in_workspace_1:
+            urns_only_in_workspace[0].append(urn)
+        elif in_workspace_2:
+            urns_only_in_workspace[1].append(urn)
+
+    updates = []
+
+    # Plan to add contacts present in one workspace but not the other
+    for target in sorted(targets, reverse=True):
+        source = 1 - target
+        for i, urn in enumerate(urns_only_in_workspace[source]):
+            record = workspace_contacts[source][urn]
+            log.info(f"Adding new contacts to {workspace_names[target]}: "
+                     f"{i + 1}/{len(urns_only_in_workspace[source])} "
+                     f"(Rapid Pro UUID '{record.uuid}' in {workspace_names[source]})")
+            summary.new_contacts[target] += 1
+            updates.append(ContactUpdate(target, record, is_new=True))
+            if merge_base_store is not None:
+                merge_base_store.set_base(record)
+
+    # Plan to update contacts present in both workspaces
+    urns_in_both_workspaces.sort()
+    for i, urn in enumerate(urns_in_both_workspaces):
+        contact_v1 = workspace_1_contacts[urn]
+        contact_v2 = workspace_2_contacts[urn]
+        progress_text = f"Synchronising contacts in both workspaces {i + 1}/{len(urns_in_both_workspaces)}"
+        uuids_text = f"(Rapid Pro UUIDs are '{contact_v1.uuid}' in {workspace_1_name}; " \
+                     f"'{contact_v2.uuid}' in {workspace_2_name})"
+
+        if contact_v1.has_same_data(contact_v2):
+            log.debug(f"{progress_text}: Contacts identical. {uuids_text}")
+            summary.identical_contacts += 1
+            if merge_base_store is not None:
+                merge_base_store.set_base(contact_v1)
+            continue
+
+        if merge_base_store is not None:
+            merge = merge_contacts(merge_base_store.get_base(urn), contact_v1, contact_v2)
+            if len(merge.conflicts) > 0:
+                if not force_update:
+                    log.warning(f"{progress_text}: Contacts have conflicting changes to {merge.conflicts}, but not "
+                                f"merging. Use --force to resolve conflicts with the latest version. {uuids_text}")
+                    summary.skipped_contacts += 1
+                    continue
+                summary.merge_conflicts += len(merge.conflicts)
+
+            in_sync_after_updates = True
+            for target, contact in enumerate([contact_v1, contact_v2]):
+                if not merge.differs_from(contact):
+                    continue
+                if target not in targets:
+                    in_sync_after_updates = False
+                    continue
+                changed_fields = merge.changed_fields(contact)
+                changed_keys = list(changed_fields) + ([NAME_KEY] if merge.record.name != contact.name else [])
+                log.info(f"{progress_text}: Contacts differ, merging changes to {sorted(changed_keys)} into the "
+                         f"contact in {workspace_names[target]}. {uuids_text}")
+                summary.updated_contacts[target] += 1
+                updates.append(ContactUpdate(target, merge.record, is_new=False, fields=changed_fields))
+
+            if in_sync_after_updates:
+                merge_base_store.set_base(merge.record)
+            continue
+
+        # Contacts differ
+        if not force_update:
+            log.warning(f"{progress_text}: Contacts differ, but not overwriting. Use --force to write the latest "
+                        f"everywhere. {uuids_text}")
+            summary.skipped_contacts += 1
+            continue
+
+        # Assume the most recent contact is correct
+        if contact_v1.modified_on > contact_v2.modified_on:
+            source, target = 0, 1
+        else:
+            source, target = 1, 0
+        if target not in targets:
+            continue
+
+        log.info(f"{progress_text}: Contacts differ, overwriting the contact in {workspace_names[target]} with the "
+                 f"more recent one in {workspace_names[source]}. {uuids_text}")
+        summary.updated_contacts[target] += 1
+        updates.append(ContactUpdate(target, workspace_contacts[source][urn], is_new=False))
+
+    return updates
+
+
+def find_unresolved_urns(workspace_contacts, urns, updates):
+    """
+    Finds the contacts that will still differ between the workspaces once the planned updates are applied, for
+    example because they differed and weren't overwritten, or because they needed writing to a workspace that isn't
+    being updated.
+
+    :param workspace_contacts: Contacts in each of the workspaces, keyed by URN.
+    :type workspace_contacts: list of (dict of str -> src.contacts.ContactRecord)
+    :param urns: URNs that were compared, or None if every URN in any workspace was compared.
+    :type urns: iterable of str | None
+    :param updates: The planned updates.
+    :type updates: iterable of ContactUpdate
+    :return: URNs of the contacts which will still be missing from, or differ in, any of the workspaces.
+    :rtype: set of str
+    """
+    if urns is None:
+        urns = set().union(*(contacts.keys() for contacts in workspace_contacts))
+
+    updated_versions = dict()  # of (target, urn) -> the version of the contact the target will have after updating
+    for update in updates:
+        updated_versions[(update.target, update.record.urn)] = update.record
+
+    unresolved_urns = set()
+    for urn in urns:
+        versions = [updated_versions.get((i, urn), contacts.get(urn)) for i, contacts in enumerate(workspace_contacts)]
+        if None in versions or not all(version.has_same_data(versions[0]) for version in versions[1:]):
+            unresolved_urns.add(urn)
+    return unresolved_urns
+
+
+def apply_contact_updates(writers, updates, field_keys):
+    """
+    Writes planned contact updates to their target workspaces, writing to each workspace concurrently.
+
+    If the writes to any workspace fail, the writes to every other workspace are stopped too, and the first failure is
+    raised.
+
+    :param writers: Writers for each of the workspaces.
+    :type writers: list of src.contact_writer.RapidProContactWriter
+    :param updates: Updates to apply.
+    :type updates: iterable of ContactUpdate
+    :param field_keys: Keys of all the contact fields in every workspace. Fields the updated contacts don't have a value
+                       for are cleared in the target workspace, unless the update specifies the only fields to write.
+    :type field_keys: set of str
+    """
+    workspace_writes = [[] for _ in writers]
+    for update in updates:
+        fields = update.record.padded_fields(field_keys) if update.fields is None else update.fields
+        workspace_writes[update.target].append((update.record.urn, update.record.name, fields))
+
+    with ThreadPoolExecutor(max_workers=len(writers)) as executor:
+        futures = [executor.submit(writer.update_contacts, writes) for writer, writes in zip(writers, workspace_writes)]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        failed = [future for future in futures if future in done and future.exception() is not None]
+        if len(failed) > 0:
+            for writer in writers:
+                writer.stop()
+            # Raise the original failure, not the failures it caused by stopping the other writers
+            failed[0].result()
+        for future in futures:
+            future.result()
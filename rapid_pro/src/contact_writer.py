@@ -0,0 +1,269 @@
+import math
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+DEFAULT_MAX_CONCURRENT_WRITES = 4
+DEFAULT_MAX_WRITES_PER_SECOND = 10
+
+
+def parse_retry_after(value, default_seconds):
+    """
+    Parses the value of a Retry-After response header, which may be either a number of seconds or an HTTP-date.
+
+    :param value: Value of the header, or None if the response didn't have one.
+    :type value: str | None
+    :param default_seconds: Number of seconds to return if the value is missing or can't be parsed.
+    :type default_seconds: float
+    :return: Number of seconds to wait before retrying. This is never negative.
+    :rtype: float
+    """
+    if value is None:
+        return default_seconds
+    value = value.strip()
+    try:
+        seconds = float(value)
+        if math.isfinite(seconds):
+            return max(0.0, seconds)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        log.warning(f"Could not parse Retry-After header '{value}'; waiting {default_seconds}s")
+        return default_seconds
+    if retry_at.tzinfo is None:
+        # HTTP-dates are always in GMT
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket, which limits the rate of requests to a server and adapts that rate to the server's
+    throttling.
+
+    The rate is halved each time the server throttles a request, and creeps back up towards `max_rate` as requests
+    succeed, so the bucket settles just under whatever rate the server will accept.
+
+    :param max_rate: Maximum number of requests to allow per second.
+    :type max_rate: float
+    :param min_rate: Rate to never slow below, in requests per second.
+    :type min_rate: float
+    """
+    def __init__(self, max_rate, min_rate=0.1):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+
+        self._lock = threading.Lock()
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(max(self.rate, 1.0), self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self):
+        """
+        Blocks until a request may be made.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait_seconds = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait_seconds = (1 - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+    def on_throttled(self, retry_after_seconds):
+        """
+        Slows the bucket down after the server refused a request for exceeding its rate limit.
+
+        :param retry_after_seconds: Number of seconds the server asked us to wait before retrying.
+        :type retry_after_seconds: float
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # Only slow down once for a burst of requests throttled together
+            if now >= self._paused_until:
+                self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+            self._paused_until = max(self._paused_until, now + retry_after_seconds)
+
+
+class RapidProContactWriter:
+    """
+    Writes contacts to a Rapid Pro workspace from a bounded pool of threads, at a rate limited by a `TokenBucket`
+    which adapts to the server's 429 responses.
+
+    This talks to the Rapid Pro contacts API directly, rather than through a RapidProClient, so that the throttling
+    response headers are available to tune the write rate with.
+
+    :param domain: Domain that the workspace is running on. Domains starting with "http://" or "https://" are used as
+                   the server's base URL as-is, for example to write to a local fake Rapid Pro.
+    :type domain: str
+    :param token: Organisation access token for authenticating to the workspace.
+    :type token: str
+    :param max_concurrent_writes: Maximum number of writes to have in flight at once.
+    :type max_concurrent_writes: int
+    :param max_writes_per_second: Maximum rate to write at.
+    :type max_writes_per_second: float
+    :param max_attempts: Maximum number of times to attempt each write before giving up, when the attempts fail with
+                         a connection or server error.
+    :type max_attempts: int
+    :param max_throttled_attempts: Maximum number of times each write may be throttled before giving up. This is
+                                   separate from, and much larger than, `max_attempts`, because throttling is expected
+                                   while the token bucket is finding the server's rate limit.
+    :type max_throttled_attempts: int
+    :param initial_backoff_seconds: Number of seconds to wait before retrying a write that failed with a server error.
+                                    This doubles after each subsequent failure.
+    :type initial_backoff_seconds: float
+    """
+    def __init__(self, domain, token, max_concurrent_writes=DEFAULT_MAX_CONCURRENT_WRITES,
+                 max_writes_per_second=DEFAULT_MAX_WRITES_PER_SECOND, max_attempts=6, max_throttled_attempts=100,
+                 initial_backoff_seconds=1):
+        base_url = domain if domain.startswith(("http://", "https://")) else f"https://{domain}"
+        self._contacts_url = f"{base_url.rstrip('/')}/api/v2/contacts.json"
+        self._token = token
+        self.max_concurrent_writes = max_concurrent_writes
+        self.max_attempts = max_attempts
+        self.max_throttled_attempts = max_throttled_attempts
+        self.initial_backoff_seconds = initial_backoff_seconds
+        self.token_bucket = TokenBucket(max_writes_per_second)
+        self._thread_local = threading.local()
+        self._stopped = threading.Event()
+
+    def _get_session(self):
+        # requests Sessions aren't guaranteed to be thread-safe, so give each thread its own
+        if not hasattr(self._thread_local, "session"):
+            session = requests.Session()
+            session.headers["Authorization"] = f"Token {self._token}"
+            self._thread_local.session = session
+        return self._thread_local.session
+
+    def stop(self):
+        """
+        Stops this writer from starting any more writes, for example because writes to another workspace failed.
+
+        Writes in progress stop at their next attempt, failing with a RuntimeError, and any later calls to
+        `update_contact` or `update_contacts` fail straight away.
+        """
+        self._stopped.set()
+
+    def _raise_if_stopped(self):
+        if self._stopped.is_set():
+            raise RuntimeError("Stopped writing contacts, because another write failed")
+
+    def update_contact(self, urn, name, fields):
+        """
+        Updates the contact with the given URN, creating it if it doesn't exist, retrying if the server throttles the
+        request or fails.
+
+        :param urn: URN of the contact to update.
+        :type urn: str
+        :param name: Name to set.
+        :type name: str | None
+        :param fields: Contact field values to set. Fields with value None are cleared.
+        :type fields: dict of str -> (str | None)
+        """
+        session = self._get_session()
+        backoff_seconds = self.initial_backoff_seconds
+        # Throttled requests are counted separately from failed ones: a 429 only means the server wants us to slow
+        # down, so it shouldn't use up the attempts allowed for writes the server failed to make.
+        failed_attempts = 0
+        throttled_attempts = 0
+        while True:
+            self._raise_if_stopped()
+            self.token_bucket.acquire()
+            try:
+                response = session.post(self._contacts_url, params={"urn": urn},
+                                        json={"name": name, "fields": fields})
+            except requests.ConnectionError as e:
+                failed_attempts += 1
+                if failed_attempts >= self.max_attempts:
+                    raise
+                log.warning(f"Failed to connect to Rapid Pro ({e}); retrying in {backoff_seconds}s...")
+                self._stopped.wait(backoff_seconds)
+                backoff_seconds *= 2
+                continue
+
+            if response.status_code == 429:
+                throttled_attempts += 1
+                if throttled_attempts >= self.max_throttled_attempts:
+                    raise RuntimeError(f"Failed to write a contact after it was throttled {throttled_attempts} times")
+                retry_after_seconds = parse_retry_after(response.headers.get("Retry-After"), backoff_seconds)
+                self.token_bucket.on_throttled(retry_after_seconds)
+                log.debug(f"Rapid Pro throttled a write; slowing to {self.token_bucket.rate:.2f} writes/s")
+                continue
+            if response.status_code >= 500:
+                failed_attempts += 1
+                if failed_attempts < self.max_attempts:
+                    log.warning(f"Rapid Pro returned HTTP {response.status_code}; retrying in {backoff_seconds}s...")
+                    self._stopped.wait(backoff_seconds)
+                    backoff_seconds *= 2
+                    continue
+
+            response.raise_for_status()
+            self.token_bucket.on_success()
+            return
+
+    def update_contacts(self, contacts):
+        """
+        Updates many contacts concurrently, with at most `max_concurrent_writes` writes in flight at once.
+
+        If any write fails, no more writes are started, this writer is stopped, and the failure is raised once the
+        writes already in flight have finished.
+
+        :param contacts: (urn, name, fields) of each contact to update. See `update_contact`.
+        :type contacts: list of (str, str | None, dict of str -> (str | None))
+        :return: Number of contacts updated.
+        :rtype: int
+        """
+        updated = 0
+
+        def collect(futures):
+            nonlocal updated
+            for future in futures:
+                # Re-raises the exception if this write failed.
+                future.result()
+                updated += 1
+                if updated % 1000 == 0:
+                    log.info(f"Written {updated}/{len(contacts)} contacts")
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_writes) as executor:
+            in_flight = set()
+            try:
+                for contact in contacts:
+                    self._raise_if_stopped()
+                    in_flight.add(executor.submit(self.update_contact, *contact))
+                    if len(in_flight) >= self.max_concurrent_writes:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        collect(done)
+
+                done, _ = wait(in_flight)
+                collect(done)
+            except BaseException:
+                # Make the writes still in flight give up at their next attempt rather than keep retrying
+                self.stop()
+                raise
+        return updated
@@ -0,0 +1,141 @@
+import sys
+
+from core_data_modules.logging import Logger
+from dateutil.parser import isoparse
+
+log = Logger(__name__)
+
+
+def is_valid_contact(contact):
+    """
+    Checks whether a Rapid Pro contact can be synchronised, logging a warning if it can't.
+
+    :param contact: Contact to check.
+    :type contact: temba_client.v2.types.Contact
+    :rtype: bool
+    """
+    if len(contact.urns) != 1:
+        log.warning(f"Found a contact with multiple URNS; skipping. "
+                    f"The RapidPro UUID is '{contact.uuid}'")
+        return False
+    if contact.urns[0].startswith("tel:") and not contact.urns[0].startswith("tel:+"):
+        log.warning(f"Found a contact with a telephone number but without a country code; skipping. "
+                    f"The RapidPro UUID is '{contact.uuid}'")
+        return False
+
+    # Check for Safaricom numbers forwarded with a wrongly formatted Kenyan country code
+    if contact.urns[0].startswith("tel:+1") and len(contact.urns[0]) < 15:
+        log.warning(f"Found a telephone that startswith +1 but less than 15 digits long. This is probably a malformed"
+                    f" Safaricom number, skipping; "
+                    f"The RapidPro UUID is '{contact.uuid}'")
+        return False
+
+    return True
+
+
+class ContactRecord:
+    """
+    Normalised copy of the parts of a Rapid Pro contact that are synchronised between workspaces.
+
+    Records are normalised so that two contacts only compare as different if there is a genuine difference:
+     - The URN has any metadata trimmed, because although Rapid Pro sometimes provides some in its get APIs, it refuses
+       them when setting.
+     - A name that is empty string is stored as None, because while Rapid Pro can return empty string contact names,
+       it doesn't accept them when uploading.
+     - Only fields with a value are stored. Rapid Pro returns all the contact fields on each contact, with value None
+       if there is no value set, which would otherwise make every contact differ the moment a new contact field was
+       created in one workspace.
+
+    Field keys are interned, so that the millions of records held when synchronising large workspaces share one copy
+    of each key rather than each holding their own.
+
+    :param urn: The contact's URN.
+    :type urn: str
+    :param uuid: The contact's Rapid Pro UUID in the workspace this record was read from, or None if unknown.
+    :type uuid: str | None
+    :param name: The contact's name.
+    :type name: str | None
+    :param fields: The contact's field values, for the fields that have a value.
+    :type fields: dict of str -> str
+    :param modified_on: When the contact was last modified in the workspace this record was read from.
+    :type modified_on: datetime.datetime | None
+    """
+    __slots__ = ("urn", "uuid", "name", "fields", "modified_on")
+
+    def __init__(self, urn, uuid, name, fields, modified_on):
+        self.urn = urn
+        self.uuid = uuid
+        self.name = name
+        self.fields = fields
+        self.modified_on = modified_on
+
+    @classmethod
+    def from_temba_contact(cls, contact):
+        """
+        :param contact: Contact to normalise. This must be valid, according to `is_valid_contact`.
+        :type contact: temba_client.v2.types.Contact
+        :rtype: ContactRecord
+        """
+        return cls(
+            urn=contact.urns[0].split("#")[0],
+            uuid=contact.uuid,
+            name=None if contact.name == "" else contact.name,
+            fields={sys.intern(key): value for key, value in contact.fields.items() if value is not None},
+            modified_on=contact.modified_on
+        )
+
+    def to_dict(self):
+        return {
+            "urn": self.urn,
+            "uuid": self.uuid,
+            "name": self.name,
+            "fields": self.fields,
+            "modified_on": None if self.modified_on is None else self.modified_on.isoformat()
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(
+            urn=d["urn"],
+            uuid=d["uuid"],
+            name=d["name"],
+            fields={sys.intern(key): value for key, value in d["fields"].items()},
+            modified_on=None if d["modified_on"] is None else isoparse(d["modified_on"])
+        )
+
+    def has_same_data(self, other):
+        """
+        :param other: Record to compare with.
+        :type other: ContactRecord
+        :return: Whether this record has the same name and field values as the other record.
+        :rtype: bool
+        """
+        return self.name == other.name and self.fields == other.fields
+
+    def padded_fields(self, field_keys):
+        """
+        :param field_keys: Keys of all the fields to include.
+        :type field_keys: iterable of str
+        :return: This contact's fields, with every field in `field_keys` that this contact doesn't have a value for
+                 set to None, so that writing them to a workspace clears any values the workspace has for them.
+        :rtype: dict of str -> (str | None)
+        """
+        fields = {key: None for key in field_keys}
+        fields.update(self.fields)
+        return fields
+
+
+def normalise_contacts(contacts):
+    """
+    :param contacts: Contacts to normalise.
+    :type contacts: iterable of temba_client.v2.types.Contact
+    :return: Records of the valid contacts, keyed by URN.
+    :rtype: dict of str -> ContactRecord
+    """
+    records = dict()
+    for contact in contacts:
+        if not is_valid_contact(contact):
+            continue
+        record = ContactRecord.from_temba_contact(contact)
+        records[record.urn] = record
+    return records
@@ -0,0 +1,107 @@
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeRapidProServer:
+    """
+    Minimal local stand-in for the Rapid Pro contacts API, for benchmarking `src.contact_writer.RapidProContactWriter`
+    without a real workspace.
+
+    Contact writes (POST /api/v2/contacts.json?urn=...) take `latency_seconds` to respond, and are throttled with
+    HTTP 429 and a Retry-After header once more than `max_writes_per_second` have been accepted in the last second,
+    like Rapid Pro's own rate limiting.
+
+    :param max_writes_per_second: Number of writes to accept in any one second before throttling.
+    :type max_writes_per_second: float
+    :param latency_seconds: Number of seconds each request takes to respond.
+    :type latency_seconds: float
+    :param retry_after_http_date: If True, sends Retry-After as an HTTP-date rather than as a number of seconds.
+    :type retry_after_http_date: bool
+    :param port: Port to listen on. If 0, a free port is chosen.
+    :type port: int
+    """
+    def __init__(self, max_writes_per_second, latency_seconds, retry_after_http_date=False, port=0):
+        self.max_writes_per_second = max_writes_per_second
+        self.latency_seconds = latency_seconds
+        self.retry_after_http_date = retry_after_http_date
+
+        self.contacts = dict()
+        self.writes_accepted = 0
+        self.writes_throttled = 0
+        self._accepted_times = deque()
+        self._lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        :return: Base URL of the server, for passing as the `domain` of a RapidProContactWriter.
+        :rtype: str
+        """
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _try_accept(self, urn, contact):
+        with self._lock:
+            now = time.monotonic()
+            while len(self._accepted_times) > 0 and self._accepted_times[0] <= now - 1:
+                self._accepted_times.popleft()
+            if len(self._accepted_times) >= self.max_writes_per_second:
+                self.writes_throttled += 1
+                return False
+            self._accepted_times.append(now)
+            self.contacts[urn] = contact
+            self.writes_accepted += 1
+            return True
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self, status, body, headers=None):
+                body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or dict()).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                contact = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                urn = parse_qs(urlparse(self.path).query)["urn"][0]
+                time.sleep(server.latency_seconds)
+
+                if server._try_accept(urn, contact):
+                    self._respond(200, {"urn": urn})
+                    return
+
+                if server.retry_after_http_date:
+                    # HTTP-dates only have a resolution of one second, so round up to make sure the window has moved
+                    retry_after = self.date_time_string(int(time.time()) + 2)
+                else:
+                    retry_after = "1"
+                self._respond(429, {"detail": "Request was throttled."}, {"Retry-After": retry_after})
+
+        return Handler
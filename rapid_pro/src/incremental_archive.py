@@ -0,0 +1,249 @@
+import io
+import json
+import os
+import tarfile
+
+from core_data_modules.logging import Logger
+from dateutil.parser import isoparse
+
+from src.workspace_archive import DEFAULT_CHUNK_SIZE_BYTES, add_chunk_to_tar, archive_member_name, \
+    parse_archive_member_name
+
+log = Logger(__name__)
+
+# Resources that can be archived incrementally, by the field that the TembaClient get method's `after` argument
+# filters on. Every other resource is small, so is archived in full in every delta.
+WATERMARK_FIELDS = {
+    "broadcasts": "created_on",
+    "channel_events": "created_on",
+    "contacts": "modified_on",
+    "flow_starts": "modified_on",
+    "messages": "created_on",
+    "runs": "modified_on"
+}
+
+# Field that uniquely identifies each record of the resources that are archived incrementally, so that records
+# archived more than once can be de-duplicated when consolidating
+RECORD_KEYS = {
+    "broadcasts": "id",
+    "channel_events": "id",
+    "contacts": "uuid",
+    "flow_starts": "uuid",
+    "messages": "id",
+    "runs": "id"
+}
+
+
+class ArchiveManifest:
+    """
+    Record of a chain of incremental archives of a workspace: a base full archive followed by deltas, each containing
+    the records created or modified since the previous archive in the chain, and the watermarks to start the next
+    delta from.
+
+    :param base: Details of the base full archive, as a dict of "location", "archive_name" and "watermarks".
+    :type base: dict
+    :param deltas: Details of each delta archive since the base, oldest first, in the same format as `base`.
+    :type deltas: list of dict
+    :param watermarks: Dictionary of resource -> ISO string of the latest watermark field value archived so far.
+    :type watermarks: dict of str -> str
+    """
+    def __init__(self, base, deltas, watermarks):
+        self.base = base
+        self.deltas = deltas
+        self.watermarks = watermarks
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        :param file_path: Path to the manifest file to load.
+        :type file_path: str
+        :return: The manifest, or None if the file doesn't exist.
+        :rtype: ArchiveManifest | None
+        """
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path) as f:
+            d = json.load(f)
+        return cls(d["base"], d["deltas"], d["watermarks"])
+
+    def save(self, file_path):
+        """
+        Atomically writes this manifest to a file.
+
+        :param file_path: Path to write the manifest to.
+        :type file_path: str
+        """
+        temp_file_path = f"{file_path}.tmp"
+        with open(temp_file_path, "w") as f:
+            json.dump({"base": self.base, "deltas": self.deltas, "watermarks": self.watermarks}, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file_path, file_path)
+
+    def get_watermark(self, resource):
+        """
+        :param resource: Resource to get the watermark of.
+        :type resource: str
+        :return: The latest watermark field value archived so far for this resource, or None if none have been.
+        :rtype: datetime.datetime | None
+        """
+        watermark = self.watermarks.get(resource)
+        return None if watermark is None else isoparse(watermark)
+
+    @staticmethod
+    def _archive_entry(location, archive_name, watermarks):
+        return {"location": location, "archive_name": archive_name, "watermarks": dict(watermarks)}
+
+    def add_delta(self, location, archive_name, watermarks):
+        """
+        :param location: Local path or GS URL of the delta archive.
+        :type location: str
+        :param archive_name: Name of the directory the resources are in inside the archive.
+        :type archive_name: str
+        :param watermarks: Watermarks after archiving this delta, as returned by `WatermarkTracker.to_dict`.
+        :type watermarks: dict of str -> str
+        """
+        self.watermarks.update(watermarks)
+        self.deltas.append(self._archive_entry(location, archive_name, self.watermarks))
+
+    @classmethod
+    def for_base(cls, location, archive_name, watermarks):
+        """
+        :param location: Local path or GS URL of the base full archive.
+        :type location: str
+        :param archive_name: Name of the directory the resources are in inside the archive.
+        :type archive_name: str
+        :param watermarks: Watermarks after archiving the base, as returned by `WatermarkTracker.to_dict`.
+        :type watermarks: dict of str -> str
+        :return: A manifest starting a new chain of archives from the given base.
+        :rtype: ArchiveManifest
+        """
+        return cls(cls._archive_entry(location, archive_name, watermarks), [], dict(watermarks))
+
+    def archive_locations_newest_first(self):
+        """
+        :return: Locations of the archives in this chain, newest first.
+        :rtype: list of str
+        """
+        return [delta["location"] for delta in reversed(self.deltas)] + [self.base["location"]]
+
+
+class WatermarkTracker:
+    """
+    Tracks the latest watermark field value of the records archived for each resource in `WATERMARK_FIELDS`.
+
+    :param initial_watermarks: Watermarks to start from, as a dictionary of resource -> datetime.
+    :type initial_watermarks: dict of str -> datetime.datetime
+    """
+    def __init__(self, initial_watermarks=None):
+        self._watermarks = dict(initial_watermarks or dict())
+
+    def on_chunk_archived(self, resource, records):
+        """
+        Updates the watermark of a resource from a chunk of its records. Pass this as `on_chunk_archived` to
+        `src.workspace_archive.write_streaming_archive`.
+
+        :param resource: Resource the records are from.
+        :type resource: str
+        :param records: Records archived.
+        :type records: list of temba_client.serialization.TembaObject
+        """
+        field = WATERMARK_FIELDS.get(resource)
+        if field is None:
+            return
+        for record in records:
+            value = getattr(record, field)
+            if value is not None and (resource not in self._watermarks or value > self._watermarks[resource]):
+                self._watermarks[resource] = value
+
+    def to_dict(self):
+        """
+        :return: Dictionary of resource -> ISO string of the latest watermark field value archived.
+        :rtype: dict of str -> str
+        """
+        return {resource: watermark.isoformat() for resource, watermark in self._watermarks.items()}
+
+
+def incremental_get_kwargs(manifest):
+    """
+    :param manifest: Manifest of the archives so far.
+    :type manifest: ArchiveManifest
+    :return: Dictionary of resource -> TembaClient get method keyword arguments, to only get the records created or
+             modified since the watermarks in the manifest. The `after` filter is inclusive, so the records at each
+             watermark are archived again, and de-duplicated when consolidating.
+    :rtype: dict of str -> dict
+    """
+    return {
+        resource: {"after": manifest.get_watermark(resource)}
+        for resource in WATERMARK_FIELDS if manifest.get_watermark(resource) is not None
+    }
+
+
+def consolidate_archives(archive_fileobjs_newest_first, output_fileobj, archive_name,
+                         chunk_size_bytes=DEFAULT_CHUNK_SIZE_BYTES):
+    """
+    Consolidates a chain of streaming archives into a single full streaming archive containing the latest version of
+    each record.
+
+    Records of the resources in `RECORD_KEYS` are merged across all the archives, keeping the newest version of each
+    record. Every other resource is archived in full in each archive, so is taken from the newest archive only.
+
+    :param archive_fileobjs_newest_first: Binary file-like objects of each tar.gz archive in the chain, newest first.
+    :type archive_fileobjs_newest_first: list of file-like
+    :param output_fileobj: Binary file-like object to write the consolidated tar.gz archive to. This is not closed.
+    :type output_fileobj: file-like
+    :param archive_name: Name of the directory in the consolidated archive to write the resources to.
+    :type archive_name: str
+    :param chunk_size_bytes: Approximate size of each tar member in the consolidated archive.
+    :type chunk_size_bytes: int
+    :return: Dictionary of resource -> number of records in the consolidated archive.
+    :rtype: dict of str -> int
+    """
+    seen_keys = {resource: set() for resource in RECORD_KEYS}
+    fully_archived_resources = set()
+    record_counts = dict()
+    chunks = dict()
+    chunk_indices = dict()
+
+    with tarfile.open(fileobj=output_fileobj, mode="w|gz") as output_tar:
+        def flush_chunk(resource):
+            chunk = chunks.pop(resource)
+            add_chunk_to_tar(output_tar, archive_member_name(archive_name, resource, chunk_indices[resource]),
+                             chunk.getvalue())
+            chunk_indices[resource] += 1
+
+        for i, archive_fileobj in enumerate(archive_fileobjs_newest_first):
+            log.info(f"Consolidating archive {i + 1}/{len(archive_fileobjs_newest_first)}...")
+            resources_in_this_archive = set()
+            with tarfile.open(fileobj=archive_fileobj, mode="r|gz") as input_tar:
+                for member in input_tar:
+                    if not member.isfile():
+                        continue
+                    _, resource = parse_archive_member_name(member.name)
+                    if resource not in RECORD_KEYS:
+                        if resource in fully_archived_resources:
+                            continue
+                        resources_in_this_archive.add(resource)
+
+                    record_counts.setdefault(resource, 0)
+                    chunk_indices.setdefault(resource, 0)
+                    for line in input_tar.extractfile(member):
+                        if resource in RECORD_KEYS:
+                            key = json.loads(line)[RECORD_KEYS[resource]]
+                            if key in seen_keys[resource]:
+                                continue
+                            seen_keys[resource].add(key)
+
+                        chunk = chunks.setdefault(resource, io.BytesIO())
+                        chunk.write(line)
+                        record_counts[resource] += 1
+                        if chunk.tell() >= chunk_size_bytes:
+                            flush_chunk(resource)
+            fully_archived_resources.update(resources_in_this_archive)
+
+        for resource in list(chunks):
+            flush_chunk(resource)
+
+    for resource, count in sorted(record_counts.items()):
+        log.info(f"Consolidated {count} {resource}")
+    return record_counts
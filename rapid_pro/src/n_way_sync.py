@@ -0,0 +1,160 @@
+from core_data_modules.logging import Logger
+
+from src.contact_sync import ContactUpdate
+
+log = Logger(__name__)
+
+
+class NWaySyncSummary:
+    """
+    Counts of the actions taken by a contact synchronisation across any number of workspaces, per workspace.
+
+    :param workspace_count: Number of workspaces being synchronised.
+    :type workspace_count: int
+    """
+    def __init__(self, workspace_count):
+        self.new_contact_fields = [0] * workspace_count
+        self.new_contacts = [0] * workspace_count
+        self.updated_contacts = [0] * workspace_count
+        self.identical_contacts = 0
+        self.skipped_contacts = 0
+
+    def log(self, workspace_names, dry_run, force_update):
+        log.info(f"Contacts sync complete. Summary of actions{' (dry run)' if dry_run else ''}:")
+        for i, workspace_name in enumerate(workspace_names):
+            log.info(f"Created {self.new_contact_fields[i]} new contact fields in workspace {workspace_name}")
+        for i, workspace_name in enumerate(workspace_names):
+            log.info(f"Created {self.new_contacts[i]} new contacts in workspace {workspace_name}")
+        if force_update:
+            for i, workspace_name in enumerate(workspace_names):
+                log.info(f"Overwrote {self.updated_contacts[i]} contacts in workspace {workspace_name} with the "
+                         f"newest version")
+        else:
+            log.info(f"Skipped {self.skipped_contacts} contacts that differed between the workspaces")
+        log.info(f"Skipped {self.identical_contacts} contacts that were identical in every workspace")
+
+
+def synchronise_fields_n_way(workspaces, workspace_names, workspace_fields, targets, dry_run, summary):
+    """
+    Creates the contact fields that exist in any of the workspaces in every workspace they are missing from.
+
+    :param workspaces: Clients for the workspaces. These may be None in dry-run mode.
+    :type workspaces: list of (rapid_pro_tools.rapid_pro_client.RapidProClient | None)
+    :param workspace_names: Names of the workspaces.
+    :type workspace_names: list of str
+    :param workspace_fields: Fields in each of the workspaces.
+    :type workspace_fields: list of list of temba_client.v2.types.Field
+    :param targets: Indices of the workspaces that may be updated.
+    :type targets: set of int
+    :param dry_run: Whether to only log the fields that would be created.
+    :type dry_run: bool
+    :param summary: Summary to count the created fields in.
+    :type summary: NWaySyncSummary
+    """
+    all_fields = dict()
+    for fields in workspace_fields:
+        for field in fields:
+            all_fields.setdefault(field.key, field)
+
+    for target in sorted(targets):
+        log.info(f"Synchronising fields to {workspace_names[target]}...")
+        target_field_keys = {f.key for f in workspace_fields[target]}
+        for field in all_fields.values():
+            if field.key not in target_field_keys:
+                summary.new_contact_fields[target] += 1
+                if dry_run:
+                    log.info(f"Would create field '{field.label}'")
+                    continue
+                workspaces[target].create_field(field.label, field.key)
+    log.info("Contact fields synchronised")
+
+
+def index_contacts_by_urn(workspace_contacts):
+    """
+    :param workspace_contacts: Contacts in each of the workspaces, keyed by URN.
+    :type workspace_contacts: list of (dict of str -> src.contacts.ContactRecord)
+    :return: Dictionary of URN -> the contact with that URN in each of the workspaces, with None for the workspaces
+             that don't have the contact.
+    :rtype: dict of str -> list of (src.contacts.ContactRecord | None)
+    """
+    urn_index = dict()
+    for i, contacts in enumerate(workspace_contacts):
+        for urn, record in contacts.items():
+            if urn not in urn_index:
+                urn_index[urn] = [None] * len(workspace_contacts)
+            urn_index[urn][i] = record
+    return urn_index
+
+
+def plan_n_way_contact_updates(workspace_names, urn_index, force_update, targets, summary):
+    """
+    Plans the writes needed to synchronise contacts across any number of workspaces, in a single pass over a merged
+    URN index.
+
+    For each URN, the winning version of the contact is the most recently modified one, or the one in the last
+    workspace if several were modified at the same time. The winner is created in every workspace that doesn't have
+    the contact. Workspaces with a version that differs from the winner are only overwritten if `force_update` is set.
+
+    :param workspace_names: Names of the workspaces.
+    :type workspace_names: list of str
+    :param urn_index: Contacts in each workspace, indexed by URN, as returned by `index_contacts_by_urn`.
+    :type urn_index: dict of str -> list of (src.contacts.ContactRecord | None)
+    :param force_update: Whether to overwrite contacts which differ from the winning version.
+    :type force_update: bool
+    :param targets: Indices of the workspaces that may be updated.
+    :type targets: set of int
+    :param summary: Summary to count the planned actions in.
+    :type summary: NWaySyncSummary
+    :return: The planned updates.
+    :rtype: list of ContactUpdate
+    """
+    updates = []
+    urns = sorted(urn_index)
+    for i, urn in enumerate(urns):
+        versions = urn_index[urn]
+        progress_text = f"Synchronising contacts {i + 1}/{len(urns)}"
+
+        # Break ties in favour of the last workspace, to match the two-workspace sync, which prefers workspace 2
+        # when both versions were modified at the same time
+        winner_index = max(
+            (j for j, version in enumerate(versions) if version is not None),
+            key=lambda j: (versions[j].modified_on, j)
+        )
+        winner = versions[winner_index]
+        winner_text = f"(Rapid Pro UUID '{winner.uuid}' in {workspace_names[winner_index]})"
+
+        differing = [
+            j for j, version in enumerate(versions) if version is not None and not version.has_same_data(winner)
+        ]
+        missing = [j for j, version in enumerate(versions) if version is None]
+
+        if len(differing) == 0 and len(missing) == 0:
+            log.debug(f"{progress_text}: Contacts identical. {winner_text}")
+            summary.identical_contacts += 1
+            continue
+
+        for target in missing:
+            if target not in targets:
+                continue
+            log.info(f"{progress_text}: Adding new contact to {workspace_names[target]}. {winner_text}")
+            summary.new_contacts[target] += 1
+            updates.append(ContactUpdate(target, winner, is_new=True))
+
+        if len(differing) == 0:
+            continue
+
+        if not force_update:
+            log.warning(f"{progress_text}: Contacts differ in {[workspace_names[j] for j in differing]}, but not "
+                        f"overwriting. Use --force to write the latest everywhere. {winner_text}")
+            summary.skipped_contacts += 1
+            continue
+
+        for target in differing:
+            if target not in targets:
+                continue
+            log.info(f"{progress_text}: Contacts differ, overwriting the contact in {workspace_names[target]} with "
+                     f"the most recent one. {winner_text}")
+            summary.updated_contacts[target] += 1
+            updates.append(ContactUpdate(target, winner, is_new=False))
+
+    return updates
@@ -0,0 +1,207 @@
+import json
+import sqlite3
+
+from dateutil.parser import isoparse
+
+from src.contacts import ContactRecord
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS contacts (
+    workspace TEXT NOT NULL,
+    urn TEXT NOT NULL,
+    uuid TEXT,
+    record TEXT NOT NULL,
+    PRIMARY KEY (workspace, urn)
+);
+CREATE INDEX IF NOT EXISTS contacts_workspace_uuid ON contacts (workspace, uuid);
+
+CREATE TABLE IF NOT EXISTS unresolved_urns (
+    urn TEXT PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class ContactSyncState:
+    """
+    Local SQLite copy of the contacts in the workspaces being synchronised, and of how far through each workspace's
+    contacts the previous synchronisation got, so that later synchronisations only need to download the contacts that
+    have been modified since.
+
+    :param connection: Connection to the SQLite database to use.
+    :type connection: sqlite3.Connection
+    """
+    def __init__(self, connection):
+        self._connection = connection
+
+        # States written before contacts were indexed by uuid can't be migrated in place, so discard their contacts
+        # and force the next sync to be a full sync, which rebuilds them.
+        contacts_columns = {row[1] for row in self._connection.execute("PRAGMA table_info(contacts)")}
+        if len(contacts_columns) > 0 and "uuid" not in contacts_columns:
+            self._connection.executescript("""
+                DROP TABLE contacts;
+                DELETE FROM metadata WHERE key = 'last_full_reconcile';
+            """)
+
+        self._connection.executescript(_SCHEMA)
+
+    @classmethod
+    def open(cls, file_path):
+        """
+        :param file_path: Path to the SQLite file. This is created if it does not exist.
+        :type file_path: str
+        :rtype: ContactSyncState
+        """
+        return cls(sqlite3.connect(file_path))
+
+    def close(self):
+        self._connection.close()
+
+    def commit(self):
+        self._connection.commit()
+
+    def _get_metadata(self, key):
+        row = self._connection.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_metadata(self, key, value):
+        self._connection.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?)", (key, value))
+
+    def get_watermark(self, workspace_name):
+        """
+        :param workspace_name: Name of the workspace to get the watermark of.
+        :type workspace_name: str
+        :return: The latest `modified_on` of the contacts downloaded from this workspace, or None if this workspace's
+                 contacts have never been downloaded into this state.
+        :rtype: datetime.datetime | None
+        """
+        watermark = self._get_metadata(f"watermark/{workspace_name}")
+        return None if watermark is None else isoparse(watermark)
+
+    def set_watermark(self, workspace_name, watermark):
+        """
+        :param workspace_name: Name of the workspace to set the watermark of.
+        :type workspace_name: str
+        :param watermark: The latest `modified_on` of the contacts downloaded from this workspace.
+        :type watermark: datetime.datetime
+        """
+        self._set_metadata(f"watermark/{workspace_name}", watermark.isoformat())
+
+    def get_last_full_reconcile(self):
+        """
+        :return: When every contact was last downloaded from all the workspaces, or None if that has never happened.
+        :rtype: datetime.datetime | None
+        """
+        last_full_reconcile = self._get_metadata("last_full_reconcile")
+        return None if last_full_reconcile is None else isoparse(last_full_reconcile)
+
+    def set_last_full_reconcile(self, timestamp):
+        """
+        :param timestamp: When every contact was last downloaded from all the workspaces.
+        :type timestamp: datetime.datetime
+        """
+        self._set_metadata("last_full_reconcile", timestamp.isoformat())
+
+    def replace_contacts(self, workspace_name, records):
+        """
+        Replaces all of the contacts stored for a workspace.
+
+        :param workspace_name: Name of the workspace the records are from.
+        :type workspace_name: str
+        :param records: Records of every contact in the workspace.
+        :type records: iterable of src.contacts.ContactRecord
+        """
+        self._connection.execute("DELETE FROM contacts WHERE workspace = ?", (workspace_name,))
+        self.upsert_contacts(workspace_name, records)
+
+    def upsert_contacts(self, workspace_name, records):
+        """
+        :param workspace_name: Name of the workspace the records are from.
+        :type workspace_name: str
+        :param records: Records of contacts to insert or update.
+        :type records: iterable of src.contacts.ContactRecord
+        """
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO contacts VALUES (?, ?, ?, ?)",
+            ((workspace_name, record.urn, record.uuid, json.dumps(record.to_dict())) for record in records)
+        )
+
+    def delete_contacts(self, workspace_name, urns):
+        """
+        :param workspace_name: Name of the workspace to delete the contacts from.
+        :type workspace_name: str
+        :param urns: URNs of the contacts to delete.
+        :type urns: iterable of str
+        """
+        self._connection.executemany(
+            "DELETE FROM contacts WHERE workspace = ? AND urn = ?", ((workspace_name, urn) for urn in urns)
+        )
+
+    def get_urns_of_contacts(self, workspace_name, uuids):
+        """
+        :param workspace_name: Name of the workspace to look the contacts up in.
+        :type workspace_name: str
+        :param uuids: Rapid Pro UUIDs of the contacts to look up.
+        :type uuids: iterable of str
+        :return: The URNs the contacts with these UUIDs are stored under.
+        :rtype: set of str
+        """
+        urns = set()
+        for uuid in uuids:
+            urns.update(urn for urn, in self._connection.execute(
+                "SELECT urn FROM contacts WHERE workspace = ? AND uuid = ?", (workspace_name, uuid)
+            ))
+        return urns
+
+    def get_unresolved_urns(self):
+        """
+        :return: URNs of the contacts which were left out of sync by the previous sync, for example because they
+                 differed and --force wasn't set, or because the workspace they needed writing to wasn't being
+                 updated.
+        :rtype: set of str
+        """
+        return {urn for urn, in self._connection.execute("SELECT urn FROM unresolved_urns")}
+
+    def set_unresolved_urns(self, urns):
+        """
+        Replaces the URNs of the contacts left out of sync.
+
+        :param urns: URNs of the contacts which are still out of sync after this sync.
+        :type urns: iterable of str
+        """
+        self._connection.execute("DELETE FROM unresolved_urns")
+        self._connection.executemany("INSERT INTO unresolved_urns VALUES (?)", ((urn,) for urn in urns))
+
+    def get_contact(self, workspace_name, urn):
+        """
+        :param workspace_name: Name of the workspace to get the contact from.
+        :type workspace_name: str
+        :param urn: URN of the contact to get.
+        :type urn: str
+        :return: The stored record of the contact, or None if this contact isn't known to be in the workspace.
+        :rtype: src.contacts.ContactRecord | None
+        """
+        row = self._connection.execute(
+            "SELECT record FROM contacts WHERE workspace = ? AND urn = ?", (workspace_name, urn)
+        ).fetchone()
+        return None if row is None else ContactRecord.from_dict(json.loads(row[0]))
+
+    def get_contacts(self, workspace_name, urns):
+        """
+        :param workspace_name: Name of the workspace to get the contacts from.
+        :type workspace_name: str
+        :param urns: URNs of the contacts to get.
+        :type urns: iterable of str
+        :return: The stored records of the contacts that are known to be in the workspace, keyed by URN.
+        :rtype: dict of str -> src.contacts.ContactRecord
+        """
+        records = dict()
+        for urn in urns:
+            record = self.get_contact(workspace_name, urn)
+            if record is not None:
+                records[urn] = record
+        return records
@@ -0,0 +1,164 @@
+import json
+import sqlite3
+
+from src.contacts import ContactRecord
+
+# Key used to refer to a contact's name alongside its field keys when listing conflicts
+NAME_KEY = "name"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS base_contacts (
+    urn TEXT PRIMARY KEY,
+    record TEXT NOT NULL
+);
+"""
+
+
+class ContactMergeBaseStore:
+    """
+    Persistent SQLite store of the version of each contact that both workspaces agreed on at the end of the last
+    successful synchronisation, for use as the common ancestor when three-way merging contacts that have since been
+    changed.
+
+    :param connection: Connection to the SQLite database to use.
+    :type connection: sqlite3.Connection
+    """
+    def __init__(self, connection):
+        self._connection = connection
+        self._connection.executescript(_SCHEMA)
+
+    @classmethod
+    def open(cls, file_path):
+        """
+        :param file_path: Path to the SQLite file. This is created if it does not exist.
+        :type file_path: str
+        :rtype: ContactMergeBaseStore
+        """
+        return cls(sqlite3.connect(file_path))
+
+    def close(self):
+        self._connection.close()
+
+    def commit(self):
+        self._connection.commit()
+
+    def get_base(self, urn):
+        """
+        :param urn: URN of the contact to get the base version of.
+        :type urn: str
+        :return: The version of the contact at the end of the last successful synchronisation, or None if it has never
+                 been synchronised.
+        :rtype: src.contacts.ContactRecord | None
+        """
+        row = self._connection.execute("SELECT record FROM base_contacts WHERE urn = ?", (urn,)).fetchone()
+        return None if row is None else ContactRecord.from_dict(json.loads(row[0]))
+
+    def set_base(self, record):
+        """
+        Records the version of a contact that both workspaces agree on after synchronising it. The caller is
+        responsible for only committing this once the synchronisation has succeeded.
+
+        :param record: Synchronised version of the contact.
+        :type record: src.contacts.ContactRecord
+        """
+        self._connection.execute(
+            "INSERT OR REPLACE INTO base_contacts VALUES (?, ?)", (record.urn, json.dumps(record.to_dict()))
+        )
+
+
+class ContactMerge:
+    """
+    Result of three-way merging two versions of a contact.
+
+    :param record: The merged contact.
+    :type record: src.contacts.ContactRecord
+    :param conflicts: Keys of the fields that were changed differently in both versions, with `NAME_KEY` for the name.
+                      These were resolved by taking the value from the most recently modified version.
+    :type conflicts: list of str
+    """
+    def __init__(self, record, conflicts):
+        self.record = record
+        self.conflicts = conflicts
+
+    def changed_fields(self, contact):
+        """
+        :param contact: Version of the contact to compare with the merged contact.
+        :type contact: src.contacts.ContactRecord
+        :return: The fields that need writing to `contact` to make it match the merged contact, with value None for
+                 fields that need clearing.
+        :rtype: dict of str -> (str | None)
+        """
+        return {
+            key: self.record.fields.get(key)
+            for key in self.record.fields.keys() | contact.fields.keys()
+            if self.record.fields.get(key) != contact.fields.get(key)
+        }
+
+    def differs_from(self, contact):
+        """
+        :param contact: Version of the contact to compare with the merged contact.
+        :type contact: src.contacts.ContactRecord
+        :return: Whether `contact` needs updating to match the merged contact.
+        :rtype: bool
+        """
+        return not self.record.has_same_data(contact)
+
+
+def _merge_value(base_value, value_1, value_2, latest_value):
+    """
+    :return: (merged value, whether the values conflicted)
+    :rtype: (any, bool)
+    """
+    if value_1 == value_2:
+        return value_1, False
+    if value_1 == base_value:
+        return value_2, False
+    if value_2 == base_value:
+        return value_1, False
+    return latest_value, True
+
+
+def merge_contacts(base, contact_v1, contact_v2):
+    """
+    Three-way merges two versions of a contact at field granularity.
+
+    Each field, and the name, takes whichever version's value was changed from the base. Where both versions changed
+    the same field differently, the value from the most recently modified version is used and the field is reported
+    as a conflict.
+
+    :param base: Version of the contact both workspaces agreed on at the last synchronisation, or None if the contact
+                 has never been synchronised, in which case every field that differs between the versions conflicts.
+    :type base: src.contacts.ContactRecord | None
+    :param contact_v1: Version of the contact in the first workspace.
+    :type contact_v1: src.contacts.ContactRecord
+    :param contact_v2: Version of the contact in the second workspace.
+    :type contact_v2: src.contacts.ContactRecord
+    :rtype: ContactMerge
+    """
+    base_name = None if base is None else base.name
+    base_fields = dict() if base is None else base.fields
+    latest = contact_v1 if contact_v1.modified_on > contact_v2.modified_on else contact_v2
+
+    conflicts = []
+    name, name_conflicted = _merge_value(base_name, contact_v1.name, contact_v2.name, latest.name)
+    if name_conflicted:
+        conflicts.append(NAME_KEY)
+
+    fields = dict()
+    for key in sorted(contact_v1.fields.keys() | contact_v2.fields.keys() | base_fields.keys()):
+        value, conflicted = _merge_value(
+            base_fields.get(key), contact_v1.fields.get(key), contact_v2.fields.get(key), latest.fields.get(key)
+        )
+        if conflicted:
+            conflicts.append(key)
+        if value is not None:
+            fields[key] = value
+
+    record = ContactRecord(
+        urn=contact_v1.urn,
+        uuid=None,
+        name=name,
+        fields=fields,
+        modified_on=max(contact_v1.modified_on, contact_v2.modified_on)
+    )
+    return ContactMerge(record, conflicts)
@@ -0,0 +1,248 @@
+import io
+import json
+import queue
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from core_data_modules.logging import Logger
+from google.cloud import storage as google_cloud_storage
+
+log = Logger(__name__)
+
+# Resources to archive, by the name of the TembaClient method that gets them (without its "get_" prefix)
+ARCHIVE_RESOURCES = [
+    "archives", "boundaries", "broadcasts", "campaigns", "campaign_events", "channels", "channel_events",
+    "classifiers", "contacts", "fields", "flow_starts", "flows", "globals", "groups", "labels", "messages",
+    "resthooks", "resthook_events", "resthook_subscribers", "runs"
+]
+
+DEFAULT_MAX_CONCURRENT_RESOURCES = 4
+DEFAULT_CHUNK_SIZE_BYTES = 16 * 1024 * 1024
+
+
+class TeeWriter:
+    """
+    Binary file-like object which writes everything written to it to several other binary file-like objects.
+
+    :param fileobjs: File-like objects to write to.
+    :type fileobjs: list of file-like
+    """
+    def __init__(self, fileobjs):
+        self._fileobjs = fileobjs
+
+    def write(self, data):
+        for f in self._fileobjs:
+            f.write(data)
+        return len(data)
+
+
+class ArchiveOutputs:
+    """
+    The places to stream an archive to: a local file and/or a GCS blob.
+
+    The GCS blob is uploaded in resumable chunks as the archive is written. Nothing is created in GCS until `close`
+    is called, so an archive that fails part way through and is never closed never appears in the bucket.
+
+    :param google_cloud_credentials_file_path: Path to a Google Cloud service account credentials file to use to
+                                               upload to GCS.
+    :type google_cloud_credentials_file_path: str
+    :param local_file_path: Path to a local file to write the archive to, or None.
+    :type local_file_path: str | None
+    :param gcs_upload_path: GS URL to upload the archive to, or None.
+    :type gcs_upload_path: str | None
+    """
+    def __init__(self, google_cloud_credentials_file_path, local_file_path=None, gcs_upload_path=None):
+        assert local_file_path is not None or gcs_upload_path is not None
+        self.gcs_upload_path = gcs_upload_path
+
+        outputs = []
+        self._local_file = None
+        if local_file_path is not None:
+            log.info(f"Streaming the archive to '{local_file_path}'")
+            self._local_file = open(local_file_path, "wb")
+            outputs.append(self._local_file)
+
+        self._blob_writer = None
+        if gcs_upload_path is not None:
+            log.info(f"Streaming the archive to {gcs_upload_path}")
+            storage_client = google_cloud_storage.Client.from_service_account_json(google_cloud_credentials_file_path)
+            blob = google_cloud_storage.Blob.from_string(gcs_upload_path, client=storage_client)
+            self._blob_writer = blob.open("wb", ignore_flush=True)
+            outputs.append(self._blob_writer)
+
+        self.writer = TeeWriter(outputs)
+
+    def close(self):
+        """
+        Closes the outputs. Only call this once the archive is complete.
+        """
+        if self._local_file is not None:
+            self._local_file.close()
+        if self._blob_writer is not None:
+            log.info(f"Finalising the upload to {self.gcs_upload_path}...")
+            self._blob_writer.close()
+
+
+def archive_member_name(archive_name, resource, chunk_index):
+    """
+    :param archive_name: Name of the directory in the archive that the resources are in.
+    :type archive_name: str
+    :param resource: Resource the member contains.
+    :type resource: str
+    :param chunk_index: Index of the chunk of the resource the member contains.
+    :type chunk_index: int
+    :return: Name of the tar member containing the given chunk of a resource in a streaming archive.
+    :rtype: str
+    """
+    return f"{archive_name}/{resource}/{resource}-{chunk_index:05d}.jsonl"
+
+
+def parse_archive_member_name(member_name):
+    """
+    :param member_name: Name of a tar member in a streaming archive, as returned by `archive_member_name`.
+    :type member_name: str
+    :return: (archive name, resource) of the member.
+    :rtype: (str, str)
+    """
+    archive_name, resource, _ = member_name.split("/")
+    return archive_name, resource
+
+
+def add_chunk_to_tar(tar, member_name, chunk):
+    """
+    :param tar: Tar to add the chunk to.
+    :type tar: tarfile.TarFile
+    :param member_name: Name of the member to add the chunk as.
+    :type member_name: str
+    :param chunk: Data to add.
+    :type chunk: bytes
+    """
+    member = tarfile.TarInfo(member_name)
+    member.size = len(chunk)
+    member.mtime = time.time()
+    tar.addfile(member, io.BytesIO(chunk))
+
+
+def iter_resource_chunks(temba_client, resource, chunk_size_bytes, get_kwargs=None):
+    """
+    Downloads all the records of a resource from Rapid Pro a page at a time, grouping them into JSONL chunks.
+
+    :param temba_client: Temba client to download with.
+    :type temba_client: temba_client.v2.TembaClient
+    :param resource: Resource to download. See `ARCHIVE_RESOURCES`.
+    :type resource: str
+    :param chunk_size_bytes: Approximate size of each chunk. Chunks are emitted as soon as they exceed this size.
+    :type chunk_size_bytes: int
+    :param get_kwargs: Keyword arguments to pass to the TembaClient get method, e.g. to filter the records, or None.
+    :type get_kwargs: dict | None
+    :return: Generator of (chunk, records downloaded into the chunk) for each chunk, where each chunk contains one
+             serialized record per line.
+    :rtype: generator of (bytes, list of temba_client.serialization.TembaObject)
+    """
+    query = getattr(temba_client, f"get_{resource}")(**(get_kwargs or dict()))
+    chunk = io.BytesIO()
+    chunk_records = []
+    for page in query.iterfetches(retry_on_rate_exceed=True):
+        for record in page:
+            chunk.write(json.dumps(record.serialize()).encode("utf-8"))
+            chunk.write(b"\n")
+            chunk_records.append(record)
+        if chunk.tell() >= chunk_size_bytes:
+            yield chunk.getvalue(), chunk_records
+            chunk = io.BytesIO()
+            chunk_records = []
+    if len(chunk_records) > 0:
+        yield chunk.getvalue(), chunk_records
+
+
+def write_streaming_archive(temba_client, fileobj, archive_name,
+                            max_concurrent_resources=DEFAULT_MAX_CONCURRENT_RESOURCES,
+                            chunk_size_bytes=DEFAULT_CHUNK_SIZE_BYTES, resources=None, resource_get_kwargs=None,
+                            on_chunk_archived=None):
+    """
+    Downloads resources from a Rapid Pro workspace concurrently, streaming them into a gzipped tar as they arrive.
+
+    Each resource is written as a series of JSONL tar members called
+    <archive_name>/<resource>/<resource>-<chunk index>.jsonl, so that no more than a few chunks are ever held in
+    memory and nothing is staged on disk.
+
+    :param temba_client: Temba client to download with.
+    :type temba_client: temba_client.v2.TembaClient
+    :param fileobj: Binary file-like object to write the tar.gz stream to. This is not closed.
+    :type fileobj: file-like
+    :param archive_name: Name of the directory in the archive to write the resources to.
+    :type archive_name: str
+    :param max_concurrent_resources: Maximum number of resources to download at once.
+    :type max_concurrent_resources: int
+    :param chunk_size_bytes: Approximate size of each tar member.
+    :type chunk_size_bytes: int
+    :param resources: Resources to archive, or None to archive all the `ARCHIVE_RESOURCES`.
+    :type resources: list of str | None
+    :param resource_get_kwargs: Dictionary of resource -> keyword arguments to pass to the TembaClient get method for
+                                that resource, or None.
+    :type resource_get_kwargs: dict of str -> dict | None
+    :param on_chunk_archived: Function to call with (resource, records) after each chunk has been written to the tar,
+                              or None. This is called from the thread writing the tar, one chunk at a time.
+    :type on_chunk_archived: (func of str, list of temba_client.serialization.TembaObject -> None) | None
+    :return: Dictionary of resource -> number of records archived.
+    :rtype: dict of str -> int
+    """
+    if resources is None:
+        resources = ARCHIVE_RESOURCES
+    if resource_get_kwargs is None:
+        resource_get_kwargs = dict()
+
+    # Bound the number of chunks waiting to be written, so that downloads pause if writing falls behind
+    chunks = queue.Queue(maxsize=max_concurrent_resources * 2)
+    cancelled = threading.Event()
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def download_resource(resource):
+        try:
+            log.info(f"Downloading {resource}...")
+            for i, (chunk, records) in enumerate(
+                    iter_resource_chunks(temba_client, resource, chunk_size_bytes, resource_get_kwargs.get(resource))):
+                if cancelled.is_set():
+                    log.warning(f"Stopping downloading {resource}, because the archive failed")
+                    return
+                put((resource, (archive_member_name(archive_name, resource, i), chunk, records)))
+        finally:
+            # Signal that this resource is complete, whether or not the download succeeded
+            put((resource, None))
+
+    record_counts = {resource: 0 for resource in resources}
+    with ThreadPoolExecutor(max_workers=max_concurrent_resources) as executor:
+        futures = {resource: executor.submit(download_resource, resource) for resource in resources}
+        try:
+            with tarfile.open(fileobj=fileobj, mode="w|gz") as tar:
+                resources_remaining = len(resources)
+                while resources_remaining > 0:
+                    resource, item = chunks.get()
+                    if item is None:
+                        # Fail as soon as any download fails, before the tar is finalised, so that an incomplete
+                        # archive is never written out as if it were complete
+                        futures[resource].result()
+                        resources_remaining -= 1
+                        continue
+
+                    member_name, chunk, records = item
+                    add_chunk_to_tar(tar, member_name, chunk)
+                    record_counts[resource] += len(records)
+                    if on_chunk_archived is not None:
+                        on_chunk_archived(resource, records)
+                    log.debug(f"Archived {record_counts[resource]} {resource} so far")
+        finally:
+            cancelled.set()
+
+    for resource in resources:
+        log.info(f"Archived {record_counts[resource]} {resource}")
+    return record_counts
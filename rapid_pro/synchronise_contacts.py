@@ -1,4 +1,6 @@
 import argparse
+import gzip
+from datetime import datetime, timedelta, timezone
 
 from core_data_modules.logging import Logger
 from core_data_modules.util import IOUtils
@@ -6,9 +8,20 @@ from storage.google_cloud import google_cloud_utils
 
 from rapid_pro_tools.rapid_pro_client import RapidProClient
 
+from src.contact_ingestion import download_contacts
+from src.contact_sync import SyncSummary, apply_contact_updates, find_unresolved_urns, plan_contact_updates, \
+    synchronise_fields
+from src.contact_writer import RapidProContactWriter, DEFAULT_MAX_CONCURRENT_WRITES, \
+    DEFAULT_MAX_WRITES_PER_SECOND
+from src.contacts import ContactRecord
+from src.sync_state import ContactSyncState
+from src.three_way_merge import ContactMergeBaseStore
+
 log = Logger(__name__)
 log.set_project_name("SynchroniseContacts")
 
+DEFAULT_FULL_RECONCILE_INTERVAL_HOURS = 7 * 24
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Synchronises contacts between two Rapid Pro workspaces")
 
@@ -19,6 +32,27 @@ if __name__ == "__main__":
                              "workspace")
     parser.add_argument("--workspaces-to-update", choices=["1", "2", "both"], const="both", default="both", nargs="?",
                         help="The workspaces to update")
+    parser.add_argument("--incremental-state-path",
+                        help="Path to a SQLite file to keep a copy of both workspaces' contacts in between runs. If "
+                             "provided, only the contacts modified in either workspace since the previous run are "
+                             "downloaded, except when a full sync is due. Contacts left out of sync by a previous "
+                             "run, e.g. because they differed and --force wasn't set, are compared again on every run")
+    parser.add_argument("--full-reconcile-interval-hours", type=float, default=DEFAULT_FULL_RECONCILE_INTERVAL_HOURS,
+                        help=f"When using --incremental-state-path, the number of hours after which to download every "
+                             f"contact again, to catch any changes an incremental sync can miss, such as deleted "
+                             f"contacts. Defaults to {DEFAULT_FULL_RECONCILE_INTERVAL_HOURS}")
+    parser.add_argument("--merge-base-path",
+                        help="Path to a SQLite file to keep the synchronised version of each contact in after each "
+                             "sync. If provided, contacts which differ are merged field by field against the version "
+                             "from the last sync, and only the changed fields are written. Contacts where both "
+                             "workspaces changed the same field are only merged if --force is set, in which case the "
+                             "latest value of that field is written everywhere")
+    parser.add_argument("--max-concurrent-writes", type=int, default=DEFAULT_MAX_CONCURRENT_WRITES,
+                        help=f"Maximum number of contact writes to have in flight at once to each workspace. "
+                             f"Defaults to {DEFAULT_MAX_CONCURRENT_WRITES}")
+    parser.add_argument("--max-writes-per-second", type=float, default=DEFAULT_MAX_WRITES_PER_SECOND,
+                        help=f"Maximum rate to write contacts to each workspace at. The rate is automatically reduced "
+                             f"if Rapid Pro throttles the writes. Defaults to {DEFAULT_MAX_WRITES_PER_SECOND}")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
                         help="Path to a Google Cloud service account credentials file to use to access the "
                              "credentials bucket")
@@ -32,13 +66,19 @@ if __name__ == "__main__":
                         help="GS URL to the organisation access token file for authenticating to the second workspace")
     parser.add_argument("raw_data_log_directory", metavar="raw-data-log-directory",
                         help="Directory to log the raw contacts data exported from Rapid Pro to. Data is exported to "
-                             "files called <raw-data-log-directory>/<workspace-name>_raw_contacts.json")
+                             "gzipped JSONL files called "
+                             "<raw-data-log-directory>/<workspace-name>_raw_contacts.jsonl.gz")
 
     args = parser.parse_args()
 
     force_update = args.force
     dry_run = args.dry_run
     workspaces_to_update = args.workspaces_to_update
+    incremental_state_path = args.incremental_state_path
+    full_reconcile_interval_hours = args.full_reconcile_interval_hours
+    merge_base_path = args.merge_base_path
+    max_concurrent_writes = args.max_concurrent_writes
+    max_writes_per_second = args.max_writes_per_second
 
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
     workspace_1_domain = args.workspace_1_domain
@@ -72,189 +112,135 @@ if __name__ == "__main__":
     log.info(f"Downloading all fields from {workspace_2_name}...")
     workspace_2_fields = workspace_2.get_fields()
 
-    # Synchronise the contacts
+    workspaces = [workspace_1, workspace_2]
+    workspace_names = [workspace_1_name, workspace_2_name]
+    workspace_fields = [workspace_1_fields, workspace_2_fields]
+
+    # Decide whether to download every contact or only those modified since the previous sync
+    sync_start_time = datetime.now(timezone.utc)
+    sync_state = None
+    full_sync = True
+    if incremental_state_path is not None:
+        sync_state = ContactSyncState.open(incremental_state_path)
+        last_full_reconcile = sync_state.get_last_full_reconcile()
+        watermarks = [sync_state.get_watermark(name) for name in workspace_names]
+        if last_full_reconcile is None or None in watermarks:
+            log.info(f"No previous sync found in '{incremental_state_path}'; performing a full sync")
+        elif sync_start_time - last_full_reconcile > timedelta(hours=full_reconcile_interval_hours):
+            log.info(f"Last full sync was at {last_full_reconcile.isoformat()}, more than "
+                     f"{full_reconcile_interval_hours} hours ago; performing a full sync")
+        else:
+            full_sync = False
+
+    # Download the contacts
     log.info("Downloading contacts...")
     IOUtils.ensure_dirs_exist(raw_data_log_directory)
-    log.info(f"Downloading all contacts from {workspace_1_name}...")
-    with open(f"{raw_data_log_directory}/{workspace_1_name}_raw_contacts.json", "w") as f:
-        workspace_1_contacts = workspace_1.get_raw_contacts(raw_export_log_file=f)
-    log.info(f"Downloading all contacts from {workspace_2_name}...")
-    with open(f"{raw_data_log_directory}/{workspace_2_name}_raw_contacts.json", "w") as f:
-        workspace_2_contacts = workspace_2.get_raw_contacts(raw_export_log_file=f)
-
-    # If in dry_run mode, dereference workspace_1 and workspace_2 as an added safety. This prevents accidental
-    # writes to either workspace.
+    downloaded_contacts = []
+    downloaded_invalid_uuids = []
+    new_watermarks = []
+    for i, (workspace, workspace_name) in enumerate(zip(workspaces, workspace_names)):
+        invalid_uuids = []
+        with gzip.open(f"{raw_data_log_directory}/{workspace_name}_raw_contacts.jsonl.gz", "wt") as f:
+            if full_sync:
+                log.info(f"Downloading all contacts from {workspace_name}...")
+                contacts, downloaded, watermark = download_contacts(workspace, f)
+            else:
+                log.info(f"Downloading contacts modified in {workspace_name} since {watermarks[i].isoformat()}...")
+                contacts, downloaded, watermark = download_contacts(workspace, f, watermarks[i], invalid_uuids)
+        log.info(f"Downloaded {downloaded} contacts from {workspace_name}, of which {len(contacts)} are valid")
+        downloaded_contacts.append(contacts)
+        downloaded_invalid_uuids.append(invalid_uuids)
+        new_watermarks.append(watermark)
+
+    # If in dry_run mode, dereference the workspaces as an added safety. This prevents accidental writes to either
+    # workspace.
     if dry_run:
         workspace_1 = None
         workspace_2 = None
+        workspaces = [None, None]
 
     # Synchronise the data
-    # Synchronise the contact fields
-    new_contact_fields_in_workspace_2 = 0
-    if workspaces_to_update in {"2", "both"}:
-        log.info(f"Synchronising fields from {workspace_1_name} to {workspace_2_name}...")
-        for field in workspace_1_fields:
-            if field.key not in {f.key for f in workspace_2_fields}:
-                new_contact_fields_in_workspace_2 += 1
-                if dry_run:
-                    log.info(f"Would create field '{field.label}'")
-                    continue
-                new_field = workspace_2.create_field(field.label, field.key)
-    new_contact_fields_in_workspace_1 = 0
-    if workspaces_to_update in {"1", "both"}:
-        log.info(f"Synchronising fields from {workspace_2_name} to {workspace_1_name}...")
-        for field in workspace_2_fields:
-            if field.key not in {f.key for f in workspace_1_fields}:
-                new_contact_fields_in_workspace_1 += 1
-                if dry_run:
-                    log.info(f"Would create field '{field.label}'")
-                    continue
-                new_field = workspace_1.create_field(field.label, field.key)
-    log.info("Contact fields synchronised")
-
-    def filter_valid_contacts(contacts):
-        valid_contacts = []
-        for contact in contacts:
-            if len(contact.urns) != 1:
-                log.warning(f"Found a contact with multiple URNS; skipping. "
-                            f"The RapidPro UUID is '{contact.uuid}'")
-                continue
-            if contact.urns[0].startswith("tel:") and not contact.urns[0].startswith("tel:+"):
-                log.warning(f"Found a contact with a telephone number but without a country code; skipping. "
-                            f"The RapidPro UUID is '{contact.uuid}'")
-                continue
-
-            #check for safaricom numbers forwarded with a wrong ke country code formating
-            if contact.urns[0].startswith("tel:+1") and len(contact.urns[0]) < 15:
-                log.warning(f"Found a telephone that startswith +1 but less than 15 digits long. This is probably a malformed"
-                            f" Safaricom number, skipping; "
-                            f"The RapidPro UUID is '{contact.uuid}'")
-                continue
-
-            valid_contacts.append(contact)
-        return valid_contacts
-
-    log.info(f"Filtering out invalid contacts from {workspace_1_name}...")
-    workspace_1_contacts = filter_valid_contacts(workspace_1_contacts)
-    log.info(f"Filtering out invalid contacts from {workspace_2_name}...")
-    workspace_2_contacts = filter_valid_contacts(workspace_2_contacts)
+    summary = SyncSummary()
+    synchronise_fields(workspaces, workspace_names, workspace_fields, workspaces_to_update, dry_run, summary)
 
-    # Trim URN metadata because although Rapid Pro sometimes provides some in its get APIs, it refuses them when setting
-    workspace_1_contacts_lut = {c.urns[0].split("#")[0]: c for c in workspace_1_contacts}
-    workspace_2_contacts_lut = {c.urns[0].split("#")[0]: c for c in workspace_2_contacts}
-    
-    # Set names that are empty string to None, because while RapidPro can return empty string contact names,
-    # it doesn't accept them when uploading
-    for contact in workspace_1_contacts:
-        if contact.name == "":
-            contact.name = None
-    for contact in workspace_2_contacts:
-        if contact.name == "":
-            contact.name = None
-
-    # Rapid Pro returns all the contact fields on each contact, even if there isn't a value set for that field for a
-    # contact. If there is no value set, the field will be returned with value None. This means the moment we create
-    # a new contact field on a Rapid Pro instance, all of the the contacts will immediately differ and be updated
-    # by this tool.
-    # Solve this by ensuring that all contacts have an entry for all the fields from both workspaces, so thac contacts
-    # can only differ if there is a genuine significant difference in field values.
-    all_fields = {f.key for f in workspace_1_fields + workspace_2_fields}
-    for contact in workspace_1_contacts + workspace_2_contacts:
-        for field in all_fields:
-            if field not in contact.fields:
-                contact.fields[field] = None
-
-    # Update contacts present in workspace 1 but not in workspace 2
-    new_contacts_in_workspace_2 = 0
-    if workspaces_to_update in {"2", "both"}:
-        urns_unique_to_workspace_1 = workspace_1_contacts_lut.keys() - workspace_2_contacts_lut.keys()
-        for i, urn in enumerate(urns_unique_to_workspace_1):
-            contact = workspace_1_contacts_lut[urn]
-            log.info(f"Adding new contacts to {workspace_2_name}: {i + 1}/{len(urns_unique_to_workspace_1)} "
-                     f"(Rapid Pro UUID '{contact.uuid}' in {workspace_1_name})")
-            new_contacts_in_workspace_2 += 1
-            if dry_run:
-                continue
-            workspace_2.update_contact(contact.urns[0], contact.name, contact.fields)
-
-    # Update contacts present in workspace 2 but not in workspace 1
-    new_contacts_in_workspace_1 = 0
-    if workspaces_to_update in {"1", "both"}:
-        urns_unique_to_workspace_2 = workspace_2_contacts_lut.keys() - workspace_1_contacts_lut.keys()
-        for i, urn in enumerate(urns_unique_to_workspace_2):
-            contact = workspace_2_contacts_lut[urn]
-            log.info(f"Adding new contacts to {workspace_1_name}: {i + 1}/{len(urns_unique_to_workspace_2)} "
-                     f"(Rapid Pro UUID '{contact.uuid}' in {workspace_2_name})")
-            new_contacts_in_workspace_1 += 1
-            if dry_run:
-                continue
-            workspace_1.update_contact(contact.urns[0], contact.name, contact.fields)
-
-    # Update contacts present in both workspaces
-    identical_contacts = 0
-    skipped_contacts = 0
-    updated_contacts_in_workspace_1 = 0
-    updated_contacts_in_workspace_2 = 0
-    urns_in_both_workspaces = workspace_1_contacts_lut.keys() & workspace_2_contacts_lut.keys()
-    for i, urn in enumerate(sorted(urns_in_both_workspaces)):
-        contact_v1 = workspace_1_contacts_lut[urn]
-        contact_v2 = workspace_2_contacts_lut[urn]
-
-        if contact_v1.name == contact_v2.name and contact_v1.fields == contact_v2.fields:
-            log.debug(f"Synchronising contacts in both workspaces {i + 1}/{len(urns_in_both_workspaces)}: "
-                      f"Contacts identical. "
-                      f"(Rapid Pro UUIDs are '{contact_v1.uuid}' in {workspace_1_name}; "
-                      f"'{contact_v2.uuid}' in {workspace_2_name})")
-            identical_contacts += 1
-            continue
-
-        # Contacts differ
-        if not force_update:
-            log.warning(f"Synchronising contacts in both workspaces {i + 1}/{len(urns_in_both_workspaces)}: "
-                        f"Contacts differ, but not overwriting. Use --force to write the latest everywhere. "
-                        f"(Rapid Pro UUIDs are '{contact_v1.uuid}' in {workspace_1_name}; "
-                        f"'{contact_v2.uuid}' in {workspace_2_name})")
-            skipped_contacts += 1
-            continue
-            
-        # Assume the most recent contact is correct
-        # IMPORTANT: If the same contact has been changed on both Rapid Pro workspaces since the last sync was
-        #            performed, the older changes will be overwritten.
-        if contact_v1.modified_on > contact_v2.modified_on:
-            if workspaces_to_update in {"2", "both"}:
-                log.info(f"Synchronising contacts in both workspaces {i + 1}/{len(urns_in_both_workspaces)}: "
-                         f"Contacts differ, overwriting the contact in {workspace_2_name} with the more recent one in "
-                         f"{workspace_1_name}. "
-                         f"(Rapid Pro UUIDs are '{contact_v1.uuid}' in {workspace_1_name}; "
-                         f"'{contact_v2.uuid}' in {workspace_2_name})")
-                updated_contacts_in_workspace_2 += 1
-                if dry_run:
-                    continue
-                workspace_2.update_contact(urn, contact_v1.name, contact_v1.fields)
-        else:
-            if workspaces_to_update in {"1", "both"}:
-                log.info(f"Synchronising contacts in both workspaces {i + 1}/{len(urns_in_both_workspaces)}: "
-                         f"Contacts differ, overwriting the contact in {workspace_1_name} with the more recent one in "
-                         f"{workspace_2_name}. "
-                         f"(Rapid Pro UUIDs are '{contact_v1.uuid}' in {workspace_1_name}; "
-                         f"'{contact_v2.uuid}' in {workspace_2_name})")
-                updated_contacts_in_workspace_1 += 1
-                if dry_run:
-                    continue
-                workspace_1.update_contact(urn, contact_v2.name, contact_v2.fields)
-
-    log.info(f"Contacts sync complete. Summary of actions{' (dry run)' if dry_run else ''}:")
-    log.info(f"Created {new_contact_fields_in_workspace_1} new contact fields in workspace {workspace_1_name}")
-    log.info(f"Created {new_contact_fields_in_workspace_2} new contact fields in workspace {workspace_2_name}")
-    log.info(f"Created {new_contacts_in_workspace_1} new contacts in workspace {workspace_1_name} using the version in "
-             f"{workspace_2_name}")
-    log.info(f"Created {new_contacts_in_workspace_2} new contacts in workspace {workspace_2_name} using the version in "
-             f"{workspace_1_name}")
-    if force_update:
-        log.info(f"Overwrote {updated_contacts_in_workspace_1} contacts in workspace {workspace_1_name} with the newer "
-                 f"version in workspace {workspace_2_name}")
-        log.info(f"Overwrote {updated_contacts_in_workspace_2} contacts in workspace {workspace_2_name} with the newer "
-                 f"version in workspace {workspace_1_name}")
+    stale_urns = [set(), set()]
+    if full_sync:
+        workspace_contacts = downloaded_contacts
+        urns_to_compare = None
     else:
-        log.info(f"Skipped {skipped_contacts} contacts that differed between the workspaces")
-    log.info(f"Skipped {identical_contacts} contacts that were identical in both workspaces")
+        # Only contacts modified in at least one workspace can need synchronising. Compare each of these with the
+        # version of the contact in the other workspace, using the stored version if it wasn't modified there.
+        urns_to_compare = downloaded_contacts[0].keys() | downloaded_contacts[1].keys()
+
+        # A modified contact whose URN changed, or which is no longer valid, is still stored under its old URN.
+        # Forget those stored versions, and compare their URNs again, as a full sync would.
+        for i, (workspace_name, contacts) in enumerate(zip(workspace_names, downloaded_contacts)):
+            modified_uuids = [record.uuid for record in contacts.values()] + downloaded_invalid_uuids[i]
+            stale_urns[i] = sync_state.get_urns_of_contacts(workspace_name, modified_uuids) - contacts.keys()
+            urns_to_compare |= stale_urns[i]
+
+        # Contacts left out of sync by the previous sync weren't necessarily modified since, so compare them again
+        unresolved_urns = sync_state.get_unresolved_urns()
+        urns_to_compare |= unresolved_urns
+
+        log.info(f"Comparing the {len(urns_to_compare)} contacts modified since the previous sync or left out of sync "
+                 f"by it ({len(unresolved_urns)} left out of sync)...")
+        workspace_contacts = []
+        for workspace_name, contacts, workspace_stale_urns in zip(workspace_names, downloaded_contacts, stale_urns):
+            stored_contacts = sync_state.get_contacts(
+                workspace_name, urns_to_compare - contacts.keys() - workspace_stale_urns)
+            stored_contacts.update(contacts)
+            workspace_contacts.append(stored_contacts)
+
+    merge_base_store = None
+    if merge_base_path is not None:
+        merge_base_store = ContactMergeBaseStore.open(merge_base_path)
+
+    updates = plan_contact_updates(
+        workspace_names, workspace_contacts, urns_to_compare, force_update, workspaces_to_update, summary,
+        merge_base_store
+    )
+    if not dry_run:
+        log.info(f"Writing {len(updates)} contacts...")
+        writers = [
+            RapidProContactWriter(domain, token, max_concurrent_writes, max_writes_per_second)
+            for domain, token in [(workspace_1_domain, workspace_1_token), (workspace_2_domain, workspace_2_token)]
+        ]
+        all_fields = {f.key for f in workspace_fields[0] + workspace_fields[1]}
+        apply_contact_updates(writers, updates, all_fields)
+
+    summary.log(workspace_names, dry_run, force_update, three_way_merge=merge_base_store is not None)
+
+    if merge_base_store is not None:
+        if not dry_run:
+            log.info(f"Updating the merge base versions at '{merge_base_path}'...")
+            merge_base_store.commit()
+        merge_base_store.close()
+
+    if sync_state is not None:
+        if dry_run:
+            log.info(f"Not updating the incremental state at '{incremental_state_path}' (dry run)")
+        else:
+            log.info(f"Updating the incremental state at '{incremental_state_path}'...")
+            for workspace_name, contacts, workspace_stale_urns, watermark in zip(
+                    workspace_names, downloaded_contacts, stale_urns, new_watermarks):
+                if full_sync:
+                    sync_state.replace_contacts(workspace_name, contacts.values())
+                else:
+                    sync_state.delete_contacts(workspace_name, workspace_stale_urns)
+                    sync_state.upsert_contacts(workspace_name, contacts.values())
+                if watermark is not None:
+                    sync_state.set_watermark(workspace_name, watermark)
+            for update in updates:
+                # Store the written version under the contact's UUID in the target workspace, rather than the UUID of
+                # the version it was copied or merged from, so that it can still be found by UUID
+                target_contact = workspace_contacts[update.target].get(update.record.urn)
+                sync_state.upsert_contacts(workspace_names[update.target], [ContactRecord(
+                    update.record.urn, None if target_contact is None else target_contact.uuid, update.record.name,
+                    update.record.fields, update.record.modified_on
+                )])
+            sync_state.set_unresolved_urns(find_unresolved_urns(workspace_contacts, urns_to_compare, updates))
+            if full_sync:
+                sync_state.set_last_full_reconcile(sync_start_time)
+            sync_state.commit()
+        sync_state.close()
@@ -0,0 +1,134 @@
+import argparse
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+
+from core_data_modules.logging import Logger
+from core_data_modules.util import IOUtils
+from storage.google_cloud import google_cloud_utils
+
+from rapid_pro_tools.rapid_pro_client import RapidProClient
+
+from src.contact_ingestion import download_contacts
+from src.contact_sync import apply_contact_updates
+from src.contact_writer import RapidProContactWriter, DEFAULT_MAX_CONCURRENT_WRITES, \
+    DEFAULT_MAX_WRITES_PER_SECOND
+from src.n_way_sync import NWaySyncSummary, index_contacts_by_urn, plan_n_way_contact_updates, \
+    synchronise_fields_n_way
+
+log = Logger(__name__)
+log.set_project_name("SynchroniseContactsAcrossWorkspaces")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synchronises contacts between any number of Rapid Pro workspaces, "
+                                                 "downloading each workspace's contacts once")
+
+    parser.add_argument("-f", "--force", const=True, default=False, action="store_const",
+                        help="Overwrite contacts which differ between the workspaces with the latest")
+    parser.add_argument("--dry-run", const=True, default=False, action="store_const",
+                        help="Logs the updates that would be made without actually updating any data in any "
+                             "workspace")
+    parser.add_argument("--workspaces-to-update", type=int, nargs="+",
+                        help="The numbers of the workspaces to update, counting from 1 in the order the workspaces "
+                             "are given in. Defaults to updating every workspace")
+    parser.add_argument("--max-concurrent-writes", type=int, default=DEFAULT_MAX_CONCURRENT_WRITES,
+                        help=f"Maximum number of contact writes to have in flight at once to each workspace. "
+                             f"Defaults to {DEFAULT_MAX_CONCURRENT_WRITES}")
+    parser.add_argument("--max-writes-per-second", type=float, default=DEFAULT_MAX_WRITES_PER_SECOND,
+                        help=f"Maximum rate to write contacts to each workspace at. The rate is automatically reduced "
+                             f"if Rapid Pro throttles the writes. Defaults to {DEFAULT_MAX_WRITES_PER_SECOND}")
+    parser.add_argument("--workspace", nargs=2, action="append", required=True,
+                        metavar=("DOMAIN", "CREDENTIALS_URL"), dest="workspaces",
+                        help="Domain that a workspace is running on, and GS URL to the organisation access token "
+                             "file for authenticating to it. Provide this once per workspace to synchronise")
+    parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
+                        help="Path to a Google Cloud service account credentials file to use to access the "
+                             "credentials bucket")
+    parser.add_argument("raw_data_log_directory", metavar="raw-data-log-directory",
+                        help="Directory to log the raw contacts data exported from Rapid Pro to. Data is exported to "
+                             "gzipped JSONL files called "
+                             "<raw-data-log-directory>/<workspace-name>_raw_contacts.jsonl.gz")
+
+    args = parser.parse_args()
+
+    force_update = args.force
+    dry_run = args.dry_run
+    workspaces_to_update = args.workspaces_to_update
+    max_concurrent_writes = args.max_concurrent_writes
+    max_writes_per_second = args.max_writes_per_second
+    workspace_domains_and_credentials_urls = args.workspaces
+
+    google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
+    raw_data_log_directory = args.raw_data_log_directory
+
+    if len(workspace_domains_and_credentials_urls) < 2:
+        parser.error("At least two workspaces must be provided")
+    if workspaces_to_update is None:
+        targets = set(range(len(workspace_domains_and_credentials_urls)))
+    else:
+        if not all(1 <= n <= len(workspace_domains_and_credentials_urls) for n in workspaces_to_update):
+            parser.error(f"--workspaces-to-update must be between 1 and {len(workspace_domains_and_credentials_urls)}")
+        targets = {n - 1 for n in workspaces_to_update}
+
+    if dry_run:
+        log.info("Performing a dry-run")
+
+    # Initialise the Rapid Pro clients
+    workspaces = []
+    workspace_names = []
+    workspace_tokens = []
+    for i, (domain, credentials_url) in enumerate(workspace_domains_and_credentials_urls):
+        log.info(f"Downloading the access token for workspace {i + 1}...")
+        token = google_cloud_utils.download_blob_to_string(google_cloud_credentials_file_path, credentials_url).strip()
+        workspace = RapidProClient(domain, token)
+        workspace_name = workspace.get_workspace_name()
+        log.info(f"Done. workspace {i + 1} is called {workspace_name}")
+        workspaces.append(workspace)
+        workspace_names.append(workspace_name)
+        workspace_tokens.append(token)
+
+    # Download the data from Rapid Pro
+    log.info("Downloading contact fields...")
+    workspace_fields = []
+    for workspace, workspace_name in zip(workspaces, workspace_names):
+        log.info(f"Downloading all fields from {workspace_name}...")
+        workspace_fields.append(workspace.get_fields())
+
+    # Download each workspace's contacts once, from all the workspaces at the same time
+    log.info("Downloading contacts...")
+    IOUtils.ensure_dirs_exist(raw_data_log_directory)
+
+    def download_workspace_contacts(workspace, workspace_name):
+        log.info(f"Downloading all contacts from {workspace_name}...")
+        with gzip.open(f"{raw_data_log_directory}/{workspace_name}_raw_contacts.jsonl.gz", "wt") as f:
+            contacts, downloaded, _ = download_contacts(workspace, f)
+        log.info(f"Downloaded {downloaded} contacts from {workspace_name}, of which {len(contacts)} are valid")
+        return contacts
+
+    with ThreadPoolExecutor(max_workers=len(workspaces)) as executor:
+        workspace_contacts = list(executor.map(download_workspace_contacts, workspaces, workspace_names))
+
+    # If in dry_run mode, dereference the workspaces as an added safety. This prevents accidental writes to any
+    # workspace.
+    if dry_run:
+        workspaces = [None] * len(workspaces)
+
+    # Synchronise the data
+    summary = NWaySyncSummary(len(workspaces))
+    synchronise_fields_n_way(workspaces, workspace_names, workspace_fields, targets, dry_run, summary)
+
+    log.info("Indexing contacts by URN...")
+    urn_index = index_contacts_by_urn(workspace_contacts)
+    del workspace_contacts
+    log.info(f"Found {len(urn_index)} distinct contacts across the {len(workspace_names)} workspaces")
+
+    updates = plan_n_way_contact_updates(workspace_names, urn_index, force_update, targets, summary)
+    if not dry_run:
+        log.info(f"Writing {len(updates)} contacts...")
+        writers = [
+            RapidProContactWriter(domain, token, max_concurrent_writes, max_writes_per_second)
+            for (domain, _), token in zip(workspace_domains_and_credentials_urls, workspace_tokens)
+        ]
+        all_fields = {f.key for fields in workspace_fields for f in fields}
+        apply_contact_updates(writers, updates, all_fields)
+
+    summary.log(workspace_names, dry_run, force_update)